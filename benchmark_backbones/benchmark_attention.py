@@ -0,0 +1,107 @@
+import argparse
+import time
+
+import torch
+from model.SwinUNETR import SwinUNETR
+
+
+def build_model(args, size, attn_backend):
+    return SwinUNETR(
+        img_size=(size, size, size),
+        in_channels=1,
+        out_channels=args.num_class,
+        feature_size=48,
+        drop_rate=0.0,
+        attn_drop_rate=0.0,
+        dropout_path_rate=0.0,
+        use_checkpoint=False,
+        attn_backend=attn_backend,
+    ).to(args.device)
+
+
+def run(args, model, x):
+    if args.train:
+        model.train()
+        out = model(x)
+        out.float().mean().backward()
+        model.zero_grad(set_to_none=True)
+    else:
+        model.eval()
+        with torch.no_grad():
+            out = model(x)
+    return out.detach()
+
+
+def measure(args, model, x):
+    is_cuda = args.device.startswith("cuda")
+    with torch.autocast(device_type=args.device.split(":")[0], enabled=args.amp):
+        for _ in range(args.warmup):
+            out = run(args, model, x)
+        if is_cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time.time()
+        for _ in range(args.num_iters):
+            out = run(args, model, x)
+        if is_cuda:
+            torch.cuda.synchronize()
+    latency = (time.time() - start) / args.num_iters
+    peak_mb = torch.cuda.max_memory_allocated() / 1024**2 if is_cuda else None
+    return latency, peak_mb, out
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "compare the math and sdpa attention backends of SwinUNETR: numerical"
+            " equivalence, latency and peak memory"
+        )
+    )
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--sizes", nargs="+", default=[96, 128], type=int)
+    parser.add_argument("--num_class", default=9, type=int, help="number of class")
+    parser.add_argument("--batch_size", default=1, type=int, help="batch size")
+    parser.add_argument("--num_iters", default=10, type=int, help="timed iterations")
+    parser.add_argument("--warmup", default=2, type=int, help="untimed iterations")
+    parser.add_argument("--amp", action="store_true", help="run under autocast")
+    parser.add_argument(
+        "--train",
+        action="store_true",
+        help="time forward + backward instead of inference",
+    )
+    parser.add_argument(
+        "--atol", default=1e-4, type=float, help="tolerance of the equivalence check"
+    )
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        torch.manual_seed(0)
+        x = torch.randn(args.batch_size, 1, size, size, size, device=args.device)
+        math_model = build_model(args, size, "math")
+        sdpa_model = build_model(args, size, "sdpa")
+        sdpa_model.load_state_dict(math_model.state_dict())
+
+        results = {}
+        for name, model in (("math", math_model), ("sdpa", sdpa_model)):
+            results[name] = measure(args, model, x)
+            latency, peak_mb, _ = results[name]
+            print(
+                "%d^3 %s: %.1f ms/iter, peak memory %s"
+                % (
+                    size,
+                    name,
+                    latency * 1000,
+                    "%.0f MB" % peak_mb if peak_mb is not None else "n/a (cpu)",
+                )
+            )
+
+        diff = (results["math"][2].float() - results["sdpa"][2].float()).abs().max()
+        status = "ok" if diff.item() <= args.atol else "MISMATCH"
+        print("%d^3 max abs difference: %.2e (%s)" % (size, diff.item(), status))
+        del math_model, sdpa_model
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import time
+
+import model.SwinUNETR as swin
+import torch
+from model.SwinUNETR import SwinUNETR
+
+
+def time_patches(args, model, x):
+    with torch.no_grad():
+        for _ in range(args.warmup):
+            out = model(x)
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(args.num_iters):
+            out = model(x)
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+    return elapsed / (args.num_iters * args.batch_size), out
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "per patch inference latency of SwinUNETR with and without cached"
+            " attention masks / relative position bias"
+        )
+    )
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--roi_x", default=96, type=int, help="roi size in x direction")
+    parser.add_argument("--roi_y", default=96, type=int, help="roi size in y direction")
+    parser.add_argument("--roi_z", default=96, type=int, help="roi size in z direction")
+    parser.add_argument("--num_class", default=9, type=int, help="number of class")
+    parser.add_argument("--batch_size", default=1, type=int, help="patches per forward")
+    parser.add_argument(
+        "--num_iters", default=20, type=int, help="timed forward passes"
+    )
+    parser.add_argument("--warmup", default=3, type=int, help="untimed forward passes")
+    parser.add_argument("--amp", action="store_true", help="run under autocast")
+    args = parser.parse_args()
+
+    model = SwinUNETR(
+        img_size=(args.roi_x, args.roi_y, args.roi_z),
+        in_channels=1,
+        out_channels=args.num_class,
+        feature_size=48,
+        drop_rate=0.0,
+        attn_drop_rate=0.0,
+        dropout_path_rate=0.0,
+        use_checkpoint=False,
+    )
+    model.to(args.device)
+    model.eval()
+    x = torch.randn(
+        args.batch_size, 1, args.roi_x, args.roi_y, args.roi_z, device=args.device
+    )
+
+    results = {}
+    with torch.autocast(device_type=args.device.split(":")[0], enabled=args.amp):
+        for cached in (False, True):
+            swin.CACHE_ATTENTION_CONSTANTS = cached
+            results[cached] = time_patches(args, model, x)
+
+    print("per patch latency without cache: %.2f ms" % (results[False][0] * 1000))
+    print("per patch latency with cache:    %.2f ms" % (results[True][0] * 1000))
+    print("speedup: %.2fx" % (results[False][0] / results[True][0]))
+    print(
+        "max abs difference of the logits: %.2e"
+        % (results[False][1].float() - results[True][1].float()).abs().max().item()
+    )
+
+
+if __name__ == "__main__":
+    main()
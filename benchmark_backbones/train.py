@@ -17,6 +17,7 @@ from tensorboardX import SummaryWriter
 from torch.nn.parallel import DistributedDataParallel
 
 from utils import loss
+from utils.memory_planner import configure_activation_checkpointing
 
 torch.multiprocessing.set_sharing_strategy("file_system")
 
@@ -94,8 +95,15 @@ def process(args):
             attn_drop_rate=0.0,
             dropout_path_rate=0.0,
             use_checkpoint=False,
+            attn_backend=args.attn_backend,
         )
 
+    configure_activation_checkpointing(
+        model,
+        args,
+        output_file=os.path.join("out", args.log_name, "memory_plan.json"),
+        verbose=rank == 0,
+    )
     model.to(args.device)
     model.train()
 
@@ -186,6 +194,27 @@ def main():
     parser.add_argument(
         "--backbone", default="unet", help="model backbone, unet backbone by default"
     )
+    parser.add_argument(
+        "--attn_backend",
+        default="math",
+        help=(
+            "attention backend of swinunetr: math or sdpa (fused, requires torch>=2.0)"
+        ),
+    )
+    parser.add_argument(
+        "--memory_budget",
+        default=None,
+        type=float,
+        help=(
+            "target peak gpu memory in GB. Selects the blocks to checkpoint"
+            " (recompute in the backward pass) after a dry run on the cpu"
+        ),
+    )
+    parser.add_argument(
+        "--memory_plan",
+        default=None,
+        help="reuse a memory_plan.json written by --memory_budget",
+    )
 
     ## dataset
     parser.add_argument("--dataset_list", nargs="+", default=["AbdomenAtlas1.0"])
@@ -0,0 +1,171 @@
+import argparse
+import time
+
+import nibabel as nib
+import numpy as np
+import torch
+from monai.inferers import sliding_window_inference
+
+from utils.adaptive_overlap import adaptive_sliding_window_inference, format_stats
+from utils.cpu_inference import configure_cpu_threads
+from utils.inference_artifact import (
+    build_model,
+    get_model_config,
+    load_checkpoint_by_name,
+    load_inference_artifact,
+)
+from utils.utils import NUM_CLASS
+
+
+def load_model(args):
+    if args.artifact is not None:
+        model, metadata = load_inference_artifact(args.artifact, device=args.device)
+        args.roi_x, args.roi_y, args.roi_z = metadata["roi"]
+        return model
+    model = build_model(get_model_config(args, NUM_CLASS))
+    if args.checkpoint is not None:
+        load_checkpoint_by_name(model, args.checkpoint)
+    return model.to(args.device).eval()
+
+
+def load_images(args):
+    """
+    the held-out images, intensities scaled like ScaleIntensityRanged (the images are not resampled). Without
+    --images a random noise volume of --size
+    """
+    if not args.images:
+        return [("random", torch.rand(1, 1, *args.size))]
+    images = []
+    for image_file in args.images:
+        image = np.asarray(nib.load(image_file).dataobj, dtype=np.float32)
+        image = np.clip((image - args.a_min) / (args.a_max - args.a_min), 0, 1)
+        images.append((image_file, torch.from_numpy(image[None, None].copy())))
+    return images
+
+
+def dice(a, b):
+    intersection = (a & b).sum().item()
+    total = a.sum().item() + b.sum().item()
+    return 1.0 if total == 0 else 2.0 * intersection / total
+
+
+def mean_dice(pred, reference):
+    # sigmoid outputs, mean over the classes present in either mask
+    pred, reference = pred[0] > 0, reference[0] > 0
+    dices = [
+        dice(p, r) for p, r in zip(pred, reference) if p.any().item() or r.any().item()
+    ]
+    return np.mean(dices) if len(dices) > 0 else 1.0
+
+
+@torch.no_grad()
+def fixed_overlap(args, model, image, overlap):
+    start = time.time()
+    logits = sliding_window_inference(
+        image,
+        (args.roi_x, args.roi_y, args.roi_z),
+        1,
+        model,
+        overlap=overlap,
+        mode="gaussian",
+        sw_device=args.device,
+        device="cpu",
+    )
+    return logits, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "patches, latency and dice of the adaptive overlap sliding window relative"
+            " to a fixed overlap (--overlap)"
+        )
+    )
+    parser.add_argument("--artifact", default=None, help="eager inference artifact")
+    parser.add_argument("--checkpoint", default=None, help="trained checkpoint")
+    parser.add_argument(
+        "--backbone", default="unet", help="backbone [swinunetr or unet]"
+    )
+    parser.add_argument("--images", nargs="*", default=[], help="held-out cts")
+    parser.add_argument(
+        "--size",
+        nargs=3,
+        default=[192, 192, 128],
+        type=int,
+        help="size of the random volume without --images",
+    )
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--cpu_threads", default=None, type=int)
+    parser.add_argument("--roi_x", default=96, type=int, help="roi size in x direction")
+    parser.add_argument("--roi_y", default=96, type=int, help="roi size in y direction")
+    parser.add_argument("--roi_z", default=96, type=int, help="roi size in z direction")
+    parser.add_argument(
+        "--a_min", default=-175, type=float, help="a_min in ScaleIntensityRanged"
+    )
+    parser.add_argument(
+        "--a_max", default=250, type=float, help="a_max in ScaleIntensityRanged"
+    )
+    parser.add_argument("--overlap", default=0.75, type=float, help="fixed overlap")
+    parser.add_argument(
+        "--base_overlap", default=0.5, type=float, help="overlap of the base pass"
+    )
+    parser.add_argument("--entropy_threshold", default=0.05, type=float)
+    parser.add_argument("--disagreement_threshold", default=0.1, type=float)
+    parser.add_argument("--min_uncertain_voxels", default=100, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+    # read by get_model_config
+    args.customize = False
+    args.attn_backend = "math"
+    args.unet_bn_mode = "batch"
+    args.static_dints = False
+
+    torch.manual_seed(args.seed)
+    if args.device == "cpu":
+        print("cpu threads: %d" % configure_cpu_threads(args.cpu_threads))
+    model = load_model(args)
+    for name, image in load_images(args):
+        print("%s %s" % (name, tuple(image.shape[2:])))
+        reference, reference_time = fixed_overlap(args, model, image, args.overlap)
+        base, base_time = fixed_overlap(args, model, image, args.base_overlap)
+        with torch.no_grad():
+            start = time.time()
+            adaptive, stats = adaptive_sliding_window_inference(
+                image,
+                model,
+                (args.roi_x, args.roi_y, args.roi_z),
+                activation="sigmoid",
+                base_overlap=args.base_overlap,
+                overlap=args.overlap,
+                entropy_threshold=args.entropy_threshold,
+                disagreement_threshold=args.disagreement_threshold,
+                min_uncertain_voxels=args.min_uncertain_voxels,
+                sw_device=args.device,
+                device="cpu",
+            )
+            adaptive_time = time.time() - start
+        print("  " + format_stats(stats))
+        dices = {}
+        for method, logits, latency in (
+            ("overlap %.2f" % args.overlap, reference, reference_time),
+            ("overlap %.2f" % args.base_overlap, base, base_time),
+            ("adaptive", adaptive, adaptive_time),
+        ):
+            dices[method] = mean_dice(logits, reference)
+            print(
+                "  %-13s %7.2f s  dice vs overlap %.2f: %.4f"
+                % (method, latency, args.overlap, dices[method])
+            )
+        print(
+            "  adaptive vs overlap %.2f: dice delta %+.4f"
+            % (
+                args.base_overlap,
+                dices["adaptive"] - dices["overlap %.2f" % args.base_overlap],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
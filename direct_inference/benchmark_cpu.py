@@ -0,0 +1,140 @@
+import argparse
+import copy
+import time
+
+import nibabel as nib
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils.cpu_inference import CPUPredictor, configure_cpu_threads
+from utils.inference_artifact import (
+    build_model,
+    get_model_config,
+    load_checkpoint_by_name,
+    load_inference_artifact,
+)
+from utils.utils import NUM_CLASS
+
+
+def load_patches(args, rng):
+    """
+    args.patches_per_image random crops of every held-out image, intensities scaled like ScaleIntensityRanged (the
+    images are not resampled). Without --images the patches are random noise
+    """
+    roi = (args.roi_x, args.roi_y, args.roi_z)
+    if not args.images:
+        return [torch.rand(1, 1, *roi) for _ in range(args.patches_per_image)]
+    patches = []
+    for image_file in args.images:
+        image = np.asarray(nib.load(image_file).dataobj, dtype=np.float32)
+        image = np.clip((image - args.a_min) / (args.a_max - args.a_min), 0, 1)
+        image = np.pad(
+            image,
+            [(0, max(0, r - s)) for r, s in zip(roi, image.shape)],
+            mode="constant",
+        )
+        for _ in range(args.patches_per_image):
+            start = [rng.randint(0, s - r + 1) for r, s in zip(roi, image.shape)]
+            patch = image[tuple(slice(st, st + r) for st, r in zip(start, roi))]
+            patches.append(torch.from_numpy(patch[None, None].copy()))
+    return patches
+
+
+def load_model(args):
+    if args.artifact is not None:
+        model, metadata = load_inference_artifact(args.artifact, device="cpu")
+        args.roi_x, args.roi_y, args.roi_z = metadata["roi"]
+        return model
+    model = build_model(get_model_config(args, NUM_CLASS))
+    if args.checkpoint is not None:
+        load_checkpoint_by_name(model, args.checkpoint)
+    return model.eval()
+
+
+@torch.no_grad()
+def predict(predictor, patches):
+    start = time.time()
+    preds = [F.sigmoid(predictor(x)) for x in patches]
+    return preds, (time.time() - start) / len(patches)
+
+
+def dice(a, b):
+    intersection = (a & b).sum().item()
+    total = a.sum().item() + b.sum().item()
+    return 1.0 if total == 0 else 2.0 * intersection / total
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "accuracy vs latency of the cpu inference options (quantization, channels"
+            " last) on held-out images, relative to fp32"
+        )
+    )
+    parser.add_argument("--artifact", default=None, help="eager inference artifact")
+    parser.add_argument("--checkpoint", default=None, help="trained checkpoint")
+    parser.add_argument(
+        "--backbone", default="unet", help="backbone [swinunetr or unet]"
+    )
+    parser.add_argument("--images", nargs="*", default=[], help="held-out cts")
+    parser.add_argument("--patches_per_image", default=4, type=int)
+    parser.add_argument(
+        "--variants",
+        nargs="+",
+        default=["none+cl", "int8", "bf16", "bf16+cl"],
+        help="quantization mode, +cl for channels last",
+    )
+    parser.add_argument("--cpu_threads", default=None, type=int)
+    parser.add_argument("--roi_x", default=96, type=int, help="roi size in x direction")
+    parser.add_argument("--roi_y", default=96, type=int, help="roi size in y direction")
+    parser.add_argument("--roi_z", default=96, type=int, help="roi size in z direction")
+    parser.add_argument(
+        "--a_min", default=-175, type=float, help="a_min in ScaleIntensityRanged"
+    )
+    parser.add_argument(
+        "--a_max", default=250, type=float, help="a_max in ScaleIntensityRanged"
+    )
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+    # read by get_model_config
+    args.customize = False
+    args.attn_backend = "math"
+    args.unet_bn_mode = "batch"
+    args.static_dints = False
+
+    print("cpu threads: %d" % configure_cpu_threads(args.cpu_threads))
+    model = load_model(args)
+    patches = load_patches(args, np.random.RandomState(args.seed))
+
+    reference, reference_latency = predict(model, patches)
+    print(
+        "%-10s %9.1f ms/patch  speedup 1.00x  max abs diff 0.00e+00  dice 1.0000"
+        % ("fp32", reference_latency * 1000)
+    )
+    for variant in args.variants:
+        quantization, _, suffix = variant.partition("+")
+        predictor = CPUPredictor(
+            copy.deepcopy(model), quantization, channels_last=suffix == "cl"
+        ).eval()
+        preds, latency = predict(predictor, patches)
+        max_diff = max([(p - r).abs().max().item() for p, r in zip(preds, reference)])
+        dices = [
+            dice(p[0, c] > 0.5, r[0, c] > 0.5)
+            for p, r in zip(preds, reference)
+            for c in range(r.shape[1])
+        ]
+        print(
+            "%-10s %9.1f ms/patch  speedup %.2fx  max abs diff %.2e  dice %.4f"
+            % (
+                variant,
+                latency * 1000,
+                reference_latency / latency,
+                max_diff,
+                np.mean(dices),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+from model.DiNTS import DiNTS, TopologyInstance, export_static_dints
+
+
+def build_model(args):
+    ckpt = torch.load(args.arch_code)
+    dints_space = TopologyInstance(
+        channel_mul=1.0,
+        num_blocks=12,
+        num_depths=4,
+        use_downsample=True,
+        arch_code=[ckpt["arch_code_a"], ckpt["arch_code_c"]],
+    )
+    return DiNTS(
+        dints_space=dints_space,
+        in_channels=1,
+        num_classes=3,
+        use_downsample=True,
+        node_a=ckpt["node_a"],
+    )
+
+
+def reset_cpu_peak():
+    # resets VmHWM (peak resident set size) of this process, linux only
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def read_cpu_peak():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+@torch.no_grad()
+def measure(args, model, x):
+    is_cuda = args.device.startswith("cuda")
+    with torch.autocast(device_type=args.device.split(":")[0], enabled=args.amp):
+        for _ in range(args.warmup):
+            model(x)
+        if is_cuda:
+            torch.cuda.synchronize()
+            base_mb = torch.cuda.memory_allocated() / 1024**2
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            base_mb = read_cpu_peak() if reset_cpu_peak() else None
+        start = time.time()
+        for _ in range(args.num_iters):
+            out = model(x)
+        if is_cuda:
+            torch.cuda.synchronize()
+    latency = (time.time() - start) / args.num_iters
+    if is_cuda:
+        peak_mb = torch.cuda.max_memory_allocated() / 1024**2 - base_mb
+    elif base_mb is not None:
+        peak_mb = read_cpu_peak() - base_mb
+    else:
+        peak_mb = None
+    return latency, peak_mb, out
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "compare the DiNTS TopologyInstance with its pruned static export:"
+            " numerical equivalence, latency and peak memory of the forward pass"
+        )
+    )
+    parser.add_argument(
+        "--arch_code", default="./model/arch_code_cvpr.pth", help="searched arch code"
+    )
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--sizes", nargs="+", default=[96], type=int)
+    parser.add_argument("--batch_size", default=1, type=int, help="batch size")
+    parser.add_argument("--num_iters", default=5, type=int, help="timed iterations")
+    parser.add_argument("--warmup", default=1, type=int, help="untimed iterations")
+    parser.add_argument("--amp", action="store_true", help="run under autocast")
+    parser.add_argument(
+        "--atol", default=1e-5, type=float, help="tolerance of the equivalence check"
+    )
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = build_model(args).to(args.device).eval()
+    static_model = export_static_dints(model).eval()
+    num_cells = len(model.dints_space.cell_tree)
+    print(
+        "static export keeps %d of %d cells, %d of %d down stems, %d of %d up stems"
+        % (
+            len(static_model.cell_tree),
+            num_cells,
+            len(static_model.stem_down),
+            len(model.stem_down),
+            len(static_model.stem_up),
+            len(model.stem_up),
+        )
+    )
+
+    for size in args.sizes:
+        x = torch.rand(args.batch_size, 1, size, size, size, device=args.device)
+        results = {}
+        for name, m in (("instance", model), ("static", static_model)):
+            results[name] = measure(args, m, x)
+            latency, peak_mb, _ = results[name]
+            print(
+                "%d^3 %-8s: %.1f ms/iter, peak memory %s"
+                % (
+                    size,
+                    name,
+                    latency * 1000,
+                    "%.0f MB" % peak_mb if peak_mb is not None else "n/a",
+                )
+            )
+        diff = np.max(
+            [
+                (a.float() - b.float()).abs().max().item() if a.numel() > 0 else 0.0
+                for a, b in zip(results["instance"][2], results["static"][2])
+            ]
+        )
+        status = "ok" if diff <= args.atol else "MISMATCH"
+        print("%d^3 max abs difference: %.2e (%s)" % (size, diff, status))
+
+
+if __name__ == "__main__":
+    main()
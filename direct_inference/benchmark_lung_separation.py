@@ -0,0 +1,316 @@
+"""
+python benchmark_lung_separation.py
+python benchmark_lung_separation.py --timing_shapes 256x256x160 320x320x200 --bridge 24
+
+Checks that find_best_iter_and_masks (one chessboard distance transform) and the NumPy anomly_detection give the
+same lungs as the former implementations (one binary_erosion per iteration, pandas rolling windows), kept below as
+reference_*, on synthetic fused lungs: two ellipsoids bridged by a bar, with pinholes, an unbalanced pair, a thin
+sheet and an empty mask. Then times both lung separations on larger volumes.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+from scipy import ndimage
+
+from utils.utils import (
+    anomly_detection,
+    find_best_iter_and_masks,
+    get_dataframe,
+    lung_overlap_post_process,
+    lung_post_process,
+    plot_anomalies,
+)
+
+
+def reference_find_best_iter_and_masks(lung_mask):
+    # the former implementation: the whole volume is eroded again for every iteration
+    iter = 1
+    struct2 = ndimage.generate_binary_structure(3, 3)
+    erosion_mask = ndimage.binary_erosion(lung_mask, structure=struct2, iterations=iter)
+    candidates_and_masks = lung_overlap_post_process(erosion_mask)
+    while candidates_and_masks[0] == 1:
+        iter += 1
+        erosion_mask = ndimage.binary_erosion(
+            lung_mask, structure=struct2, iterations=iter
+        )
+        candidates_and_masks = lung_overlap_post_process(erosion_mask)
+    left_lung_erosion_mask = candidates_and_masks[1]
+    right_lung_erosion_mask = candidates_and_masks[2]
+    left_lung_erosion_mask_size = np.sum(left_lung_erosion_mask, axis=(0, 1, 2))
+    right_lung_erosion_mask_size = np.sum(right_lung_erosion_mask, axis=(0, 1, 2))
+    while (
+        left_lung_erosion_mask_size / right_lung_erosion_mask_size > 4
+        or right_lung_erosion_mask_size / left_lung_erosion_mask_size > 4
+    ):
+        iter += 1
+        erosion_mask = ndimage.binary_erosion(
+            lung_mask, structure=struct2, iterations=iter
+        )
+        candidates_and_masks = lung_overlap_post_process(erosion_mask)
+        while candidates_and_masks[0] == 1:
+            iter += 1
+            erosion_mask = ndimage.binary_erosion(
+                lung_mask, structure=struct2, iterations=iter
+            )
+            candidates_and_masks = lung_overlap_post_process(erosion_mask)
+        left_lung_erosion_mask = candidates_and_masks[1]
+        right_lung_erosion_mask = candidates_and_masks[2]
+        left_lung_erosion_mask_size = np.sum(left_lung_erosion_mask, axis=(0, 1, 2))
+        right_lung_erosion_mask_size = np.sum(right_lung_erosion_mask, axis=(0, 1, 2))
+    print("erosion done, best iteration: " + str(iter))
+
+    erosion_part_mask = lung_mask - left_lung_erosion_mask - right_lung_erosion_mask
+    left_lung_dist = np.ones(left_lung_erosion_mask.shape)
+    right_lung_dist = np.ones(right_lung_erosion_mask.shape)
+    left_lung_dist[left_lung_erosion_mask == 1] = 0
+    right_lung_dist[right_lung_erosion_mask == 1] = 0
+    left_lung_dist_map = ndimage.distance_transform_edt(left_lung_dist)
+    right_lung_dist_map = ndimage.distance_transform_edt(right_lung_dist)
+    left_lung_dist_map[erosion_part_mask == 0] = 0
+    right_lung_dist_map[erosion_part_mask == 0] = 0
+    left_lung_adding_map = left_lung_dist_map < right_lung_dist_map
+    right_lung_adding_map = right_lung_dist_map < left_lung_dist_map
+
+    left_lung_erosion_mask[left_lung_adding_map == 1] = 1
+    right_lung_erosion_mask[right_lung_adding_map == 1] = 1
+    return ndimage.binary_fill_holes(left_lung_erosion_mask), ndimage.binary_fill_holes(
+        right_lung_erosion_mask
+    )
+
+
+def reference_anomly_detection(pred_mask, post_pred_mask, save_path, batch, anomly_num):
+    # the former implementation, pandas rolling windows over the slice sums
+    total_anomly_slice_number = anomly_num
+    df = get_dataframe(post_pred_mask)
+    lung_df = df[df["array_sum"] != 0].copy()
+    lung_df["SMA20"] = (
+        lung_df["array_sum"].rolling(20, min_periods=1, center=True).mean()
+    )
+    lung_df["STD20"] = (
+        lung_df["array_sum"].rolling(20, min_periods=1, center=True).std()
+    )
+    lung_df["SMA7"] = lung_df["array_sum"].rolling(7, min_periods=1, center=True).mean()
+    lung_df["upper_bound"] = lung_df["SMA20"] + 2 * lung_df["STD20"]
+    lung_df["Predictions"] = lung_df["array_sum"] > lung_df["upper_bound"]
+    lung_df["Predictions"] = lung_df["Predictions"].astype(int)
+    lung_df.dropna(inplace=True)
+    anomly_df = lung_df[lung_df["Predictions"] == 1]
+    anomly_slice = anomly_df["slice_index"].to_numpy()
+    anomly_value = anomly_df["array_sum"].to_numpy()
+    anomly_SMA7 = anomly_df["SMA7"].to_numpy()
+
+    if len(anomly_df) != 0:
+        real_anomly_slice = []
+        for i in range(len(anomly_df)):
+            if anomly_value[i] > anomly_SMA7[i] + 200:
+                real_anomly_slice.append(anomly_slice[i])
+                total_anomly_slice_number += 1
+        if len(real_anomly_slice) != 0:
+            plot_anomalies(lung_df, save_dir=save_path)
+            for s in real_anomly_slice:
+                pred_mask[batch, 15, :, :, s] = 0
+                pred_mask[batch, 16, :, :, s] = 0
+            left_lung_mask, right_lung_mask = lung_post_process(pred_mask[batch])
+            return left_lung_mask, right_lung_mask, total_anomly_slice_number
+    left_lung_mask, right_lung_mask = reference_find_best_iter_and_masks(post_pred_mask)
+    return left_lung_mask, right_lung_mask, total_anomly_slice_number
+
+
+def fused_lungs(
+    shape,
+    bridge,
+    rng,
+    radii=((0.22, 0.3, 0.4), (0.2, 0.28, 0.38)),
+    pinholes=0.002,
+):
+    """
+    float64 mask of two ellipsoids (radii as fractions of the shape) joined by a bar of half width bridge voxels,
+    a fraction pinholes of the voxels removed at random
+    """
+    x, y, z = np.ogrid[: shape[0], : shape[1], : shape[2]]
+    X, Y, Z = x / shape[0], y / shape[1], z / shape[2]
+    mask = np.zeros(shape, bool)
+    for cx, r in zip((0.27, 0.73), radii):
+        mask |= ((X - cx) / r[0]) ** 2 + ((Y - 0.5) / r[1]) ** 2 + (
+            (Z - 0.5) / r[2]
+        ) ** 2 <= 1
+    mask |= (
+        (np.abs(Y - 0.5) * shape[1] <= bridge)
+        & (np.abs(Z - 0.5) * shape[2] <= bridge)
+        & (np.abs(X - 0.5) < 0.3)
+    )
+    if pinholes > 0:
+        mask &= rng.random(shape) > pinholes
+    return mask.astype(np.float64)
+
+
+def run_quietly(fn, *args):
+    """
+    :return: outputs of fn (the name of the exception it raised), seconds
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.time()
+        try:
+            out = fn(*args)
+        except (IndexError, ZeroDivisionError) as e:
+            out = type(e).__name__
+        return out, time.time() - start
+
+
+def same_outputs(a, b):
+    if isinstance(a, str) or isinstance(b, str):
+        return a == b
+    return len(a) == len(b) and all(
+        np.array_equal(np.asarray(x), np.asarray(y)) for x, y in zip(a, b)
+    )
+
+
+def parse_shape(text):
+    return tuple(int(s) for s in text.split("x"))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "equivalence and speed of the lung separation against the former erosion"
+            " loop on synthetic fused lungs"
+        )
+    )
+    parser.add_argument(
+        "--shapes",
+        nargs="+",
+        default=[(96, 80, 64), (128, 96, 80)],
+        type=parse_shape,
+        help="shapes of the equivalence cases",
+    )
+    parser.add_argument(
+        "--bridges",
+        nargs="+",
+        default=[1, 3, 6, 10],
+        type=int,
+        help="half widths (voxels) of the bar fusing the lungs",
+    )
+    parser.add_argument(
+        "--anomaly_trials", default=30, type=int, help="random anomly_detection cases"
+    )
+    parser.add_argument(
+        "--timing_shapes",
+        nargs="*",
+        default=[(256, 256, 160)],
+        type=parse_shape,
+        help="shapes of the timed cases",
+    )
+    parser.add_argument(
+        "--bridge", default=24, type=int, help="bar half width of the timed cases"
+    )
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    cases = []
+    for shape in args.shapes:
+        for bridge in args.bridges:
+            cases.append(
+                ("%s bridge %d" % (shape, bridge), fused_lungs(shape, bridge, rng))
+            )
+    shape = args.shapes[0]
+    cases.append(
+        (
+            "%s unbalanced" % (shape,),
+            fused_lungs(shape, 4, rng, radii=((0.22, 0.3, 0.4), (0.1, 0.15, 0.2))),
+        )
+    )
+    sheet = np.zeros((40, 40, 40))
+    sheet[5:35, 5:35, 20] = 1
+    cases.append(("thin sheet", sheet))
+    cases.append(("empty mask", np.zeros((40, 40, 40))))
+
+    mismatches = 0
+    print(">> find_best_iter_and_masks")
+    for name, mask in cases:
+        reference, reference_seconds = run_quietly(
+            reference_find_best_iter_and_masks, mask.copy()
+        )
+        out, seconds = run_quietly(find_best_iter_and_masks, mask.copy())
+        same = same_outputs(reference, out)
+        mismatches += not same
+        print(
+            "%-28s %s, reference %.2f s, distance transform %.2f s%s"
+            % (
+                name,
+                "same" if same else "MISMATCH",
+                reference_seconds,
+                seconds,
+                " (%s)" % out if isinstance(out, str) else "",
+            )
+        )
+
+    print(">> anomly_detection")
+    with tempfile.TemporaryDirectory() as plot_dir:
+        for trial in range(args.anomaly_trials):
+            shape = (64, 48, int(rng.integers(1, 120)))
+            mask = fused_lungs(shape, int(rng.integers(1, 6)), rng, pinholes=0)
+            # spikes of the slice sums
+            for s in rng.integers(0, shape[2], int(rng.integers(0, 4))):
+                mask[:, :, s] = rng.random(shape[:2]) < rng.random()
+            if trial % 5 == 0:
+                # constant slice sums
+                mask[:] = 0
+                mask[10:20, 10:20, :] = 1
+            pred_mask = np.zeros((1, 32) + shape)
+            pred_mask[0, 15] = mask
+            reference_pred, pred = pred_mask.copy(), pred_mask.copy()
+            reference, _ = run_quietly(
+                reference_anomly_detection,
+                reference_pred,
+                mask.copy(),
+                os.path.join(plot_dir, "reference.png"),
+                0,
+                0,
+            )
+            out, _ = run_quietly(
+                anomly_detection,
+                pred,
+                mask.copy(),
+                os.path.join(plot_dir, "anomaly.png"),
+                0,
+                0,
+            )
+            if not same_outputs(reference, out) or not np.array_equal(
+                reference_pred, pred
+            ):
+                mismatches += 1
+                print("trial %d %s: MISMATCH" % (trial, shape))
+    print("%d trials done" % args.anomaly_trials)
+
+    for shape in args.timing_shapes:
+        mask = fused_lungs(shape, args.bridge, rng, pinholes=0)
+        reference, reference_seconds = run_quietly(
+            reference_find_best_iter_and_masks, mask.copy()
+        )
+        out, seconds = run_quietly(find_best_iter_and_masks, mask.copy())
+        same = same_outputs(reference, out)
+        mismatches += not same
+        print(
+            "%s bridge %d: reference %.1f s, distance transform %.1f s (%.1fx), %s"
+            % (
+                shape,
+                args.bridge,
+                reference_seconds,
+                seconds,
+                reference_seconds / seconds,
+                "same" if same else "MISMATCH",
+            )
+        )
+
+    print(">> %d mismatches" % mismatches)
+
+
+if __name__ == "__main__":
+    main()
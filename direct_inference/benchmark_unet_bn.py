@@ -0,0 +1,152 @@
+import argparse
+import time
+
+import nibabel as nib
+import numpy as np
+import torch
+import torch.nn.functional as F
+from model.Unet import calibrate_running_stats, fuse_for_inference, set_frozen_stats
+from model.Universal_model import Universal_model
+
+from utils.utils import NUM_CLASS
+
+
+def load_model(args):
+    model = Universal_model(
+        img_size=(args.roi_x, args.roi_y, args.roi_z),
+        in_channels=1,
+        out_channels=NUM_CLASS,
+        backbone="unet",
+        encoding="word_embedding",
+    )
+    if args.checkpoint is not None:
+        # same key mapping as inference.py
+        store_dict = model.state_dict()
+        store_dict_keys = [key for key, value in store_dict.items()]
+        load_dict = torch.load(args.checkpoint, map_location="cpu")["net"]
+        load_dict_value = [value for key, value in load_dict.items()]
+        for i in range(len(store_dict)):
+            store_dict[store_dict_keys[i]] = load_dict_value[i]
+        model.load_state_dict(store_dict)
+    return model.to(args.device).eval()
+
+
+def sample_patches(args, num_patches, rng):
+    """
+    random (1, 1, roi_x, roi_y, roi_z) crops of args.image, intensities scaled like ScaleIntensityRanged. The image
+    is not resampled to the training spacing. Without --image the patches are random noise
+    """
+    roi = (args.roi_x, args.roi_y, args.roi_z)
+    if args.image is None:
+        return [
+            torch.from_numpy(rng.rand(1, 1, *roi).astype(np.float32)).to(args.device)
+            for _ in range(num_patches)
+        ]
+    image = np.asarray(nib.load(args.image).dataobj, dtype=np.float32)
+    image = np.clip((image - args.a_min) / (args.a_max - args.a_min), 0, 1)
+    image = np.pad(
+        image, [(0, max(0, r - s)) for r, s in zip(roi, image.shape)], mode="constant"
+    )
+    patches = []
+    for _ in range(num_patches):
+        start = [rng.randint(0, s - r + 1) for r, s in zip(roi, image.shape)]
+        patch = image[tuple(slice(st, st + r) for st, r in zip(start, roi))]
+        patches.append(torch.from_numpy(patch[None, None].copy()).to(args.device))
+    return patches
+
+
+@torch.no_grad()
+def predict(args, model, patches):
+    preds = []
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.time()
+    with torch.autocast(device_type=args.device.split(":")[0], enabled=args.amp):
+        for x in patches:
+            preds.append(F.sigmoid(model(x)).float())
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return preds, (time.time() - start) / len(patches)
+
+
+def dice(a, b):
+    intersection = (a & b).sum().item()
+    total = a.sum().item() + b.sum().item()
+    return 1.0 if total == 0 else 2.0 * intersection / total
+
+
+def compare(name, preds, reference, latency):
+    max_diff = max([(p - r).abs().max().item() for p, r in zip(preds, reference)])
+    dices = [dice(p > 0.5, r > 0.5) for p, r in zip(preds, reference)]
+    print(
+        "%-10s %8.1f ms/patch  max abs diff %.2e  mean dice vs batch %.4f"
+        % (name, latency * 1000, max_diff, np.mean(dices))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "accuracy and latency of the unet backbone with batch statistics (as"
+            " trained), running statistics and folded conv + batch norm"
+        )
+    )
+    parser.add_argument("--checkpoint", default=None, help="trained checkpoint")
+    parser.add_argument("--image", default=None, help="ct (nii.gz) to sample from")
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--roi_x", default=96, type=int, help="roi size in x direction")
+    parser.add_argument("--roi_y", default=96, type=int, help="roi size in y direction")
+    parser.add_argument("--roi_z", default=96, type=int, help="roi size in z direction")
+    parser.add_argument(
+        "--a_min", default=-175, type=float, help="a_min in ScaleIntensityRanged"
+    )
+    parser.add_argument(
+        "--a_max", default=250, type=float, help="a_max in ScaleIntensityRanged"
+    )
+    parser.add_argument("--num_patches", default=8, type=int, help="test patches")
+    parser.add_argument(
+        "--calibration_patches",
+        default=0,
+        type=int,
+        help="refresh the running statistics on this many patches first",
+    )
+    parser.add_argument("--amp", action="store_true", help="run under autocast")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument(
+        "--save_fused", default=None, help="save the fused model (torch.save)"
+    )
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    model = load_model(args)
+    patches = sample_patches(args, args.num_patches, rng)
+
+    # batch statistics mode updates the running statistics, keep a copy to restore them
+    running_stats = {k: v.clone() for k, v in model.state_dict().items()}
+    reference, latency = predict(args, model, patches)
+    compare("batch", reference, reference, latency)
+    model.load_state_dict(running_stats)
+
+    if args.calibration_patches > 0:
+        calibrate_running_stats(
+            model, sample_patches(args, args.calibration_patches, rng)
+        )
+        print("calibrated running statistics on %d patches" % args.calibration_patches)
+
+    set_frozen_stats(model)
+    preds, latency = predict(args, model, patches)
+    compare("frozen", preds, reference, latency)
+
+    fused = fuse_for_inference(model)
+    preds, latency = predict(args, fused, patches)
+    compare("fused", preds, reference, latency)
+
+    if args.save_fused is not None:
+        torch.save(fused, args.save_fused)
+        print("fused model saved in path: %s" % args.save_fused)
+
+
+if __name__ == "__main__":
+    main()
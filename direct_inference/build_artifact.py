@@ -0,0 +1,189 @@
+import argparse
+import time
+
+import torch
+
+from utils.inference_artifact import (
+    build_model,
+    get_model_config,
+    load_checkpoint_by_name,
+    load_inference_artifact,
+    save_inference_artifact,
+)
+from utils.utils import NUM_CLASS, ORGAN_NAME_LOW, TEMPLATE
+
+
+def legacy_load(args, config):
+    # what inference.py does at every start: build the model and remap the checkpoint positionally
+    model = build_model(config)
+    store_dict = model.state_dict()
+    store_dict_keys = [key for key, value in store_dict.items()]
+    load_dict = torch.load(args.checkpoint, map_location="cpu")["net"]
+    load_dict_value = [value for key, value in load_dict.items()]
+    for i in range(len(store_dict)):
+        store_dict[store_dict_keys[i]] = load_dict_value[i]
+    model.load_state_dict(store_dict)
+    return model.eval()
+
+
+def throughput(model, shape, num_patches):
+    x = torch.rand(shape)
+    with torch.no_grad():
+        model(x)
+        start = time.time()
+        for _ in range(num_patches):
+            model(x)
+    return num_patches / (time.time() - start)
+
+
+def benchmark(args, config, metadata):
+    torch.set_num_threads(args.num_threads)
+    shape = metadata["input_shape"]
+    results = []
+    if args.checkpoint is not None and not args.customize:
+        start = time.time()
+        model = legacy_load(args, config)
+        results.append(("eager + positional remap", time.time() - start, model))
+    start = time.time()
+    model, _ = load_inference_artifact(args.output, device="cpu")
+    results.append(("artifact (%s)" % metadata["mode"], time.time() - start, model))
+    for name, startup, model in results:
+        print(
+            "%-26s startup %6.2f s, %.3f patches/s"
+            % (name, startup, throughput(model, shape, args.benchmark))
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "load a checkpoint once, validate the weights by name and save a ready to"
+            " run inference artifact for inference.py --artifact"
+        )
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        help="The path of trained checkpoint (random weights if not given)",
+    )
+    parser.add_argument("--output", required=True, help="artifact file")
+    parser.add_argument(
+        "--mode",
+        default="eager",
+        choices=["eager", "trace"],
+        help="eager: validated state dict + model config, trace: TorchScript module",
+    )
+    parser.add_argument(
+        "--device", default="cpu", help="device to trace on (trace mode only)"
+    )
+    parser.add_argument(
+        "--batch_size", default=1, type=int, help="batch size the trace is built for"
+    )
+    parser.add_argument(
+        "--allow_missing",
+        action="store_true",
+        default=False,
+        help="do not fail if model weights are missing in the checkpoint",
+    )
+    parser.add_argument(
+        "--backbone", default="unet", help="backbone [swinunetr or unet]"
+    )
+    parser.add_argument("--customize", action="store_true", default=False)
+    parser.add_argument("--num_class", default=25, type=int, help="class number")
+    parser.add_argument(
+        "--attn_backend",
+        default="math",
+        help=(
+            "attention backend of swinunetr: math or sdpa (fused, requires torch>=2.0)"
+        ),
+    )
+    parser.add_argument(
+        "--unet_bn_mode",
+        default="batch",
+        choices=["batch", "frozen", "fused"],
+        help="normalization of the unet backbone, see inference.py",
+    )
+    parser.add_argument(
+        "--static_dints",
+        action="store_true",
+        default=False,
+        help="store the dints backbone as a pruned static graph, see inference.py",
+    )
+    parser.add_argument(
+        "--a_min", default=-175, type=float, help="a_min in ScaleIntensityRanged"
+    )
+    parser.add_argument(
+        "--a_max", default=250, type=float, help="a_max in ScaleIntensityRanged"
+    )
+    parser.add_argument(
+        "--b_min", default=0.0, type=float, help="b_min in ScaleIntensityRanged"
+    )
+    parser.add_argument(
+        "--b_max", default=1.0, type=float, help="b_max in ScaleIntensityRanged"
+    )
+    parser.add_argument(
+        "--space_x", default=1.5, type=float, help="spacing in x direction"
+    )
+    parser.add_argument(
+        "--space_y", default=1.5, type=float, help="spacing in y direction"
+    )
+    parser.add_argument(
+        "--space_z", default=1.5, type=float, help="spacing in z direction"
+    )
+    parser.add_argument("--roi_x", default=96, type=int, help="roi size in x direction")
+    parser.add_argument("--roi_y", default=96, type=int, help="roi size in y direction")
+    parser.add_argument("--roi_z", default=96, type=int, help="roi size in z direction")
+    parser.add_argument(
+        "--benchmark",
+        default=0,
+        type=int,
+        help=(
+            "afterwards, compare startup time and throughput on the cpu over this"
+            " many patches"
+        ),
+    )
+    parser.add_argument(
+        "--num_threads", default=4, type=int, help="cpu threads for the benchmark"
+    )
+    args = parser.parse_args()
+
+    num_class = args.num_class if args.customize else NUM_CLASS
+    config = get_model_config(args, num_class)
+    model = build_model(config)
+    if args.checkpoint is not None:
+        load_checkpoint_by_name(model, args.checkpoint, args.allow_missing)
+    else:
+        print("WARNING: no checkpoint given, the artifact holds random weights")
+
+    metadata = {
+        "checkpoint": args.checkpoint,
+        "roi": [args.roi_x, args.roi_y, args.roi_z],
+        "spacing": [args.space_x, args.space_y, args.space_z],
+        "intensity_window": {
+            "a_min": args.a_min,
+            "a_max": args.a_max,
+            "b_min": args.b_min,
+            "b_max": args.b_max,
+        },
+        "num_class": num_class,
+        "class_names": ORGAN_NAME_LOW[:num_class],
+        "target_classes": TEMPLATE["target"],
+    }
+    start = time.time()
+    metadata = save_inference_artifact(
+        model,
+        config,
+        metadata,
+        args.output,
+        mode=args.mode,
+        device=args.device,
+        batch_size=args.batch_size,
+    )
+    print("artifact saved in path: %s (%.1f s)" % (args.output, time.time() - start))
+
+    if args.benchmark > 0:
+        benchmark(args, config, metadata)
+
+
+if __name__ == "__main__":
+    main()
@@ -66,6 +66,7 @@ from monai.utils import GridSamplePadMode, ensure_tuple, ensure_tuple_rep
 from monai.utils.enums import PostFix, TransformBackends
 from torch.utils.data import Subset
 
+from utils.run_report import TimedCompose
 from utils.utils import get_key
 
 DEFAULT_POST_FIX = PostFix.meta()
@@ -467,7 +468,7 @@ def get_loader(args):
         ]
     )
     if args.original_label:
-        val_transforms = Compose(
+        val_transforms = TimedCompose(
             [
                 LoadImaged(keys=["image", "label"]),
                 AddChanneld(keys=["image", "label"]),
@@ -492,7 +493,7 @@ def get_loader(args):
             ]
         )
     else:
-        val_transforms = Compose(
+        val_transforms = TimedCompose(
             [
                 LoadImaged(keys=["image"]),
                 AddChanneld(keys=["image"]),
@@ -8,12 +8,25 @@ import torch
 import torch.distributed as distributed
 import torch.nn.functional as F
 from dataset.dataloader_test import get_loader, taskmap_set
+from model.DiNTS import export_static_dints
 from model.SwinUNETR_target import SwinUNETR
+from model.Unet import fuse_for_inference, set_frozen_stats
 from model.Universal_model import Universal_model
 from monai.data import DistributedSampler
 from monai.inferers import sliding_window_inference
 from tqdm import tqdm
 
+from utils.adaptive_overlap import adaptive_sliding_window_inference, format_stats
+from utils.cpu_inference import (
+    QUANTIZATION_MODES,
+    configure_cpu_threads,
+    get_inference_device,
+    optimize_for_cpu,
+)
+from utils.inference_artifact import apply_artifact_metadata, load_inference_artifact
+from utils.result_cache import CACHE_FORMATS, LazyModel, ResultCache, get_model_key
+from utils.roi_inference import coarse_to_fine_inference, format_timings
+from utils.run_report import RunReport, traced_batches
 from utils.utils import (
     NUM_CLASS,
     ORGAN_NAME_LOW,
@@ -28,7 +41,81 @@ from utils.utils import (
 torch.multiprocessing.set_sharing_strategy("file_system")
 
 
-def validation(model, ValLoader, val_transforms, args):
+def get_coarse_classes(args):
+    """
+    output channels localized by the coarse pass of --coarse_to_fine
+    """
+    if args.suprem:
+        names = ["pancreas"] if args.coarse_classes is None else args.coarse_classes
+        return [ORGAN_NAME_LOW.index(name) for name in names]
+    if args.coarse_classes is None:
+        return list(range(1, args.num_class))
+    class_index = dict([(v, k) for k, v in taskmap_set[args.map_type].items()])
+    return [class_index[name] for name in args.coarse_classes]
+
+
+def run_sliding_window(
+    image, model, args, activation="sigmoid", sw_device=None, device=None, trace=None
+):
+    if trace is not None:
+        model = trace.count_patches(model)
+    if args.adaptive_overlap:
+        logits, stats = adaptive_sliding_window_inference(
+            image,
+            model,
+            (args.roi_x, args.roi_y, args.roi_z),
+            activation=activation,
+            base_overlap=args.base_overlap,
+            overlap=args.overlap,
+            entropy_threshold=args.entropy_threshold,
+            disagreement_threshold=args.disagreement_threshold,
+            sw_device=sw_device,
+            device=device,
+        )
+        print(format_stats(stats))
+        return logits
+    if not args.coarse_to_fine:
+        return sliding_window_inference(
+            image,
+            (args.roi_x, args.roi_y, args.roi_z),
+            1,
+            model,
+            overlap=args.overlap,
+            mode="gaussian",
+            sw_device=sw_device,
+            device=device,
+        )
+    logits, timings = coarse_to_fine_inference(
+        image,
+        model,
+        (args.roi_x, args.roi_y, args.roi_z),
+        get_coarse_classes(args),
+        activation=activation,
+        coarse_scale=args.coarse_scale,
+        coarse_overlap=args.coarse_overlap,
+        overlap=args.overlap,
+        margin=args.roi_margin,
+        sw_device=sw_device,
+        device=device,
+    )
+    print(format_timings(timings))
+    return logits
+
+
+def predict_logits(image, model, args, trace=None):
+    with torch.autocast(
+        device_type=args.device.type,
+        dtype=torch.float16,
+        enabled=args.device.type == "cuda",
+    ):
+        return run_sliding_window(image, model, args, activation="sigmoid", trace=trace)
+
+
+def validation(
+    model, ValLoader, val_transforms, args, result_cache=None, run_report=None
+):
+    if run_report is None:
+        run_report = RunReport()
     save_dir = args.save_dir
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
@@ -39,8 +126,12 @@ def validation(model, ValLoader, val_transforms, args):
             dice_list[key] = np.zeros(
                 (2, NUM_CLASS)
             )  # 1st row for dice, 2nd row for count
-        for index, batch in enumerate(tqdm(ValLoader)):
-            image, name_img = batch["image"].cuda(), batch["name_img"]
+        for batch, trace in tqdm(
+            traced_batches(ValLoader, val_transforms, args.device),
+            total=len(ValLoader),
+        ):
+            image, name_img = batch["image"].to(args.device), batch["name_img"]
+            trace.case = name_img[0]
             image_file_path = os.path.join(
                 args.data_root_path, name_img[0], f"{args.target_file}.nii.gz"
             )
@@ -48,6 +139,7 @@ def validation(model, ValLoader, val_transforms, args):
             print(case_save_path)
             if os.path.exists(os.path.join(case_save_path, "combined_labels.nii.gz")):
                 print(f"Results already exists, skipping")
+                run_report.write(trace.finish("skipped"))
                 continue
             if not os.path.isdir(case_save_path):
                 os.makedirs(case_save_path)
@@ -62,76 +154,95 @@ def validation(model, ValLoader, val_transforms, args):
                     case_save_path, f"{args.target_file}.nii.gz"
                 )
                 if not os.path.isfile(destination_ct):
-                    shutil.copy(image_file_path, destination_ct)
+                    with trace.span("copy_ct"):
+                        shutil.copy(image_file_path, destination_ct)
+                    trace.add_output(destination_ct)
                     print("CT scans copied successfully.")
-            affine_temp = nib.load(image_file_path).affine
+            image_nifti = nib.load(image_file_path)
+            affine_temp = image_nifti.affine
+            set_shape_values(trace, image_nifti, image)
             with torch.no_grad():
-                with torch.autocast(device_type="cuda", dtype=torch.float16):
-                    try:
-                        pred = sliding_window_inference(
-                            image,
-                            (args.roi_x, args.roi_y, args.roi_z),
-                            1,
-                            model,
-                            overlap=args.overlap,
-                            mode="gaussian",
-                        )
-                    except RuntimeError as e:
-                        print(f"Failed inference for {name_img[0]}, skipping")
-                        print(e)
-                        os.rmdir(case_save_path)
-                        continue
-                pred_sigmoid = F.sigmoid(pred)
-            pred_hard = threshold_organ(pred_sigmoid, args)
-            pred_hard = pred_hard.cpu()
+                try:
+                    with trace.span("sliding_window"):
+                        if result_cache is not None:
+                            pred_sigmoid = result_cache.predict(
+                                image,
+                                lambda x: predict_logits(x, model, args, trace),
+                                activation="sigmoid",
+                                device=args.device,
+                            )
+                        else:
+                            pred = predict_logits(image, model, args, trace)
+                            pred_sigmoid = F.sigmoid(pred)
+                except RuntimeError as e:
+                    print(f"Failed inference for {name_img[0]}, skipping")
+                    print(e)
+                    os.rmdir(case_save_path)
+                    run_report.write(trace.finish("failed"))
+                    continue
+            with trace.span("threshold"):
+                pred_hard = threshold_organ(pred_sigmoid, args)
+                pred_hard = pred_hard.cpu()
             torch.cuda.empty_cache()
 
             B = pred_hard.shape[0]
-            for b in range(B):
-                organ_list_all = TEMPLATE["target"]  # post processing target organ
-                pred_hard_post, _ = organ_post_process(
-                    pred_hard.numpy(), organ_list_all, case_save_path, args
-                )
-                pred_hard_post = torch.tensor(pred_hard_post)
+            with trace.span("organ_post_process"):
+                for b in range(B):
+                    organ_list_all = TEMPLATE["target"]  # post processing target organ
+                    pred_hard_post, _ = organ_post_process(
+                        pred_hard.numpy(), organ_list_all, case_save_path, args
+                    )
+                    pred_hard_post = torch.tensor(pred_hard_post)
 
             if args.store_result:
                 if not os.path.isdir(organ_seg_save_path):
                     os.makedirs(organ_seg_save_path)
                 organ_index_all = TEMPLATE["target"]
                 for organ_index in organ_index_all:
-                    pseudo_label_single = pseudo_label_single_organ(
-                        pred_hard_post, organ_index, args
-                    )
-                    organ_name = ORGAN_NAME_LOW[organ_index - 1]
-                    batch[organ_name] = pseudo_label_single.cpu()
-                    BATCH = invert_transform(organ_name, batch, val_transforms)
-                    organ_invertd = np.squeeze(BATCH[0][organ_name].numpy(), axis=0)
+                    with trace.span("invert"):
+                        pseudo_label_single = pseudo_label_single_organ(
+                            pred_hard_post, organ_index, args
+                        )
+                        organ_name = ORGAN_NAME_LOW[organ_index - 1]
+                        batch[organ_name] = pseudo_label_single.cpu()
+                        BATCH = invert_transform(organ_name, batch, val_transforms)
+                        organ_invertd = np.squeeze(BATCH[0][organ_name].numpy(), axis=0)
                     # save organ labels as the np.int8 type
                     organ_inverted_type = organ_invertd.astype(np.uint8)
                     organ_save = nib.Nifti1Image(organ_inverted_type, affine_temp)
                     new_name = os.path.join(organ_seg_save_path, organ_name + ".nii.gz")
                     print("organ seg saved in path: %s" % (new_name))
-                    nib.save(organ_save, new_name)
+                    with trace.span("write"):
+                        nib.save(organ_save, new_name)
+                    trace.add_output(new_name)
 
-                pseudo_label_all = pseudo_label_all_organ(pred_hard_post, args)
-                batch["pseudo_label"] = pseudo_label_all.cpu()
-                BATCH = invert_transform("pseudo_label", batch, val_transforms)
-                pseudo_label_invertd = np.squeeze(
-                    BATCH[0]["pseudo_label"].numpy(), axis=0
-                )
+                with trace.span("invert"):
+                    pseudo_label_all = pseudo_label_all_organ(pred_hard_post, args)
+                    batch["pseudo_label"] = pseudo_label_all.cpu()
+                    BATCH = invert_transform("pseudo_label", batch, val_transforms)
+                    pseudo_label_invertd = np.squeeze(
+                        BATCH[0]["pseudo_label"].numpy(), axis=0
+                    )
                 pseudo_label_inverted_type = pseudo_label_invertd.astype(np.uint8)
                 pseudo_label_save = nib.Nifti1Image(
                     pseudo_label_inverted_type, affine_temp
                 )
                 new_name = os.path.join(case_save_path, "combined_labels.nii.gz")
-                nib.save(pseudo_label_save, new_name)
+                with trace.span("write"):
+                    nib.save(pseudo_label_save, new_name)
+                trace.add_output(new_name)
                 print("pseudo label saved in path: %s" % (new_name))
+            run_report.write(trace.finish())
 
     if args.customize:
         selected_class_map = taskmap_set[args.map_type]
         count = 0
-        for index, batch in enumerate(tqdm(ValLoader)):
+        for batch, trace in tqdm(
+            traced_batches(ValLoader, val_transforms, args.device),
+            total=len(ValLoader),
+        ):
             image, name = batch["image"].to(args.device), batch["name_img"]
+            trace.case = name[0]
             image_file_path = os.path.join(
                 args.data_root_path, name[0], f"{args.target_file}.nii.gz"
             )
@@ -150,39 +261,52 @@ def validation(model, ValLoader, val_transforms, args):
                     case_save_path, f"{args.target_file}.nii.gz"
                 )
                 if not os.path.isfile(destination_ct):
-                    shutil.copy(image_file_path, destination_ct)
+                    with trace.span("copy_ct"):
+                        shutil.copy(image_file_path, destination_ct)
+                    trace.add_output(destination_ct)
                     print("CT scans copied successfully.")
             name = (
                 name.item() if isinstance(name, torch.Tensor) else name
             )  # Convert to Python str if it's a Tensor
-            original_affine = nib.load(image_file_path).affine
+            image_nifti = nib.load(image_file_path)
+            original_affine = image_nifti.affine
+            set_shape_values(trace, image_nifti, image)
             with torch.no_grad():
                 # print("Image: {}, shape: {}".format(name[0], image.shape))
-                val_outputs = sliding_window_inference(
-                    image,
-                    (args.roi_x, args.roi_y, args.roi_z),
-                    1,
+                predictor = lambda x: run_sliding_window(
+                    x,
                     model,
-                    overlap=args.overlap,
-                    mode="gaussian",
-                    sw_device="cuda",
+                    args,
+                    activation="softmax",
+                    sw_device=args.device,
                     device="cpu",
+                    trace=trace,
                 )
-                val_outputs = F.softmax(val_outputs, dim=1)
+                with trace.span("sliding_window"):
+                    if result_cache is not None:
+                        val_outputs = result_cache.predict(
+                            image, predictor, activation="softmax", device="cpu"
+                        )
+                    else:
+                        val_outputs = F.softmax(predictor(image), dim=1)
                 # print(val_outputs.shape)
-                hard_val_outputs = torch.argmax(val_outputs, dim=1).unsqueeze(1)
+                with trace.span("argmax"):
+                    hard_val_outputs = torch.argmax(val_outputs, dim=1).unsqueeze(1)
                 # print(hard_val_outputs.shape)
                 # print(np.unique(hard_val_outputs))
 
-            batch["pred"] = hard_val_outputs
-            batch = invert_transform("pred", batch, val_transforms)
-            pred = batch[0]["pred"].cpu().numpy()[0]
+            with trace.span("invert"):
+                batch["pred"] = hard_val_outputs
+                batch = invert_transform("pred", batch, val_transforms)
+                pred = batch[0]["pred"].cpu().numpy()[0]
             # print(pred.shape)
             file_path_pattern = os.path.join(case_save_path, "combined_labels.nii.gz")
-            nib.save(
-                nib.Nifti1Image(pred.astype(np.uint8), original_affine),
-                file_path_pattern,
-            )
+            with trace.span("write"):
+                nib.save(
+                    nib.Nifti1Image(pred.astype(np.uint8), original_affine),
+                    file_path_pattern,
+                )
+            trace.add_output(file_path_pattern)
             if not os.path.isdir(organ_seg_save_path):
                 os.makedirs(organ_seg_save_path)
             for k in range(1, args.num_class):
@@ -191,15 +315,96 @@ def validation(model, ValLoader, val_transforms, args):
                 file_path_pattern = os.path.join(
                     organ_seg_save_path, f"{class_name}.nii.gz"
                 )
-                nib.save(
-                    nib.Nifti1Image(pred_class.astype(np.uint8), original_affine),
-                    file_path_pattern,
-                )
+                with trace.span("write"):
+                    nib.save(
+                        nib.Nifti1Image(pred_class.astype(np.uint8), original_affine),
+                        file_path_pattern,
+                    )
+                trace.add_output(file_path_pattern)
             count += 1
             print("[{}/{}] Saved {}".format(count, len(ValLoader), name[0]))
+            run_report.write(trace.finish())
 
         torch.cuda.empty_cache()
 
+    if result_cache is not None:
+        print(
+            "result cache: %d hits, %d misses"
+            % (result_cache.hits, result_cache.misses)
+        )
+
+
+def set_shape_values(trace, image_nifti, image):
+    # voxels of the ct as stored and after the preprocessing (the sliding window input)
+    trace.set_values(
+        input_shape=list(image_nifti.shape[:3]),
+        input_voxels=int(np.prod(image_nifti.shape[:3])),
+        voxels=int(np.prod(image.shape[2:])),
+    )
+
+
+def load_model(args):
+    """
+    builds the model of --suprem / --customize and loads --checkpoint
+    """
+    if args.suprem:
+        model = Universal_model(
+            img_size=(args.roi_x, args.roi_y, args.roi_z),
+            in_channels=1,
+            out_channels=NUM_CLASS,
+            backbone=args.backbone,
+            encoding="word_embedding",
+            attn_backend=args.attn_backend,
+        )
+        # Load pre-trained weights
+        store_dict = model.state_dict()
+        store_dict_keys = [key for key, value in store_dict.items()]
+        checkpoint = torch.load(args.checkpoint)
+        load_dict = checkpoint["net"]
+        load_dict_value = [value for key, value in load_dict.items()]
+
+        for i in range(len(store_dict)):
+            store_dict[store_dict_keys[i]] = load_dict_value[i]
+
+    if args.customize:
+        model = SwinUNETR(
+            img_size=(args.roi_x, args.roi_y, args.roi_z),
+            in_channels=1,
+            out_channels=args.num_class,
+            feature_size=48,
+            drop_rate=0.0,
+            attn_drop_rate=0.0,
+            dropout_path_rate=0.0,
+            use_checkpoint=False,
+            attn_backend=args.attn_backend,
+        )
+        store_dict = model.state_dict()
+        model_dict = torch.load(args.checkpoint)["net"]
+        store_dict = model.state_dict()
+        amount = 0
+        for key in model_dict.keys():
+            new_key = ".".join(key.split(".")[1:])
+            if new_key in store_dict.keys():
+                store_dict[new_key] = model_dict[key]
+                amount += 1
+        print(amount, len(store_dict.keys()))
+
+    model.load_state_dict(store_dict)
+    print("Use pretrained weights")
+    if args.unet_bn_mode != "batch":
+        set_frozen_stats(model)
+        if args.unet_bn_mode == "fused":
+            model = fuse_for_inference(model, inplace=True)
+    if args.static_dints and args.backbone == "dints":
+        model.backbone = export_static_dints(model.backbone)
+    return model
+
+
+def prepare_model(model, args):
+    model.to(args.device)
+    model.eval()
+    return optimize_for_cpu(model, args)
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -303,15 +508,172 @@ def main():
         "--cpu",
         action="store_true",
         default=False,
-        help="The entire inference process is performed on the GPU ",
+        help="The entire inference process is performed on the CPU",
+    )
+    parser.add_argument(
+        "--cpu_threads",
+        default=None,
+        type=int,
+        help="intra op threads on the CPU (default: torch default)",
+    )
+    parser.add_argument(
+        "--cpu_interop_threads",
+        default=None,
+        type=int,
+        help="inter op threads on the CPU (default: torch default)",
+    )
+    parser.add_argument(
+        "--quantization",
+        default="none",
+        choices=QUANTIZATION_MODES,
+        help=(
+            "CPU only. int8: dynamic int8 Linear layers, bf16: bfloat16 autocast for"
+            " Conv3d and Linear"
+        ),
+    )
+    parser.add_argument(
+        "--channels_last",
+        action="store_true",
+        default=False,
+        help="CPU only. run the model in channels last (NDHWC) memory format",
     )
     parser.add_argument("--threshold_organ", default="Pancreas Tumor")
     parser.add_argument(
         "--backbone", default="unet", help="backbone [swinunetr or unet]"
     )
+    parser.add_argument(
+        "--attn_backend",
+        default="math",
+        help=(
+            "attention backend of swinunetr: math or sdpa (fused, requires torch>=2.0)"
+        ),
+    )
     parser.add_argument("--create_dataset", action="store_true", default=False)
     parser.add_argument("--suprem", action="store_true", default=False)
     parser.add_argument("--customize", action="store_true", default=False)
+    parser.add_argument(
+        "--artifact",
+        default=None,
+        help=(
+            "inference artifact built by build_artifact.py. Replaces --checkpoint and"
+            " the model/preprocessing arguments"
+        ),
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        default=False,
+        help="torch.compile the artifact (requires torch>=2.0)",
+    )
+    parser.add_argument(
+        "--unet_bn_mode",
+        default="batch",
+        choices=["batch", "frozen", "fused"],
+        help=(
+            "normalization of the unet backbone: statistics of every patch (as"
+            " trained), running statistics, or running statistics folded into the"
+            " convolutions. See benchmark_unet_bn.py to compare them"
+        ),
+    )
+    parser.add_argument(
+        "--static_dints",
+        action="store_true",
+        default=False,
+        help=(
+            "run the dints backbone as a pruned static graph that frees feature maps"
+            " after their last use. See benchmark_dints.py"
+        ),
+    )
+    parser.add_argument(
+        "--coarse_to_fine",
+        action="store_true",
+        default=False,
+        help=(
+            "localize the target organs with a low resolution pass, then run the full"
+            " resolution sliding window only inside their padded bounding box"
+        ),
+    )
+    parser.add_argument(
+        "--coarse_scale",
+        default=0.5,
+        type=float,
+        help="downsampling factor of the coarse pass",
+    )
+    parser.add_argument(
+        "--coarse_overlap", default=0.25, type=float, help="overlap of the coarse pass"
+    )
+    parser.add_argument(
+        "--roi_margin",
+        default=16,
+        type=int,
+        help="voxels added on each side of the coarse bounding box",
+    )
+    parser.add_argument(
+        "--coarse_classes",
+        nargs="+",
+        default=None,
+        help=(
+            "class names localized by the coarse pass (default: pancreas with --suprem,"
+            " all foreground classes with --customize)"
+        ),
+    )
+    parser.add_argument(
+        "--adaptive_overlap",
+        action="store_true",
+        default=False,
+        help=(
+            "run the sliding window with --base_overlap, then add the patches of"
+            " --overlap only where the prediction is uncertain. See"
+            " benchmark_adaptive_overlap.py"
+        ),
+    )
+    parser.add_argument(
+        "--base_overlap",
+        default=0.5,
+        type=float,
+        help="overlap of the first pass of --adaptive_overlap",
+    )
+    parser.add_argument(
+        "--entropy_threshold",
+        default=0.05,
+        type=float,
+        help="voxels above this entropy are refined by --adaptive_overlap",
+    )
+    parser.add_argument(
+        "--disagreement_threshold",
+        default=0.1,
+        type=float,
+        help=(
+            "voxels where overlapping patches disagree by more than this (standard"
+            " deviation of the foreground probability) are refined by"
+            " --adaptive_overlap"
+        ),
+    )
+
+    parser.add_argument(
+        "--result_cache",
+        default=None,
+        help=(
+            "directory caching the network output per case, reruns with other"
+            " thresholds, post processing or output options replay it"
+        ),
+    )
+    parser.add_argument(
+        "--cache_format",
+        default="fp16",
+        choices=CACHE_FORMATS,
+        help="fp16 logits, or uint8 sigmoid probabilities (--suprem only)",
+    )
+
+    parser.add_argument(
+        "--run_report",
+        default=None,
+        help=(
+            "jsonl file the per case timings (loading, transforms, sliding window, post"
+            " processing, inversion, writing), patches, voxels, peak memory and output"
+            " bytes are appended to. See summarize_run_report.py"
+        ),
+    )
 
     ### ======================== ###
     ### ADDED CUSTOM ARGUMENTS ###
@@ -323,61 +685,53 @@ def main():
 
     args = parser.parse_args()
 
+    if args.adaptive_overlap and args.coarse_to_fine:
+        raise ValueError("--adaptive_overlap and --coarse_to_fine are exclusive")
+
     rank = 0
     if args.dist:
-        distributed.init_process_group(backend="nccl")
+        distributed.init_process_group(backend="gloo" if args.cpu else "nccl")
         rank = distributed.get_rank()
-    device = torch.device(f"cuda:{rank}")
-    torch.cuda.set_device(device)
+    args.device = get_inference_device(args, rank)
+    if args.device.type == "cuda":
+        torch.cuda.set_device(args.device)
+    else:
+        print(
+            "Running on the cpu with %d threads"
+            % configure_cpu_threads(args.cpu_threads, args.cpu_interop_threads)
+        )
 
     # prepare the 3D model
-
-    if args.suprem:
-        model = Universal_model(
-            img_size=(args.roi_x, args.roi_y, args.roi_z),
-            in_channels=1,
-            out_channels=NUM_CLASS,
-            backbone=args.backbone,
-            encoding="word_embedding",
+    if args.artifact is not None:
+        model, metadata = load_inference_artifact(
+            args.artifact, device=args.device, compile=args.compile
         )
-        # Load pre-trained weights
-        store_dict = model.state_dict()
-        store_dict_keys = [key for key, value in store_dict.items()]
-        checkpoint = torch.load(args.checkpoint)
-        load_dict = checkpoint["net"]
-        load_dict_value = [value for key, value in load_dict.items()]
-
-        for i in range(len(store_dict)):
-            store_dict[store_dict_keys[i]] = load_dict_value[i]
+        apply_artifact_metadata(args, metadata)
+        print("Use inference artifact %s" % args.artifact)
+        model = prepare_model(model, args)
+    elif args.result_cache is not None:
+        # the checkpoint is only loaded once a case misses the cache
+        model = LazyModel(lambda: prepare_model(load_model(args), args))
+    else:
+        model = prepare_model(load_model(args), args)
+    torch.backends.cudnn.benchmark = True
 
-    if args.customize:
-        model = SwinUNETR(
-            img_size=(args.roi_x, args.roi_y, args.roi_z),
-            in_channels=1,
-            out_channels=args.num_class,
-            feature_size=48,
-            drop_rate=0.0,
-            attn_drop_rate=0.0,
-            dropout_path_rate=0.0,
-            use_checkpoint=False,
+    result_cache = None
+    if args.result_cache is not None:
+        if args.customize and args.cache_format == "uint8":
+            raise ValueError("--customize outputs can only be cached as fp16")
+        result_cache = ResultCache(
+            args.result_cache, get_model_key(args), args.cache_format
         )
-        store_dict = model.state_dict()
-        model_dict = torch.load(args.checkpoint)["net"]
-        store_dict = model.state_dict()
-        amount = 0
-        for key in model_dict.keys():
-            new_key = ".".join(key.split(".")[1:])
-            if new_key in store_dict.keys():
-                store_dict[new_key] = model_dict[key]
-                amount += 1
-        print(amount, len(store_dict.keys()))
-
-    model.load_state_dict(store_dict)
-    print("Use pretrained weights")
-    model.cuda()
-    torch.backends.cudnn.benchmark = True
     test_loader, val_transforms = get_loader(args)
-    validation(model, test_loader, val_transforms, args)
+    validation(
+        model,
+        test_loader,
+        val_transforms,
+        args,
+        result_cache,
+        RunReport(args.run_report, rank),
+    )
 
 
 if __name__ == "__main__":
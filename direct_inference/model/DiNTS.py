@@ -759,6 +759,163 @@ class DiNTS(nn.Module):
         return outputs[-1], _temp
 
 
+class StaticDiNTS(nn.Module):
+    """
+    Inference only DiNTS with the searched topology resolved once, built by ``export_static_dints``.
+
+    Paths that are not activated by ``arch_code_a`` or whose result never reaches the outputs, unused stems and the
+    unselected ``MixedOp`` operations are removed. Every remaining cell is its preprocessing block followed by the
+    selected operation (identities dropped). The forward pass runs a precomputed schedule and releases every feature
+    map right after its last consumer, instead of keeping all nodes of the current and previous block alive.
+    The outputs are the same ``(outputs[-1], decoder output)`` pair as ``DiNTS.forward``.
+
+    Args:
+        stem_down: ``nn.ModuleDict`` of the used downsample stems, keyed by depth.
+        stem_up: ``nn.ModuleDict`` of the used upsample stems, keyed by depth.
+        cell_tree: ``nn.ModuleDict`` of the pruned cells, keyed like ``TopologyConstruction.cell_tree``.
+        stems: ``(depth, node, zero)`` for every used stem, ``zero`` if ``node_a`` disables the input.
+        schedule: ``(cell key, input node, output node, last use of the input)`` in execution order.
+        empty_nodes: used nodes without an active incoming path, they hold a scalar zero like in ``TopologyInstance``.
+        output_node: node returned as first output.
+        decoder: ``(depth, node)`` consumed by the upsample stems, deepest first.
+    """
+
+    def __init__(
+        self,
+        stem_down: nn.ModuleDict,
+        stem_up: nn.ModuleDict,
+        cell_tree: nn.ModuleDict,
+        stems: List[Tuple[int, int, bool]],
+        schedule: List[Tuple[str, int, int, bool]],
+        empty_nodes: List[int],
+        output_node: int,
+        decoder: List[Tuple[int, int]],
+    ):
+        super().__init__()
+        self.stem_down = stem_down
+        self.stem_up = stem_up
+        self.cell_tree = cell_tree
+        self.stems = stems
+        self.schedule = schedule
+        self.empty_nodes = empty_nodes
+        self.output_node = output_node
+        self.decoder = decoder
+
+    def forward(self, x: torch.Tensor):
+        values = {}
+        for d, node, zero in self.stems:
+            x_out = self.stem_down[str(d)](x)
+            values[node] = torch.zeros_like(x_out) if zero else x_out
+        for node in self.empty_nodes:
+            values[node] = x.new_zeros(())
+
+        # nodes holding a sum computed here, they can be accumulated in place
+        owned = set()
+        for name, src, dst, last_use in self.schedule:
+            _out = self.cell_tree[name](values[src])
+            if last_use:
+                del values[src]
+            acc = values.get(dst)
+            if acc is None:
+                values[dst] = _out
+            elif dst in owned and acc.shape == _out.shape and acc.dtype == _out.dtype:
+                acc.add_(_out)
+            else:
+                values[dst] = acc + _out
+                owned.add(dst)
+
+        output = values[self.output_node]
+        _temp = torch.empty(0)
+        for i, (d, node) in enumerate(self.decoder):
+            value = values[node] if node == self.output_node else values.pop(node)
+            _temp = self.stem_up[str(d)](value if i == 0 else value + _temp)
+        return output, _temp
+
+
+def _collapse_cell(cell: Cell) -> nn.Module:
+    """preprocessing block followed by the single selected operation of the ``MixedOp``, identities dropped
+    """
+    ops = [op for op in cell.op.ops if not isinstance(op, _CloseWithRAMCost)]
+    if len(ops) != 1:
+        raise ValueError(
+            "static export needs exactly one operation per cell (one-hot arch_code_c),"
+            " got %d"
+            % len(ops)
+        )
+    mods = [m for m in (cell.preprocess, ops[0]) if not isinstance(m, nn.Identity)]
+    if len(mods) == 0:
+        return nn.Identity()
+    if len(mods) == 1:
+        return mods[0]
+    return nn.Sequential(*mods)
+
+
+def export_static_dints(net: DiNTS) -> StaticDiNTS:
+    """
+    Materializes the topology of a ``DiNTS`` built on a ``TopologyInstance`` as a ``StaticDiNTS`` for inference.
+    The modules (and parameters) are shared with ``net``, so load the trained weights into ``net`` first.
+    A node ``(block, depth)`` is numbered ``block * num_depths + depth``, block 0 being the stem outputs.
+    """
+    space = net.dints_space
+    if not isinstance(space, TopologyInstance):
+        raise ValueError(
+            "only DiNTS models built on a TopologyInstance can be exported"
+        )
+    num_depths, num_blocks = net.num_depths, net.num_blocks
+    arch_code_a = space.arch_code_a.detach().cpu().numpy()
+
+    # depths of the last block read by the upsample stems, deepest first
+    decoder_depths = []
+    for d in range(num_depths - 1, -1, -1):
+        if len(decoder_depths) > 0 or net.node_a[num_blocks][d]:
+            decoder_depths.append(d)
+
+    # walk the blocks backwards and keep only the paths whose result is used
+    needed = {num_depths - 1} | set(decoder_depths)
+    empty_nodes, paths = [], []
+    for blk_idx in range(num_blocks - 1, -1, -1):
+        written, used_inputs = set(), set()
+        for res_idx in range(len(space.arch_code2out)):
+            if arch_code_a[blk_idx, res_idx] and space.arch_code2out[res_idx] in needed:
+                paths.append((blk_idx, res_idx))
+                written.add(space.arch_code2out[res_idx])
+                used_inputs.add(space.arch_code2in[res_idx])
+        empty_nodes.extend([(blk_idx + 1) * num_depths + d for d in needed - written])
+        needed = used_inputs
+    paths.sort()
+
+    stems = [(d, d, not bool(net.node_a[0][d])) for d in sorted(needed)]
+    stem_down = nn.ModuleDict({str(d): net.stem_down[str(d)] for d in sorted(needed)})
+    stem_up = nn.ModuleDict({str(d): net.stem_up[str(d)] for d in decoder_depths})
+
+    cell_tree = nn.ModuleDict()
+    edges = []
+    for blk_idx, res_idx in paths:
+        name = str((blk_idx, res_idx))
+        cell_tree[name] = _collapse_cell(space.cell_tree[name])
+        src = blk_idx * num_depths + space.arch_code2in[res_idx]
+        dst = (blk_idx + 1) * num_depths + space.arch_code2out[res_idx]
+        edges.append((name, src, dst))
+
+    last_use = {}
+    for i, (_, src, _) in enumerate(edges):
+        last_use[src] = i
+    schedule = [
+        (name, src, dst, last_use[src] == i) for i, (name, src, dst) in enumerate(edges)
+    ]
+
+    return StaticDiNTS(
+        stem_down=stem_down,
+        stem_up=stem_up,
+        cell_tree=cell_tree,
+        stems=stems,
+        schedule=schedule,
+        empty_nodes=sorted(empty_nodes),
+        output_node=num_blocks * num_depths + num_depths - 1,
+        decoder=[(d, num_blocks * num_depths + d) for d in decoder_depths],
+    )
+
+
 if __name__ == "__main__":
     ckpt = torch.load("./arch_code_cvpr.pth")
     node_a = ckpt["node_a"]
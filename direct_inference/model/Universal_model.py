@@ -19,6 +19,7 @@ class Universal_model(nn.Module):
         out_channels,
         backbone="swinunetr",
         encoding="rand_embedding",
+        attn_backend="math",
     ):
         # encoding: rand_embedding or word_embedding
         super().__init__()
@@ -33,6 +34,7 @@ class Universal_model(nn.Module):
                 attn_drop_rate=0.0,
                 dropout_path_rate=0.0,
                 use_checkpoint=False,
+                attn_backend=attn_backend,
             )
             self.precls_conv = nn.Sequential(
                 nn.GroupNorm(16, 48),
@@ -0,0 +1,158 @@
+"""
+python summarize_run_report.py run_report.jsonl
+python summarize_run_report.py run_report_*.jsonl --per_megavoxel --percentiles 50 95
+
+Percentiles of the per case records written by inference.py --run_report (total and per stage seconds, patches,
+voxels, peak memory, output size), and the outlier cases: a case is an outlier when the robust z-score (median and
+median absolute deviation over the cases) of its total time is above --threshold. For every outlier the stages that are
+outliers themselves are listed, which tells a slow Spacingd (large or oddly spaced ct) from a slow sliding window or a
+slow disk.
+"""
+
+import argparse
+
+import numpy as np
+
+from utils.run_report import MB, read_report
+
+VALUES = ["patches", "voxels", "input_voxels", "peak_rss_mb", "peak_gpu_mb"]
+
+
+def robust_z(values):
+    values = np.asarray(values, dtype=np.float64)
+    median = np.median(values)
+    mad = np.median(np.abs(values - median)) / 0.6745
+    if mad == 0:
+        # more than half of the cases share the median, fall back to the mean absolute deviation
+        mad = np.mean(np.abs(values - median)) * 1.2533
+    if mad == 0:
+        return np.zeros(len(values))
+    return (values - median) / mad
+
+
+def get_columns(records, per_megavoxel=False):
+    """
+    :return: column name -> values of every record (nan where a record has no value)
+    """
+    spans = []
+    for record in records:
+        spans += [name for name in record["spans"] if name not in spans]
+    scale = [
+        (1e6 / record["input_voxels"] if per_megavoxel else 1.0) for record in records
+    ]
+    columns = {"total": [r["total"] * s for r, s in zip(records, scale)]}
+    for name in spans:
+        columns[name] = [
+            r["spans"].get(name, np.nan) * s for r, s in zip(records, scale)
+        ]
+    for name in VALUES:
+        if any(name in r for r in records):
+            columns[name] = [r.get(name, np.nan) for r in records]
+    columns["output_mb"] = [r["output_bytes"] / MB for r in records]
+    return dict((k, np.asarray(v, dtype=np.float64)) for k, v in columns.items())
+
+
+def print_percentiles(columns, percentiles, unit):
+    header = "%-32s %6s %10s" % ("", "n", "mean") + "".join(
+        " %10s" % ("p%g" % p) for p in percentiles
+    )
+    print(header + " %10s" % "max")
+    for name, values in columns.items():
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            continue
+        label = name + (" (%s)" % unit if name not in VALUES + ["output_mb"] else "")
+        print(
+            "%-32s %6d %10.4g" % (label, len(values), values.mean())
+            + "".join(" %10.4g" % v for v in np.percentile(values, percentiles))
+            + " %10.4g" % values.max()
+        )
+
+
+def print_outliers(records, columns, threshold, top):
+    total_z = robust_z(columns["total"])
+    outliers = [i for i in np.argsort(-total_z) if total_z[i] > threshold][:top]
+    print(
+        "\n> %d outlier cases (robust z of the total time > %g)"
+        % (sum(total_z > threshold), threshold)
+    )
+    stage_z = {}
+    for name, values in columns.items():
+        if name != "total":
+            present = ~np.isnan(values)
+            stage_z[name] = np.full(len(values), np.nan)
+            stage_z[name][present] = robust_z(values[present])
+    for i in outliers:
+        stages = sorted(
+            [
+                (z[i], name)
+                for name, z in stage_z.items()
+                if not np.isnan(z[i]) and z[i] > threshold
+            ],
+            reverse=True,
+        )
+        print(
+            "  %-32s total %.4g (z %.1f)%s"
+            % (
+                records[i]["case"],
+                columns["total"][i],
+                total_z[i],
+                "".join(
+                    ", %s %.4g (z %.1f)" % (name, columns[name][i], z)
+                    for z, name in stages
+                ),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="percentiles and outlier cases of inference.py --run_report"
+    )
+    parser.add_argument("reports", nargs="+", help="jsonl run reports")
+    parser.add_argument("--percentiles", nargs="+", default=[50, 90, 99], type=float)
+    parser.add_argument(
+        "--threshold", default=3.5, type=float, help="robust z-score of an outlier"
+    )
+    parser.add_argument("--top", default=20, type=int, help="outliers printed")
+    parser.add_argument(
+        "--per_megavoxel",
+        action="store_true",
+        default=False,
+        help="seconds per million ct voxels, so large cts are not outliers by size",
+    )
+    parser.add_argument(
+        "--status",
+        default="done",
+        help="status of the records summarized (done, skipped or failed)",
+    )
+    args = parser.parse_args()
+
+    records = []
+    for report_file in args.reports:
+        records += read_report(report_file)
+    statuses = {}
+    for record in records:
+        statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+    print(
+        ">> %d records: %s"
+        % (
+            len(records),
+            ", ".join("%d %s" % (n, status) for status, n in sorted(statuses.items())),
+        )
+    )
+    records = [r for r in records if r["status"] == args.status]
+    if args.per_megavoxel:
+        records = [r for r in records if r.get("input_voxels", 0) > 0]
+    if len(records) == 0:
+        return
+
+    columns = get_columns(records, args.per_megavoxel)
+    print_percentiles(
+        columns, args.percentiles, "s/Mvoxel" if args.per_megavoxel else "s"
+    )
+    print_outliers(records, columns, args.threshold, args.top)
+
+
+if __name__ == "__main__":
+    main()
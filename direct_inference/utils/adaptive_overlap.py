@@ -0,0 +1,196 @@
+import time
+
+import torch
+import torch.nn.functional as F
+from monai.data.utils import compute_importance_map, dense_patch_slices
+
+
+def get_scan_interval(image_size, roi_size, overlap):
+    # same scan interval as monai sliding_window_inference
+    scan_interval = []
+    for size, roi in zip(image_size, roi_size):
+        if roi == size:
+            scan_interval.append(roi)
+        else:
+            scan_interval.append(max(int(roi * (1 - overlap)), 1))
+    return scan_interval
+
+
+def get_patch_slices(image_size, roi_size, overlap):
+    return dense_patch_slices(
+        image_size, roi_size, get_scan_interval(image_size, roi_size, overlap)
+    )
+
+
+def get_probabilities(logits, activation="sigmoid"):
+    if activation == "sigmoid":
+        return torch.sigmoid(logits)
+    return F.softmax(logits, dim=1)
+
+
+def foreground_confidence(prob, activation="sigmoid"):
+    # probability of the most likely foreground class, (B, 1, X, Y, Z)
+    if activation == "sigmoid":
+        return prob.amax(dim=1, keepdim=True)
+    return 1 - prob[:, :1]
+
+
+def entropy_map(prob):
+    """
+    per class entropy -p log(p) of prob, as in create_entropy_map (utils.py), maximum over the classes
+    """
+    return torch.special.entr(prob).amax(dim=1)
+
+
+class _PatchAccumulator:
+    """
+    gaussian weighted average of the patch outputs (like monai sliding_window_inference), plus the weighted mean and
+    mean square of the foreground confidence of every patch, whose variance measures the disagreement of overlapping
+    patches
+    """
+
+    def __init__(self, image, predictor, roi_size, activation, sw_device, device):
+        self.image = image
+        self.predictor = predictor
+        self.activation = activation
+        self.sw_device = sw_device if sw_device is not None else image.device
+        self.device = device if device is not None else image.device
+        self.importance_map = torch.clamp(
+            compute_importance_map(
+                roi_size, mode="gaussian", sigma_scale=0.125, device=self.device
+            ),
+            min=1e-3,
+        )
+        self.output = None
+        self.count = torch.zeros(
+            (image.shape[0], 1) + image.shape[2:], device=self.device
+        )
+        self.confidence = torch.zeros_like(self.count)
+        self.confidence_sq = torch.zeros_like(self.count)
+        self.num_patches = 0
+
+    def add(self, patch_slice):
+        index = (slice(None), slice(None)) + tuple(patch_slice)
+        out = self.predictor(self.image[index].to(self.sw_device))
+        out = out.float().to(self.device)
+        if self.output is None:
+            self.output = torch.zeros(
+                (out.shape[0], out.shape[1]) + self.image.shape[2:], device=self.device
+            )
+        w = self.importance_map
+        self.output[index] += out * w
+        self.count[index] += w
+        q = foreground_confidence(
+            get_probabilities(out, self.activation), self.activation
+        )
+        self.confidence[index] += q * w
+        self.confidence_sq[index] += q * q * w
+        self.num_patches += 1
+
+    def logits(self):
+        return self.output / self.count
+
+    def disagreement(self):
+        # weighted standard deviation of the foreground confidence over the patches covering a voxel
+        mean = self.confidence / self.count
+        variance = self.confidence_sq / self.count - mean * mean
+        return torch.sqrt(torch.clamp(variance, min=0))[:, 0]
+
+
+def adaptive_sliding_window_inference(
+    image,
+    predictor,
+    roi_size,
+    activation="sigmoid",
+    base_overlap=0.5,
+    overlap=0.75,
+    entropy_threshold=0.05,
+    disagreement_threshold=0.1,
+    min_uncertain_voxels=100,
+    sw_device=None,
+    device=None,
+):
+    """
+    sliding window inference that spends the patches of a high overlap only where the prediction is uncertain
+    1. base pass: all patches of the base_overlap grid
+    2. uncertainty: voxels whose entropy (see entropy_map, threshold as in entropy_post_process) or disagreement of the
+    overlapping base patches (standard deviation of the foreground confidence, threshold as in std_post_process) is
+    above its threshold
+    3. refinement: the patches of the overlap grid that are not in the base grid and hold at least
+    min_uncertain_voxels uncertain voxels
+    With base_overlap 0.5 and overlap 0.75 the base grid is a subset of the fine one, so refining every patch gives
+    the same output as monai sliding_window_inference with overlap 0.75.
+
+    :param image: (1, C_in, X, Y, Z) preprocessed image
+    :param predictor: network, patches -> logits
+    :return: logits, stats (patch counts, fraction of extra patches, uncertain fraction, seconds per pass)
+    """
+    roi_size = tuple(roi_size)
+    image_size = tuple(image.shape[2:])
+    # pad to at least one roi like monai sliding_window_inference
+    pad = []
+    for size, roi in zip(reversed(image_size), reversed(roi_size)):
+        diff = max(roi - size, 0)
+        pad.extend([diff // 2, diff - diff // 2])
+    padded = F.pad(image, pad, mode="constant", value=0)
+    padded_size = tuple(padded.shape[2:])
+
+    stats = {}
+    start = time.time()
+    accumulator = _PatchAccumulator(
+        padded, predictor, roi_size, activation, sw_device, device
+    )
+    base_slices = get_patch_slices(padded_size, roi_size, base_overlap)
+    for patch_slice in base_slices:
+        accumulator.add(patch_slice)
+    prob = get_probabilities(accumulator.logits(), activation)
+    uncertain = (entropy_map(prob) > entropy_threshold) | (
+        accumulator.disagreement() > disagreement_threshold
+    )
+    uncertain = uncertain.any(dim=0)
+    del prob
+    stats["base_time"] = time.time() - start
+
+    start = time.time()
+    base_starts = set(
+        tuple(s.start for s in patch_slice) for patch_slice in base_slices
+    )
+    candidates = [
+        patch_slice
+        for patch_slice in get_patch_slices(padded_size, roi_size, overlap)
+        if tuple(s.start for s in patch_slice) not in base_starts
+    ]
+    for patch_slice in candidates:
+        if uncertain[tuple(patch_slice)].sum().item() >= min_uncertain_voxels:
+            accumulator.add(patch_slice)
+    stats["refine_time"] = time.time() - start
+
+    stats["base_patches"] = len(base_slices)
+    stats["extra_patches"] = accumulator.num_patches - len(base_slices)
+    stats["fixed_patches"] = len(base_slices) + len(candidates)
+    stats["extra_fraction"] = stats["extra_patches"] / max(len(candidates), 1)
+    stats["uncertain_fraction"] = uncertain.float().mean().item()
+
+    logits = accumulator.logits()
+    crop = [slice(None), slice(None)]
+    for i, size in enumerate(image_size):
+        lo = pad[2 * (len(image_size) - 1 - i)]
+        crop.append(slice(lo, lo + size))
+    return logits[tuple(crop)], stats
+
+
+def format_stats(stats):
+    return (
+        "adaptive overlap: %d base + %d of %d extra patches (%.1f%%, %d patches with a"
+        " fixed overlap), %.1f%% of the voxels uncertain, base %.2f s, refine %.2f s"
+        % (
+            stats["base_patches"],
+            stats["extra_patches"],
+            stats["fixed_patches"] - stats["base_patches"],
+            stats["extra_fraction"] * 100,
+            stats["fixed_patches"],
+            stats["uncertain_fraction"] * 100,
+            stats["base_time"],
+            stats["refine_time"],
+        )
+    )
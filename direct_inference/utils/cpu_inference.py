@@ -0,0 +1,92 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+
+QUANTIZATION_MODES = ("none", "int8", "bf16")
+
+
+def get_inference_device(args, rank=0):
+    if args.cpu:
+        return torch.device("cpu")
+    return torch.device("cuda:%d" % rank)
+
+
+def configure_cpu_threads(num_threads=None, num_interop_threads=None):
+    """
+    intra op threads default to the number of physical cores, which oversubscribes the machine if several inference
+    processes share it. Must be called before the first parallel op (set_num_interop_threads fails afterwards)
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        torch.set_num_interop_threads(num_interop_threads)
+    return torch.get_num_threads()
+
+
+def quantize_model(model, quantization="none"):
+    """
+    post training weight quantization for cpu inference
+    - int8: dynamic int8 quantization (int8 weights, activations quantized on the fly) of all nn.Linear layers. This
+    covers the attention and mlp layers of swinunetr. PyTorch has no dynamic int8 kernel for Conv3d, convolutions stay
+    in fp32 (use bf16 for them)
+    - bf16: nothing changes here, the forward pass runs under cpu autocast (see cpu_autocast) which computes Conv3d and
+    Linear in bfloat16
+    """
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(
+            "quantization should be one of %s, got %s"
+            % (", ".join(QUANTIZATION_MODES), quantization)
+        )
+    if quantization == "int8":
+        if isinstance(model, torch.jit.ScriptModule):
+            raise ValueError(
+                "int8 quantization needs an eager model, build the artifact with"
+                " --mode eager"
+            )
+        if next(model.parameters()).device.type != "cpu":
+            raise ValueError("int8 quantized models can only run on the cpu")
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {nn.Linear}, dtype=torch.qint8
+        )
+    return model
+
+
+def cpu_autocast(quantization="none"):
+    if quantization == "bf16":
+        return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+class CPUPredictor(nn.Module):
+    """
+    wraps a model for sliding_window_inference on the cpu: converts the patches to channels last (NDHWC) memory
+    format, which most cpu Conv3d kernels (oneDNN) prefer, and runs the forward pass under bf16 autocast if requested
+    """
+
+    def __init__(self, model, quantization="none", channels_last=False):
+        super().__init__()
+        self.model = quantize_model(model, quantization)
+        self.quantization = quantization
+        self.channels_last = channels_last
+        if channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last_3d)
+
+    def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last_3d)
+        with cpu_autocast(self.quantization):
+            out = self.model(x)
+        return out.float().contiguous()
+
+
+def optimize_for_cpu(model, args):
+    """
+    applies the cpu options of inference.py (--quantization, --channels_last) to model. Returns model unchanged when
+    running on the gpu
+    """
+    if not args.cpu:
+        return model
+    if args.quantization == "none" and not args.channels_last:
+        return model
+    return CPUPredictor(model, args.quantization, args.channels_last).eval()
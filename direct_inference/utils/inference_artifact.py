@@ -0,0 +1,221 @@
+import json
+import os
+import time
+
+import torch
+from model.DiNTS import export_static_dints
+from model.SwinUNETR_target import SwinUNETR
+from model.Unet import fuse_for_inference, set_frozen_stats
+from model.Universal_model import Universal_model
+
+ARTIFACT_VERSION = 1
+# prefixes added by DistributedDataParallel / DataParallel and by wrapping the backbone into Universal_model
+WRAPPER_PREFIXES = ("module.", "backbone.")
+
+
+def build_model(config):
+    """
+    builds the eager model described by config (see get_model_config)
+    """
+    img_size = tuple(config["roi"])
+    if config["customize"]:
+        model = SwinUNETR(
+            img_size=img_size,
+            in_channels=1,
+            out_channels=config["num_class"],
+            feature_size=48,
+            drop_rate=0.0,
+            attn_drop_rate=0.0,
+            dropout_path_rate=0.0,
+            use_checkpoint=False,
+            attn_backend=config["attn_backend"],
+        )
+    else:
+        model = Universal_model(
+            img_size=img_size,
+            in_channels=1,
+            out_channels=config["num_class"],
+            backbone=config["backbone"],
+            encoding=config["encoding"],
+            attn_backend=config["attn_backend"],
+        )
+    return model
+
+
+def get_model_config(args, num_class):
+    return {
+        "customize": bool(args.customize),
+        "backbone": args.backbone,
+        "encoding": "word_embedding",
+        "num_class": num_class,
+        "roi": [args.roi_x, args.roi_y, args.roi_z],
+        "attn_backend": args.attn_backend,
+        "unet_bn_mode": args.unet_bn_mode,
+        "static_dints": bool(args.static_dints),
+    }
+
+
+def _strip_prefixes(key):
+    for prefix in WRAPPER_PREFIXES:
+        if key.startswith(prefix):
+            return _strip_prefixes(key[len(prefix) :])
+    return key
+
+
+def map_state_dict_by_name(store_dict, load_dict):
+    """
+    maps the entries of a checkpoint onto the keys of store_dict by name. Wrapper prefixes (module., backbone.) are
+    ignored on both sides so that checkpoints of DDP models and of Universal_model backbones can be loaded. Every
+    mapped entry must have the shape of the entry it replaces.
+    :return: mapped state dict, list of keys of store_dict missing in load_dict, list of unused keys of load_dict
+    """
+    store_names = {}
+    for key in store_dict.keys():
+        name = _strip_prefixes(key)
+        if name in store_names:
+            raise ValueError(
+                "keys %s and %s cannot be told apart without their prefixes"
+                % (store_names[name], key)
+            )
+        store_names[name] = key
+
+    mapped = dict(store_dict)
+    found = set()
+    unused = []
+    for key, value in load_dict.items():
+        name = _strip_prefixes(key)
+        if name not in store_names:
+            unused.append(key)
+            continue
+        target = store_names[name]
+        if tuple(store_dict[target].shape) != tuple(value.shape):
+            raise ValueError(
+                "shape mismatch for %s: checkpoint %s, model %s"
+                % (key, tuple(value.shape), tuple(store_dict[target].shape))
+            )
+        mapped[target] = value
+        found.add(target)
+    missing = [k for k in store_dict.keys() if k not in found]
+    return mapped, missing, unused
+
+
+def load_checkpoint_by_name(model, checkpoint_file, allow_missing=False):
+    checkpoint = torch.load(checkpoint_file, map_location="cpu")
+    if "net" in checkpoint:
+        checkpoint = checkpoint["net"]
+    elif "state_dict" in checkpoint:
+        checkpoint = checkpoint["state_dict"]
+    mapped, missing, unused = map_state_dict_by_name(model.state_dict(), checkpoint)
+    print(
+        "mapped %d of %d model weights, %d checkpoint entries unused"
+        % (len(mapped) - len(missing), len(mapped), len(unused))
+    )
+    if len(missing) > 0:
+        msg = "weights missing in %s: %s" % (checkpoint_file, ", ".join(missing))
+        if not allow_missing:
+            raise ValueError(msg)
+        print("WARNING:", msg)
+    model.load_state_dict(mapped)
+    return missing, unused
+
+
+def prepare_for_inference(model, config):
+    model.eval()
+    if config.get("unet_bn_mode", "batch") != "batch":
+        set_frozen_stats(model)
+        if config["unet_bn_mode"] == "fused":
+            model = fuse_for_inference(model, inplace=True)
+    if config.get("static_dints", False) and config["backbone"] == "dints":
+        model.backbone = export_static_dints(model.backbone)
+    return model
+
+
+def save_inference_artifact(
+    model, config, metadata, output_file, mode="eager", device="cpu", batch_size=1
+):
+    """
+    serializes a ready to run inference artifact. model must already hold the trained weights.
+    :param mode: "eager" stores the (name validated) state dict and rebuilds the model from config when loading.
+    "trace" stores a TorchScript module traced with a fixed (batch_size, 1, *roi) input on device, loading it does not
+    need any model code. Traced artifacts only accept inputs of exactly that shape
+    :param metadata: json serializable dict (roi, spacing, intensity window, class map, ...)
+    """
+    metadata = dict(metadata)
+    metadata.update(
+        {
+            "artifact_version": ARTIFACT_VERSION,
+            "mode": mode,
+            "model_config": config,
+            "input_shape": [batch_size, 1] + list(config["roi"]),
+            "torch_version": torch.__version__,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+    )
+    model = prepare_for_inference(model, config)
+    tmp_file = output_file + ".tmp"
+    if mode == "eager":
+        torch.save(
+            {"metadata": json.dumps(metadata), "state_dict": model.state_dict()},
+            tmp_file,
+        )
+    elif mode == "trace":
+        model = model.to(device)
+        example = torch.zeros(metadata["input_shape"], device=device)
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example, check_trace=False)
+        torch.jit.save(
+            traced, tmp_file, _extra_files={"metadata.json": json.dumps(metadata)}
+        )
+    else:
+        raise ValueError("unknown artifact mode %s" % mode)
+    os.replace(tmp_file, output_file)
+    return metadata
+
+
+def load_inference_artifact(artifact_file, device="cpu", compile=False):
+    """
+    :return: (model in eval mode on device, metadata)
+    """
+    extra_files = {"metadata.json": ""}
+    try:
+        model = torch.jit.load(
+            artifact_file, map_location=device, _extra_files=extra_files
+        )
+        metadata = json.loads(extra_files["metadata.json"])
+    except RuntimeError:
+        artifact = torch.load(artifact_file, map_location="cpu")
+        metadata = json.loads(artifact["metadata"])
+        config = metadata["model_config"]
+        model = build_model(config)
+        # the stored state dict was taken after prepare_for_inference, so the module structure has to match first
+        model = prepare_for_inference(model, config)
+        model.load_state_dict(artifact["state_dict"])
+        model = model.to(device)
+    if metadata.get("artifact_version") != ARTIFACT_VERSION:
+        raise ValueError(
+            "artifact version %s is not supported (expected %d)"
+            % (metadata.get("artifact_version"), ARTIFACT_VERSION)
+        )
+    model.eval()
+    if compile:
+        if hasattr(torch, "compile"):
+            model = torch.compile(model)
+        else:
+            print("torch.compile requires torch>=2.0, running the model uncompiled")
+    return model, metadata
+
+
+def apply_artifact_metadata(args, metadata):
+    """
+    overrides the model and preprocessing arguments of inference.py with the values the artifact was built with
+    """
+    config = metadata["model_config"]
+    args.roi_x, args.roi_y, args.roi_z = metadata["roi"]
+    args.space_x, args.space_y, args.space_z = metadata["spacing"]
+    for k, v in metadata["intensity_window"].items():
+        setattr(args, k, v)
+    args.num_class = metadata["num_class"]
+    args.backbone = config["backbone"]
+    args.customize = config["customize"]
+    args.suprem = not config["customize"]
+    return args
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+CACHE_VERSION = 1
+CACHE_FORMATS = ("fp16", "uint8")
+# arguments of inference.py that change the network output
+CACHE_KEY_ARGS = (
+    "suprem",
+    "customize",
+    "backbone",
+    "num_class",
+    "roi_x",
+    "roi_y",
+    "roi_z",
+    "overlap",
+    "attn_backend",
+    "unet_bn_mode",
+    "static_dints",
+    "quantization",
+    "channels_last",
+    "coarse_to_fine",
+    "coarse_scale",
+    "coarse_overlap",
+    "roi_margin",
+    "coarse_classes",
+    "adaptive_overlap",
+    "base_overlap",
+    "entropy_threshold",
+    "disagreement_threshold",
+)
+
+
+def file_sha1(file_name, block_size=1 << 20):
+    h = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_model_key(args):
+    """
+    identifies the network output of an inference.py run: content hash of the checkpoint (or artifact) and the
+    arguments that change the output. Thresholds, post processing and output options are not part of it
+    """
+    model_file = args.artifact if args.artifact is not None else args.checkpoint
+    return {
+        "version": CACHE_VERSION,
+        "model_sha1": file_sha1(model_file),
+        "device": args.device.type,
+        "args": dict([(k, getattr(args, k, None)) for k in CACHE_KEY_ARGS]),
+    }
+
+
+class ResultCache:
+    """
+    On disk cache of the raw sliding window output of inference.py, so that runs with other thresholds, post
+    processing or output formats replay the network output instead of recomputing it.
+
+    An entry is keyed by the model key (see get_model_key) and the preprocessed image, so changes of the spacing or
+    intensity window miss the cache. It is stored as one compressed .npz per case, chunked per class and per
+    chunk_depth slices along the last axis.
+    - fp16: logits in float16, works for sigmoid (suprem) and softmax (customize) outputs
+    - uint8: sigmoid probabilities quantized to 1/255, about half the size of fp16, sigmoid outputs only
+    The output of a miss goes through the same quantization, so the first run and the replays give the same labels.
+    """
+
+    def __init__(self, cache_dir, model_key, cache_format="fp16", chunk_depth=64):
+        if cache_format not in CACHE_FORMATS:
+            raise ValueError(
+                "cache format should be one of %s, got %s"
+                % (", ".join(CACHE_FORMATS), cache_format)
+            )
+        self.cache_dir = cache_dir
+        self.model_key = json.dumps(model_key, sort_keys=True)
+        self.cache_format = cache_format
+        self.chunk_depth = chunk_depth
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, image):
+        array = np.ascontiguousarray(image.detach().cpu().numpy())
+        h = hashlib.sha1(self.model_key.encode())
+        h.update(("%s %s %s" % (self.cache_format, array.shape, array.dtype)).encode())
+        h.update(array.data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npz")
+
+    def encode(self, logits):
+        if self.cache_format == "fp16":
+            return logits.half().cpu().numpy()
+        return (
+            (torch.sigmoid(logits.float()) * 255).round().to(torch.uint8).cpu().numpy()
+        )
+
+    @staticmethod
+    def decode(data, activation="sigmoid", device="cpu"):
+        """
+        :return: float32 probabilities (sigmoid or softmax over the class axis) on device
+        """
+        x = torch.from_numpy(data).to(device)
+        if x.dtype == torch.uint8:
+            if activation != "sigmoid":
+                raise ValueError("uint8 cache entries only hold sigmoid outputs")
+            return x.float() / 255
+        if activation == "sigmoid":
+            return torch.sigmoid(x.float())
+        return F.softmax(x.float(), dim=1)
+
+    def save(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {
+            "shape": list(data.shape),
+            "dtype": str(data.dtype),
+            "chunk_depth": self.chunk_depth,
+            "model_key": self.model_key,
+        }
+        chunks = {"meta": np.array(json.dumps(meta))}
+        for c in range(data.shape[1]):
+            for z in range(0, data.shape[-1], self.chunk_depth):
+                chunks["c%03d_z%05d" % (c, z)] = data[
+                    :, c, ..., z : z + self.chunk_depth
+                ]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **chunks)
+        os.replace(tmp_path, path)
+
+    def load(self, key):
+        """
+        :return: cached array (see encode), None if the case is not cached
+        """
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as f:
+                meta = json.loads(str(f["meta"]))
+                data = np.empty(meta["shape"], dtype=meta["dtype"])
+                for c in range(data.shape[1]):
+                    for z in range(0, data.shape[-1], meta["chunk_depth"]):
+                        data[:, c, ..., z : z + meta["chunk_depth"]] = f[
+                            "c%03d_z%05d" % (c, z)
+                        ]
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            print("WARNING: ignoring unreadable cache entry %s (%s)" % (path, e))
+            return None
+        return data
+
+    def predict(self, image, predictor, activation="sigmoid", device="cpu"):
+        """
+        probabilities of image, from the cache or computed with predictor (image -> logits) and added to the cache
+        """
+        key = self.get_key(image)
+        data = self.load(key)
+        if data is not None:
+            self.hits += 1
+            print("result cache hit %s" % key)
+        else:
+            self.misses += 1
+            data = self.encode(predictor(image))
+            self.save(key, data)
+        return self.decode(data, activation, device)
+
+
+class LazyModel:
+    """
+    builds the model at its first call, runs that are fully served by the result cache never load the checkpoint
+    """
+
+    def __init__(self, build_fn):
+        self.build_fn = build_fn
+        self.model = None
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        if self.model is None:
+            self.model = self.build_fn()
+        return self.model(x)
@@ -0,0 +1,148 @@
+import math
+import time
+
+import torch
+import torch.nn.functional as F
+from monai.inferers import sliding_window_inference
+
+
+def _synchronize(device):
+    if device is not None and torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def _sliding_window(image, predictor, roi_size, overlap, sw_device, device):
+    return sliding_window_inference(
+        image,
+        roi_size,
+        1,
+        predictor,
+        overlap=overlap,
+        mode="gaussian",
+        sw_device=sw_device,
+        device=device,
+    )
+
+
+def target_mask(logits, target_classes, activation="softmax", threshold=0.5):
+    """
+    :param logits: (1, C, X, Y, Z) network output
+    :return: (X, Y, Z) bool mask of the voxels assigned to one of target_classes (channel indices). softmax: argmax
+    over the classes, sigmoid: probability above threshold
+    """
+    if activation == "softmax":
+        labels = torch.argmax(logits[0], dim=0)
+        return torch.isin(labels, torch.tensor(target_classes, device=labels.device))
+    return (torch.sigmoid(logits[0, target_classes].float()) > threshold).any(dim=0)
+
+
+def target_bounding_box(mask, full_shape, margin, roi_size):
+    """
+    bounding box of mask, mapped from the coarse grid of mask to full_shape, padded by margin voxels and grown to at
+    least roi_size
+
+    :return: tuple of slices into the full volume, None if mask is empty
+    """
+    nonzero = torch.nonzero(mask)
+    if nonzero.numel() == 0:
+        return None
+    lower = nonzero.min(dim=0).values.tolist()
+    upper = (nonzero.max(dim=0).values + 1).tolist()
+    box = []
+    for lo, hi, coarse_size, size, roi in zip(
+        lower, upper, mask.shape, full_shape, roi_size
+    ):
+        ratio = size / coarse_size
+        lo = int(math.floor(lo * ratio)) - margin
+        hi = int(math.ceil(hi * ratio)) + margin
+        if hi - lo < roi:
+            lo = (lo + hi - roi) // 2
+            hi = lo + roi
+        # shift a box that leaves the volume back inside, so that it keeps its size
+        if lo < 0:
+            lo, hi = 0, hi - lo
+        if hi > size:
+            lo, hi = lo - (hi - size), size
+        box.append(slice(max(lo, 0), hi))
+    return tuple(box)
+
+
+def coarse_to_fine_inference(
+    image,
+    predictor,
+    roi_size,
+    target_classes,
+    activation="softmax",
+    coarse_scale=0.5,
+    coarse_overlap=0.25,
+    overlap=0.5,
+    margin=16,
+    threshold=0.5,
+    sw_device=None,
+    device=None,
+):
+    """
+    two stage sliding window inference for tasks that only concern one region of the volume (e.g. the pancreas)
+    1. coarse: sliding window over the image downsampled by coarse_scale with coarse_overlap, localizes the voxels of
+    target_classes
+    2. fine: full resolution sliding window with overlap inside their bounding box (padded by margin voxels)
+    The fine output is pasted into the upsampled coarse output, so the result has the shape of the full volume.
+    Falls back to a full resolution sliding window over the whole volume when the coarse pass finds no target voxel.
+
+    :param image: (1, 1, X, Y, Z) preprocessed image
+    :param predictor: network, patches -> logits
+    :return: logits of the full volume, timings (seconds per stage, box, fraction of the volume, fallback)
+    """
+    full_shape = image.shape[2:]
+    timings = {"fallback": False}
+    start = time.time()
+    coarse_image = F.interpolate(
+        image, scale_factor=coarse_scale, mode="trilinear", align_corners=False
+    )
+    coarse = _sliding_window(
+        coarse_image, predictor, roi_size, coarse_overlap, sw_device, device
+    )
+    mask = target_mask(coarse, target_classes, activation, threshold)
+    box = target_bounding_box(mask, full_shape, margin, roi_size)
+    _synchronize(coarse.device)
+    timings["coarse"] = time.time() - start
+
+    start = time.time()
+    if box is None:
+        timings["fallback"] = True
+        timings["box_fraction"] = 1.0
+        output = _sliding_window(image, predictor, roi_size, overlap, sw_device, device)
+    else:
+        index = (slice(None), slice(None)) + box
+        fine = _sliding_window(
+            image[index], predictor, roi_size, overlap, sw_device, device
+        )
+        output = F.interpolate(
+            coarse, size=full_shape, mode="trilinear", align_corners=False
+        )
+        del coarse
+        output[index] = fine.to(output.device, output.dtype)
+        timings["box"] = [[s.start, s.stop] for s in box]
+        timings["box_fraction"] = math.prod(s.stop - s.start for s in box) / math.prod(
+            full_shape
+        )
+    _synchronize(output.device)
+    timings["fine"] = time.time() - start
+    timings["total"] = timings["coarse"] + timings["fine"]
+    return output, timings
+
+
+def format_timings(timings):
+    if timings["fallback"]:
+        region = "coarse pass found no target, full volume"
+    else:
+        region = "box %s, %.1f%% of the volume" % (
+            " x ".join("%d:%d" % tuple(s) for s in timings["box"]),
+            timings["box_fraction"] * 100,
+        )
+    return "coarse %.2f s, fine %.2f s (%s), total %.2f s" % (
+        timings["coarse"],
+        timings["fine"],
+        region,
+        timings["total"],
+    )
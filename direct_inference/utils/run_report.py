@@ -0,0 +1,212 @@
+"""
+per case timing and resource trace of inference.py (--run_report), one json line per case. summarize_run_report.py
+prints the percentiles of a report and its outlier cases
+"""
+
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+import torch
+from monai.transforms import Compose, apply_transform
+
+MB = 1024.0**2
+
+
+def reset_peak_rss():
+    """
+    resets the peak resident set size of the process (linux >= 4.0), so the next peak_rss_bytes is the peak since
+    this call. Elsewhere the peak stays the one of the whole process
+
+    :return: whether the peak was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_bytes():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # kilobytes on linux, bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class TimedCompose(Compose):
+    """
+    Compose keeping the seconds of every transform of its last call in last_timings (transform class name ->
+    seconds). The transforms are unchanged, so Invertd still inverts them. CacheDataset applies the cached transforms
+    one by one, cached cases have no timings
+    """
+
+    def __init__(self, transforms=None, *args, **kwargs):
+        super().__init__(transforms, *args, **kwargs)
+        self.last_timings = {}
+
+    def __call__(self, input_):
+        self.last_timings = {}
+        for _transform in self.transforms:
+            start = time.time()
+            input_ = apply_transform(
+                _transform, input_, self.map_items, self.unpack_items
+            )
+            name = type(_transform).__name__
+            self.last_timings[name] = (
+                self.last_timings.get(name, 0.0) + time.time() - start
+            )
+        return input_
+
+
+class CaseTrace:
+    """
+    spans (stage -> seconds), values (counts, shapes) and outputs of one case. Created before the case is loaded, so
+    the peaks of memory cover the loading
+    """
+
+    def __init__(self, device=None):
+        self.device = torch.device(device) if device is not None else None
+        self.case = None
+        self.spans = {}
+        self.values = {"patches": 0}
+        self.outputs = []
+        self.start = time.time()
+        self.rss_reset = reset_peak_rss()
+        if self._cuda():
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def _cuda(self):
+        return self.device is not None and self.device.type == "cuda"
+
+    def _synchronize(self):
+        if self._cuda():
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def span(self, name):
+        # accumulates, e.g. the inversion of every organ
+        self._synchronize()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._synchronize()
+            self.add_span(name, time.time() - start)
+
+    def add_span(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        self.values[name] = self.values.get(name, 0) + value
+
+    def set_values(self, **values):
+        self.values.update(values)
+
+    def count_patches(self, predictor):
+        # predictor counting the patches it is called with
+        def counted(x):
+            self.count("patches", x.shape[0])
+            return predictor(x)
+
+        return counted
+
+    def add_output(self, path):
+        self.outputs.append(path)
+
+    def finish(self, status="done"):
+        """
+        :return: json record of the case
+        """
+        self._synchronize()
+        record = {
+            "case": self.case,
+            "status": status,
+            "total": time.time() - self.start,
+            "spans": self.spans,
+        }
+        record.update(self.values)
+        record["output_bytes"] = sum(
+            os.path.getsize(path) for path in self.outputs if os.path.isfile(path)
+        )
+        record["peak_rss_mb"] = peak_rss_bytes() / MB
+        record["peak_rss_scope"] = "case" if self.rss_reset else "process"
+        if self._cuda():
+            record["peak_gpu_mb"] = torch.cuda.max_memory_allocated(self.device) / MB
+        return record
+
+
+def traced_batches(loader, transforms=None, device=None):
+    """
+    batches of loader with their CaseTrace, holding the seconds spent loading the batch ("data") and, for a
+    TimedCompose, the seconds of every transform
+    """
+    iterator = iter(loader)
+    while True:
+        trace = CaseTrace(device)
+        start = time.time()
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return
+        trace.add_span("data", time.time() - start)
+        for name, seconds in getattr(transforms, "last_timings", {}).items():
+            trace.add_span(name, seconds)
+        yield batch, trace
+
+
+class RunReport:
+    """
+    appends the record of every case to a jsonl file, one write per line so ranks of a distributed run can share it.
+    Without a file the records are only printed
+    """
+
+    def __init__(self, report_file=None, rank=0):
+        self.report_file = report_file
+        self.rank = rank
+        if report_file is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(report_file)), exist_ok=True)
+
+    def write(self, record):
+        record["rank"] = self.rank
+        record["time"] = time.time()
+        print(format_record(record))
+        if self.report_file is not None:
+            with open(self.report_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+def format_record(record):
+    spans = sorted(record["spans"].items(), key=lambda item: item[1], reverse=True)
+    return "%s %s in %.2f s (%s), peak rss %.0f MB%s, output %.1f MB" % (
+        record["case"],
+        record["status"],
+        record["total"],
+        ", ".join("%s %.2f s" % span for span in spans),
+        record["peak_rss_mb"],
+        (", peak gpu %.0f MB" % record["peak_gpu_mb"])
+        if "peak_gpu_mb" in record
+        else "",
+        record["output_bytes"] / MB,
+    )
+
+
+def read_report(report_file):
+    records = []
+    with open(report_file) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue  # line cut by an interrupted run
+    return records
@@ -596,6 +596,9 @@ TUMOR_ORGAN = {
     "Kidney Cyst": [2, 3],
 }
 
+# anomaly detections of an unbalanced lung separation before the result is kept as is
+LUNG_SEPARATION_ATTEMPTS = 5
+
 
 def organ_post_process(pred_mask, organ_list, case_dir, args):
     total_anomly_slice_number = 0
@@ -692,10 +695,12 @@ def organ_post_process(pred_mask, organ_list, case_dir, args):
                                 left_lung_size = np.sum(
                                     post_pred_mask[b, 16], axis=(0, 1, 2)
                                 )
-                                while (
+                                attempt = 1
+                                while attempt < LUNG_SEPARATION_ATTEMPTS and (
                                     right_lung_size / left_lung_size > 4
                                     or left_lung_size / right_lung_size > 4
                                 ):
+                                    attempt += 1
                                     print("still need anomly detection")
                                     if right_lung_size > left_lung_size:
                                         (
@@ -782,10 +787,12 @@ def organ_post_process(pred_mask, organ_list, case_dir, args):
                                 left_lung_size = np.sum(
                                     post_pred_mask[b, 16], axis=(0, 1, 2)
                                 )
-                                while (
+                                attempt = 1
+                                while attempt < LUNG_SEPARATION_ATTEMPTS and (
                                     right_lung_size / left_lung_size > 4
                                     or left_lung_size / right_lung_size > 4
                                 ):
+                                    attempt += 1
                                     print("still need anomly detection")
                                     if right_lung_size > left_lung_size:
                                         (
@@ -931,71 +938,66 @@ def lung_overlap_post_process(pred_mask):
 
 
 def find_best_iter_and_masks(lung_mask):
-    iter = 1
-    print("current iteration:" + str(iter))
-    struct2 = ndimage.generate_binary_structure(3, 3)
-    erosion_mask = ndimage.binary_erosion(lung_mask, structure=struct2, iterations=iter)
-    candidates_and_masks = lung_overlap_post_process(erosion_mask)
-    while candidates_and_masks[0] == 1:
-        iter += 1
-        print("current iteration:" + str(iter))
-        erosion_mask = ndimage.binary_erosion(
-            lung_mask, structure=struct2, iterations=iter
+    # binary_erosion with the 3x3x3 structure and iterations=iter keeps the voxels whose chessboard distance to the
+    # background (outside of the volume included) is larger than iter, so every erosion depth is a threshold of a
+    # single distance transform. The best iteration is the smallest one leaving two components with a size ratio of
+    # at most 4; the depths are bounded by the thickest part of the mask, past it the erosion is empty (IndexError,
+    # as the former repeated erosions).
+    coords = np.nonzero(lung_mask)
+    if len(coords[0]) == 0:
+        raise IndexError("empty lung mask")
+    box = tuple(slice(c.min(), c.max() + 1) for c in coords)
+    lung = np.pad(lung_mask[box] != 0, 1)
+    depth = ndimage.distance_transform_cdt(lung, metric="chessboard")
+
+    for iter in range(1, depth.max()):
+        label_out, num_candidates = cc3d.connected_components(
+            depth > iter, connectivity=26, return_N=True
         )
-        candidates_and_masks = lung_overlap_post_process(erosion_mask)
-    print("check if components are valid")
-    left_lung_erosion_mask = candidates_and_masks[1]
-    right_lung_erosion_mask = candidates_and_masks[2]
-    left_lung_erosion_mask_size = np.sum(left_lung_erosion_mask, axis=(0, 1, 2))
-    right_lung_erosion_mask_size = np.sum(right_lung_erosion_mask, axis=(0, 1, 2))
-    while (
-        left_lung_erosion_mask_size / right_lung_erosion_mask_size > 4
-        or right_lung_erosion_mask_size / left_lung_erosion_mask_size > 4
+        if num_candidates == 1:
+            continue
+        areas = np.bincount(label_out.ravel())[1:]
+        ONE, TWO = np.argsort(-areas, kind="stable")[:2] + 1
+        if areas[ONE - 1] / areas[TWO - 1] <= 4:
+            break
+    else:
+        raise IndexError("cannot separate two lungs by erosion")
+    print("erosion done, best iteration: " + str(iter))
+
+    if np.mean(np.nonzero(label_out == ONE)[0]) < np.mean(
+        np.nonzero(label_out == TWO)[0]
     ):
-        print("components still have large difference, erosion interation + 1")
-        iter += 1
-        print("current iteration:" + str(iter))
-        erosion_mask = ndimage.binary_erosion(
-            lung_mask, structure=struct2, iterations=iter
+        left_lung_erosion_mask, right_lung_erosion_mask = (
+            label_out == ONE,
+            label_out == TWO,
         )
-        candidates_and_masks = lung_overlap_post_process(erosion_mask)
-        while candidates_and_masks[0] == 1:
-            iter += 1
-            print("current iteration:" + str(iter))
-            erosion_mask = ndimage.binary_erosion(
-                lung_mask, structure=struct2, iterations=iter
-            )
-            candidates_and_masks = lung_overlap_post_process(erosion_mask)
-        left_lung_erosion_mask = candidates_and_masks[1]
-        right_lung_erosion_mask = candidates_and_masks[2]
-        left_lung_erosion_mask_size = np.sum(left_lung_erosion_mask, axis=(0, 1, 2))
-        right_lung_erosion_mask_size = np.sum(right_lung_erosion_mask, axis=(0, 1, 2))
-    print("erosion done, best iteration: " + str(iter))
+    else:
+        left_lung_erosion_mask, right_lung_erosion_mask = (
+            label_out == TWO,
+            label_out == ONE,
+        )
+    print("erosion left lung size:" + str(np.sum(left_lung_erosion_mask)))
+    print("erosion right lung size:" + str(np.sum(right_lung_erosion_mask)))
 
     print("start dilation")
-    left_lung_erosion_mask = candidates_and_masks[1]
-    right_lung_erosion_mask = candidates_and_masks[2]
-
-    erosion_part_mask = lung_mask - left_lung_erosion_mask - right_lung_erosion_mask
-    left_lung_dist = np.ones(left_lung_erosion_mask.shape)
-    right_lung_dist = np.ones(right_lung_erosion_mask.shape)
-    left_lung_dist[left_lung_erosion_mask == 1] = 0
-    right_lung_dist[right_lung_erosion_mask == 1] = 0
-    left_lung_dist_map = ndimage.distance_transform_edt(left_lung_dist)
-    right_lung_dist_map = ndimage.distance_transform_edt(right_lung_dist)
-    left_lung_dist_map[erosion_part_mask == 0] = 0
-    right_lung_dist_map[erosion_part_mask == 0] = 0
-    left_lung_adding_map = left_lung_dist_map < right_lung_dist_map
-    right_lung_adding_map = right_lung_dist_map < left_lung_dist_map
-
-    left_lung_erosion_mask[left_lung_adding_map == 1] = 1
-    right_lung_erosion_mask[right_lung_adding_map == 1] = 1
-
-    left_lung_mask = left_lung_erosion_mask
-    right_lung_mask = right_lung_erosion_mask
+    # eroded voxels go to the closest lung, ties to neither
+    erosion_part_mask = lung & ~left_lung_erosion_mask & ~right_lung_erosion_mask
+    left_lung_dist_map = ndimage.distance_transform_edt(~left_lung_erosion_mask)
+    right_lung_dist_map = ndimage.distance_transform_edt(~right_lung_erosion_mask)
+    left_lung_mask = left_lung_erosion_mask | (
+        erosion_part_mask & (left_lung_dist_map < right_lung_dist_map)
+    )
+    right_lung_mask = right_lung_erosion_mask | (
+        erosion_part_mask & (right_lung_dist_map < left_lung_dist_map)
+    )
     print("dilation complete")
-    left_lung_mask_fill_hole = ndimage.binary_fill_holes(left_lung_mask)
-    right_lung_mask_fill_hole = ndimage.binary_fill_holes(right_lung_mask)
+
+    # the padding keeps the background around the box connected, holes are filled as in the whole volume
+    inner = (slice(1, -1),) * 3
+    left_lung_mask_fill_hole = np.zeros(lung_mask.shape, bool)
+    right_lung_mask_fill_hole = np.zeros(lung_mask.shape, bool)
+    left_lung_mask_fill_hole[box] = ndimage.binary_fill_holes(left_lung_mask)[inner]
+    right_lung_mask_fill_hole[box] = ndimage.binary_fill_holes(right_lung_mask)[inner]
     left_lung_size = np.sum(left_lung_mask_fill_hole, axis=(0, 1, 2))
     right_lung_size = np.sum(right_lung_mask_fill_hole, axis=(0, 1, 2))
     print("new left lung size:" + str(left_lung_size))
@@ -1003,56 +1005,66 @@ def find_best_iter_and_masks(lung_mask):
     return left_lung_mask_fill_hole, right_lung_mask_fill_hole
 
 
+def rolling_mean_std(values, window):
+    # pandas rolling(window, min_periods=1, center=True) mean and std (ddof 1, nan for a single value)
+    left = window // 2
+    padded = np.pad(
+        values.astype(np.float64), (left, window - 1 - left), constant_values=np.nan
+    )
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window)
+    valid = ~np.isnan(windows)
+    counts = valid.sum(axis=1)
+    mean = np.where(valid, windows, 0).sum(axis=1) / counts
+    squares = np.where(valid, (windows - mean[:, None]) ** 2, 0).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        std = np.sqrt(squares / (counts - 1))
+    return mean, std
+
+
 def anomly_detection(pred_mask, post_pred_mask, save_path, batch, anomly_num):
     total_anomly_slice_number = anomly_num
-    df = get_dataframe(post_pred_mask)
-    # lung_pred_df = fit_model(model,lung_df)
-    lung_df = df[df["array_sum"] != 0]
-    lung_df["SMA20"] = (
-        lung_df["array_sum"].rolling(20, min_periods=1, center=True).mean()
-    )
-    lung_df["STD20"] = (
-        lung_df["array_sum"].rolling(20, min_periods=1, center=True).std()
-    )
-    lung_df["SMA7"] = lung_df["array_sum"].rolling(7, min_periods=1, center=True).mean()
-    lung_df["upper_bound"] = lung_df["SMA20"] + 2 * lung_df["STD20"]
-    lung_df["Predictions"] = lung_df["array_sum"] > lung_df["upper_bound"]
-    lung_df["Predictions"] = lung_df["Predictions"].astype(int)
-    lung_df.dropna(inplace=True)
-    anomly_df = lung_df[lung_df["Predictions"] == 1]
-    anomly_slice = anomly_df["slice_index"].to_numpy()
-    anomly_value = anomly_df["array_sum"].to_numpy()
-    anomly_SMA7 = anomly_df["SMA7"].to_numpy()
+    array_sum = np.sum(post_pred_mask, axis=(0, 1))
+    slice_index = np.nonzero(array_sum)[0]
+    array_sum = array_sum[slice_index]
+    SMA20, STD20 = rolling_mean_std(array_sum, 20)
+    SMA7, _ = rolling_mean_std(array_sum, 7)
+    upper_bound = SMA20 + 2 * STD20
+    # a slice without a std (a single lung slice) is no anomaly
+    defined = ~np.isnan(upper_bound)
+    predictions = defined & (array_sum > upper_bound)
 
     print("decision made")
-    if len(anomly_df) != 0:
+    if np.any(predictions):
         print("anomaly point detected")
         print("check if the anomaly points are real")
-        real_anomly_slice = []
-        for i in range(len(anomly_df)):
-            if anomly_value[i] > anomly_SMA7[i] + 200:
-                print("the anomaly point is real")
-                real_anomly_slice.append(anomly_slice[i])
-                total_anomly_slice_number += 1
+        real = predictions & (array_sum > SMA7 + 200)
+        real_anomly_slice = slice_index[real]
+        total_anomly_slice_number += len(real_anomly_slice)
 
         if len(real_anomly_slice) != 0:
+            print("the anomaly point is real")
+            lung_df = pd.DataFrame(
+                {
+                    "slice_index": slice_index,
+                    "array_sum": array_sum,
+                    "SMA20": SMA20,
+                    "upper_bound": upper_bound,
+                    "Predictions": predictions.astype(int),
+                }
+            )[defined]
             plot_anomalies(lung_df, save_dir=save_path)
             print("anomaly detection plot created")
-            for s in real_anomly_slice:
-                pred_mask[batch, 15, :, :, s] = 0
-                pred_mask[batch, 16, :, :, s] = 0
+            pred_mask[batch, 15][..., real_anomly_slice] = 0
+            pred_mask[batch, 16][..., real_anomly_slice] = 0
             left_lung_mask, right_lung_mask = lung_post_process(pred_mask[batch])
             left_lung_size = np.sum(left_lung_mask, axis=(0, 1, 2))
             right_lung_size = np.sum(right_lung_mask, axis=(0, 1, 2))
             print("new left lung size:" + str(left_lung_size))
             print("new right lung size:" + str(right_lung_size))
             return left_lung_mask, right_lung_mask, total_anomly_slice_number
-        else:
-            print("the anomaly point is not real, start separate overlapping")
-            left_lung_mask, right_lung_mask = find_best_iter_and_masks(post_pred_mask)
-            return left_lung_mask, right_lung_mask, total_anomly_slice_number
-
-    print("overlap detected, start erosion and dilation")
+        print("the anomaly point is not real, start separate overlapping")
+    else:
+        print("overlap detected, start erosion and dilation")
     left_lung_mask, right_lung_mask = find_best_iter_and_masks(post_pred_mask)
 
     return left_lung_mask, right_lung_mask, total_anomly_slice_number
@@ -1194,19 +1206,11 @@ def threshold_organ(data, args, organ=None, threshold=None):
         THRESHOLD_DIC[organ] = threshold
     for key, value in THRESHOLD_DIC.items():
         threshold_list.append(value)
-    if args.cpu:
-        threshold_list = (
-            torch.tensor(threshold_list)
-            .repeat(B, 1)
-            .reshape(B, len(threshold_list), 1, 1, 1)
-        )
-    else:
-        threshold_list = (
-            torch.tensor(threshold_list)
-            .repeat(B, 1)
-            .reshape(B, len(threshold_list), 1, 1, 1)
-            .cuda()
-        )
+    threshold_list = (
+        torch.tensor(threshold_list, device=data.device)
+        .repeat(B, 1)
+        .reshape(B, len(threshold_list), 1, 1, 1)
+    )
     pred_hard = data > threshold_list
     return pred_hard
 
@@ -1290,8 +1294,8 @@ def visualize_label(batch, save_dir, input_transform):
 
 def merge_label(pred_bmask, name):
     B, C, W, H, D = pred_bmask.shape
-    merged_label_v1 = torch.zeros(B, 1, W, H, D).cuda()
-    merged_label_v2 = torch.zeros(B, 1, W, H, D).cuda()
+    merged_label_v1 = torch.zeros(B, 1, W, H, D, device=pred_bmask.device)
+    merged_label_v2 = torch.zeros(B, 1, W, H, D, device=pred_bmask.device)
     for b in range(B):
         template_key = get_key(name[b])
         transfer_mapping_v1 = MERGE_MAPPING_v1[template_key]
@@ -1309,10 +1313,7 @@ def merge_label(pred_bmask, name):
 
 def pseudo_label_all_organ(pred_bmask, args):
     B, C, W, H, D = pred_bmask.shape
-    if args.cpu:
-        pseudo_label = torch.zeros(B, 1, W, H, D)
-    else:
-        pseudo_label = torch.zeros(B, 1, W, H, D).cuda()
+    pseudo_label = torch.zeros(B, 1, W, H, D, device=pred_bmask.device)
     for b in range(B):
         template_key = "all"
         pseudo_label_mapping = PSEUDO_LABEL_ALL[template_key]
@@ -1324,10 +1325,7 @@ def pseudo_label_all_organ(pred_bmask, args):
 
 def pseudo_label_single_organ(pred_bmask, organ_index, args):
     B, C, W, H, D = pred_bmask.shape
-    if args.cpu:
-        pseudo_label_single_organ = torch.zeros(B, 1, W, H, D)
-    else:
-        pseudo_label_single_organ = torch.zeros(B, 1, W, H, D).cuda()
+    pseudo_label_single_organ = torch.zeros(B, 1, W, H, D, device=pred_bmask.device)
     for b in range(B):
         template_key = ORGAN_NAME[organ_index - 1]
         pseudo_label_single_organ_mapping = PSEUDO_LABEL_ALL[template_key]
@@ -1339,7 +1337,7 @@ def pseudo_label_single_organ(pred_bmask, organ_index, args):
 
 def create_entropy_map(pred, organ_index):
     B, C, W, H, D = pred.shape
-    entropy_map = torch.zeros(B, 1, W, H, D).cuda()
+    entropy_map = torch.zeros(B, 1, W, H, D, device=pred.device)
     for b in range(B):
         organ_soft_pred = pred[b, organ_index - 1]
         organ_uncertainty = torch.special.entr(organ_soft_pred)
@@ -1377,7 +1375,7 @@ def save_soft_pred(pred_soft, pred_hard_post, organ_index, args):
     struct2 = ndimage.generate_binary_structure(3, 3)
 
     B, C, W, H, D = pred_hard_post.shape
-    organ_pred_soft_save = torch.zeros(B, 1, W, H, D).cuda()
+    organ_pred_soft_save = torch.zeros(B, 1, W, H, D, device=pred_soft.device)
     for b in range(B):
         binary_mask = single_organ_binary_mask[b, 0]
         binary_mask_dilation = ndimage.binary_dilation(
@@ -26,6 +26,8 @@ class Universal_model(nn.Module):
         encoding (str, default='rand_embedding'): The type of organ encoding. Supports:
              * 'rand_embedding':  Randomly initialized organ embeddings.
              * 'word_embedding': Pre-trained text-based organ embeddings.
+        attn_backend (str, default='math'): Attention backend of the swinunetr backbone, 'math' or 'sdpa' (fused
+            scaled_dot_product_attention, requires torch>=2.0).
     """
 
     def __init__(
@@ -35,6 +37,7 @@ class Universal_model(nn.Module):
         out_channels,
         backbone="swinunetr",
         encoding="rand_embedding",
+        attn_backend="math",
     ):
         # encoding: rand_embedding or word_embedding
         super().__init__()
@@ -49,6 +52,7 @@ class Universal_model(nn.Module):
                 attn_drop_rate=0.0,
                 dropout_path_rate=0.0,
                 use_checkpoint=False,
+                attn_backend=attn_backend,
             )
             self.precls_conv = nn.Sequential(
                 nn.GroupNorm(16, 48),
@@ -1,3 +1,4 @@
+import warnings
 from typing import Sequence, Tuple, Type, Union
 
 import numpy as np
@@ -18,6 +19,13 @@ from torch.nn import LayerNorm
 
 rearrange, _ = optional_import("einops", name="rearrange")
 
+# the shifted window masks and the relative position bias only depend on the (padded) input shape and the weights, so
+# they are cached instead of being rebuilt for every forward pass (sliding window inference runs thousands of patches
+# of the same shape). Set to False to always recompute them
+CACHE_ATTENTION_CONSTANTS = True
+_MASK_CACHE_SIZE = 32
+_mask_cache = {}
+
 
 class SwinUNETR(nn.Module):
     """
@@ -40,6 +48,7 @@ class SwinUNETR(nn.Module):
         dropout_path_rate: float = 0.0,
         normalize: bool = True,
         use_checkpoint: bool = False,
+        attn_backend: str = "math",
         spatial_dims: int = 3,
         encoding: Union[
             Tuple, str
@@ -59,6 +68,8 @@ class SwinUNETR(nn.Module):
             dropout_path_rate: drop path rate.
             normalize: normalize output intermediate features in each stage.
             use_checkpoint: use gradient checkpointing for reduced memory usage.
+            attn_backend: "math" (explicit softmax(q @ k^T + bias) @ v) or "sdpa" (fused
+                torch.nn.functional.scaled_dot_product_attention, requires torch>=2.0).
             spatial_dims: number of spatial dims.
         Examples::
             # for 3D single channel input with size (96,96,96), 4-channel output and feature size of 48.
@@ -100,6 +111,9 @@ class SwinUNETR(nn.Module):
         if feature_size % 12 != 0:
             raise ValueError("feature_size should be divisible by 12.")
 
+        if attn_backend not in ("math", "sdpa"):
+            raise ValueError("attn_backend should be 'math' or 'sdpa'.")
+
         self.normalize = normalize
 
         self.swinViT = SwinTransformer(
@@ -116,6 +130,7 @@ class SwinUNETR(nn.Module):
             drop_path_rate=dropout_path_rate,
             norm_layer=nn.LayerNorm,
             use_checkpoint=use_checkpoint,
+            attn_backend=attn_backend,
             spatial_dims=spatial_dims,
         )
 
@@ -419,6 +434,7 @@ class WindowAttention(nn.Module):
         qkv_bias: bool = False,
         attn_drop: float = 0.0,
         proj_drop: float = 0.0,
+        attn_backend: str = "math",
     ) -> None:
         """
         Args:
@@ -428,6 +444,8 @@ class WindowAttention(nn.Module):
             qkv_bias: add a learnable bias to query, key, value.
             attn_drop: attention dropout rate.
             proj_drop: dropout rate of output.
+            attn_backend: "math" (explicit softmax(q @ k^T + bias) @ v) or "sdpa" (fused
+                torch.nn.functional.scaled_dot_product_attention, requires torch>=2.0).
         """
 
         super().__init__()
@@ -493,6 +511,46 @@ class WindowAttention(nn.Module):
         self.proj_drop = nn.Dropout(proj_drop)
         trunc_normal_(self.relative_position_bias_table, std=0.02)
         self.softmax = nn.Softmax(dim=-1)
+        self._bias_cache = None
+        self._bias_cache_key = None
+        if attn_backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+            warnings.warn(
+                "scaled_dot_product_attention requires torch>=2.0, falling back to the"
+                " math attention backend."
+            )
+            attn_backend = "math"
+        self.attn_backend = attn_backend
+
+    def _compute_relative_position_bias(self, n):
+        relative_position_bias = self.relative_position_bias_table[
+            self.relative_position_index.clone()[:n, :n].reshape(-1)
+        ].reshape(n, n, -1)
+        return relative_position_bias.permute(2, 0, 1).contiguous()
+
+    def get_relative_position_bias(self, n):
+        """Returns the (num_heads, n, n) relative position bias. In eval mode without autograd the gathered tensor is
+        cached and only recomputed when the bias table or the index is updated in place (load_state_dict, load_from),
+        replaced, or moved to another device/dtype.
+        Args:
+            n: number of tokens per window.
+        """
+        if self.training or torch.is_grad_enabled() or not CACHE_ATTENTION_CONSTANTS:
+            return self._compute_relative_position_bias(n)
+        table = self.relative_position_bias_table
+        index = self.relative_position_index
+        key = (
+            n,
+            table.data_ptr(),
+            table._version,
+            index.data_ptr(),
+            index._version,
+            table.device,
+            table.dtype,
+        )
+        if self._bias_cache_key != key:
+            self._bias_cache = self._compute_relative_position_bias(n)
+            self._bias_cache_key = key
+        return self._bias_cache
 
     def forward(self, x, mask):
         b, n, c = x.shape
@@ -502,12 +560,11 @@ class WindowAttention(nn.Module):
             .permute(2, 0, 3, 1, 4)
         )
         q, k, v = qkv[0], qkv[1], qkv[2]
+        relative_position_bias = self.get_relative_position_bias(n)
+        if self.attn_backend == "sdpa":
+            return self._forward_sdpa(q, k, v, relative_position_bias, mask)
         q = q * self.scale
         attn = q @ k.transpose(-2, -1)
-        relative_position_bias = self.relative_position_bias_table[
-            self.relative_position_index.clone()[:n, :n].reshape(-1)
-        ].reshape(n, n, -1)
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()
         attn = attn + relative_position_bias.unsqueeze(0)
         if mask is not None:
             nw = mask.shape[0]
@@ -525,6 +582,30 @@ class WindowAttention(nn.Module):
         x = self.proj_drop(x)
         return x
 
+    def _forward_sdpa(self, q, k, v, relative_position_bias, mask):
+        # bias and shifted window mask are added up and passed as attn_mask, so the (windows, heads, n, n) attention
+        # matrix is never materialized outside the fused kernel. The windows of one image are folded into the head
+        # dimension, this way the (nw, heads, n, n) mask broadcasts over the batch without being repeated
+        b, _, n, head_dim = q.shape
+        attn_bias = relative_position_bias.unsqueeze(0)
+        if mask is not None:
+            nw = mask.shape[0]
+            attn_bias = (attn_bias + mask.unsqueeze(1)).reshape(1, -1, n, n)
+            q, k, v = [
+                t.reshape(b // nw, nw * self.num_heads, n, head_dim) for t in (q, k, v)
+            ]
+        x = F.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=attn_bias.to(q.dtype),
+            dropout_p=self.attn_drop.p if self.training else 0.0,
+        )
+        x = x.reshape(b, self.num_heads, n, head_dim).transpose(1, 2).reshape(b, n, -1)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
 
 class SwinTransformerBlock(nn.Module):
     """
@@ -548,6 +629,7 @@ class SwinTransformerBlock(nn.Module):
         act_layer: str = "GELU",
         norm_layer: Type[LayerNorm] = nn.LayerNorm,  # type: ignore
         use_checkpoint: bool = False,
+        attn_backend: str = "math",
     ) -> None:
         """
         Args:
@@ -563,6 +645,8 @@ class SwinTransformerBlock(nn.Module):
             act_layer: activation layer.
             norm_layer: normalization layer.
             use_checkpoint: use gradient checkpointing for reduced memory usage.
+            attn_backend: "math" (explicit softmax(q @ k^T + bias) @ v) or "sdpa" (fused
+                torch.nn.functional.scaled_dot_product_attention, requires torch>=2.0).
         """
 
         super().__init__()
@@ -580,6 +664,7 @@ class SwinTransformerBlock(nn.Module):
             qkv_bias=qkv_bias,
             attn_drop=attn_drop,
             proj_drop=drop,
+            attn_backend=attn_backend,
         )
 
         self.drop_path = DropPath(drop_path) if drop_path > 0.0 else nn.Identity()
@@ -781,7 +866,7 @@ class PatchMerging(nn.Module):
         return x
 
 
-def compute_mask(dims, window_size, shift_size, device):
+def compute_mask(dims, window_size, shift_size, device, dtype=torch.float32):
     """Computing region masks based on: "Liu et al.,
     Swin Transformer: Hierarchical Vision Transformer using Shifted Windows
     <https://arxiv.org/abs/2103.14030>"
@@ -791,13 +876,14 @@ def compute_mask(dims, window_size, shift_size, device):
         window_size: local window size.
         shift_size: shift size.
         device: device.
+        dtype: dtype of the mask.
     """
 
     cnt = 0
 
     if len(dims) == 3:
         d, h, w = dims
-        img_mask = torch.zeros((1, d, h, w, 1), device=device)
+        img_mask = torch.zeros((1, d, h, w, 1), device=device, dtype=dtype)
         for d in (
             slice(-window_size[0]),
             slice(-window_size[0], -shift_size[0]),
@@ -818,7 +904,7 @@ def compute_mask(dims, window_size, shift_size, device):
 
     elif len(dims) == 2:
         h, w = dims
-        img_mask = torch.zeros((1, h, w, 1), device=device)
+        img_mask = torch.zeros((1, h, w, 1), device=device, dtype=dtype)
         for h in (
             slice(-window_size[0]),
             slice(-window_size[0], -shift_size[0]),
@@ -842,6 +928,35 @@ def compute_mask(dims, window_size, shift_size, device):
     return attn_mask
 
 
+def get_cached_mask(dims, window_size, shift_size, device, dtype=torch.float32):
+    """Same as compute_mask, but every mask is only computed once per (padded shape, window size, shift size, device,
+    dtype). The returned tensor is shared between all callers and must not be modified in place.
+     Args:
+        dims: dimension values.
+        window_size: local window size.
+        shift_size: shift size.
+        device: device.
+        dtype: dtype of the mask.
+    """
+
+    if not CACHE_ATTENTION_CONSTANTS:
+        return compute_mask(dims, window_size, shift_size, device, dtype)
+    key = (
+        tuple(dims),
+        tuple(window_size),
+        tuple(shift_size),
+        torch.device(device),
+        dtype,
+    )
+    attn_mask = _mask_cache.get(key)
+    if attn_mask is None:
+        if len(_mask_cache) >= _MASK_CACHE_SIZE:
+            _mask_cache.clear()
+        attn_mask = compute_mask(dims, window_size, shift_size, device, dtype)
+        _mask_cache[key] = attn_mask
+    return attn_mask
+
+
 class BasicLayer(nn.Module):
     """
     Basic Swin Transformer layer in one stage based on: "Liu et al.,
@@ -864,6 +979,7 @@ class BasicLayer(nn.Module):
         norm_layer: Type[LayerNorm] = nn.LayerNorm,  # type: ignore
         downsample: isinstance = None,  # type: ignore
         use_checkpoint: bool = False,
+        attn_backend: str = "math",
     ) -> None:
         """
         Args:
@@ -879,6 +995,8 @@ class BasicLayer(nn.Module):
             norm_layer: normalization layer.
             downsample: downsample layer at the end of the layer.
             use_checkpoint: use gradient checkpointing for reduced memory usage.
+            attn_backend: "math" (explicit softmax(q @ k^T + bias) @ v) or "sdpa" (fused
+                torch.nn.functional.scaled_dot_product_attention, requires torch>=2.0).
         """
 
         super().__init__()
@@ -903,6 +1021,7 @@ class BasicLayer(nn.Module):
                     ),
                     norm_layer=norm_layer,
                     use_checkpoint=use_checkpoint,
+                    attn_backend=attn_backend,
                 )
                 for i in range(depth)
             ]
@@ -924,7 +1043,9 @@ class BasicLayer(nn.Module):
             dp = int(np.ceil(d / window_size[0])) * window_size[0]
             hp = int(np.ceil(h / window_size[1])) * window_size[1]
             wp = int(np.ceil(w / window_size[2])) * window_size[2]
-            attn_mask = compute_mask([dp, hp, wp], window_size, shift_size, x.device)
+            attn_mask = get_cached_mask(
+                [dp, hp, wp], window_size, shift_size, x.device, x.dtype
+            )
             for blk in self.blocks:
                 x = blk(x, attn_mask)
             x = x.view(b, d, h, w, -1)
@@ -940,7 +1061,9 @@ class BasicLayer(nn.Module):
             x = rearrange(x, "b c h w -> b h w c")
             hp = int(np.ceil(h / window_size[0])) * window_size[0]
             wp = int(np.ceil(w / window_size[1])) * window_size[1]
-            attn_mask = compute_mask([hp, wp], window_size, shift_size, x.device)
+            attn_mask = get_cached_mask(
+                [hp, wp], window_size, shift_size, x.device, x.dtype
+            )
             for blk in self.blocks:
                 x = blk(x, attn_mask)
             x = x.view(b, h, w, -1)
@@ -974,6 +1097,7 @@ class SwinTransformer(nn.Module):
         norm_layer: Type[LayerNorm] = nn.LayerNorm,  # type: ignore
         patch_norm: bool = False,
         use_checkpoint: bool = False,
+        attn_backend: str = "math",
         spatial_dims: int = 3,
     ) -> None:
         """
@@ -992,6 +1116,8 @@ class SwinTransformer(nn.Module):
             norm_layer: normalization layer.
             patch_norm: add normalization after patch embedding.
             use_checkpoint: use gradient checkpointing for reduced memory usage.
+            attn_backend: "math" (explicit softmax(q @ k^T + bias) @ v) or "sdpa" (fused
+                torch.nn.functional.scaled_dot_product_attention, requires torch>=2.0).
             spatial_dims: spatial dimension.
         """
 
@@ -1028,6 +1154,7 @@ class SwinTransformer(nn.Module):
                 norm_layer=norm_layer,
                 downsample=PatchMerging,
                 use_checkpoint=use_checkpoint,
+                attn_backend=attn_backend,
             )
             if i_layer == 0:
                 self.layers1.append(layer)
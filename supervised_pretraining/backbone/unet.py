@@ -1,9 +1,15 @@
+import copy
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 
 class ContBatchNorm3d(nn.modules.batchnorm._BatchNorm):
+    # the batch statistics are used in train and in eval mode, this is how the released models were trained and
+    # evaluated. Set to True (see set_frozen_stats) to normalize with the running statistics instead
+    use_running_stats = False
+
     def _check_input_dim(self, input):
         if input.dim() != 5:
             raise ValueError("expected 5D input (got {}D input)".format(input.dim()))
@@ -11,14 +17,19 @@ class ContBatchNorm3d(nn.modules.batchnorm._BatchNorm):
 
     def forward(self, input):
         self._check_input_dim(input)
+        exponential_average_factor = self.momentum
+        if self.momentum is None and not self.use_running_stats:
+            # cumulative moving average, used by calibrate_running_stats
+            self.num_batches_tracked.add_(1)
+            exponential_average_factor = 1.0 / float(self.num_batches_tracked)
         return F.batch_norm(
             input,
             self.running_mean,
             self.running_var,
             self.weight,
             self.bias,
-            True,
-            self.momentum,
+            not self.use_running_stats,
+            exponential_average_factor,
             self.eps,
         )
 
@@ -141,3 +152,79 @@ class UNet3D(nn.Module):
         # self.out = self.out_tr(self.out_up_64)
 
         return self.out512, self.out_up_64
+
+
+def set_frozen_stats(model, frozen=True):
+    """
+    switches all ContBatchNorm3d layers in model between batch statistics (frozen=False, default) and running
+    statistics (frozen=True). With running statistics the prediction of a patch no longer depends on the content of the
+    patch, the running statistics are not updated by inference anymore and the normalization can be folded into the
+    preceding convolution (see fuse_for_inference)
+    """
+    for m in model.modules():
+        if isinstance(m, ContBatchNorm3d):
+            m.use_running_stats = frozen
+    return model
+
+
+@torch.no_grad()
+def calibrate_running_stats(model, patches):
+    """
+    replaces the running statistics of all ContBatchNorm3d layers in model by the average of the batch statistics
+    over patches. Use this if the running statistics of a checkpoint do not match the data (they are updated with
+    momentum during training, and by every forward pass in batch statistics mode)
+    :param model:
+    :param patches: iterable of (b, c, x, y, z) tensors on the device of model
+    """
+    bns = [m for m in model.modules() if isinstance(m, ContBatchNorm3d)]
+    old_settings = [(m.momentum, m.use_running_stats) for m in bns]
+    for m in bns:
+        m.reset_running_stats()
+        m.momentum = None
+        m.use_running_stats = False
+    num_patches = 0
+    for x in patches:
+        model(x)
+        num_patches += 1
+    assert num_patches > 0, "need at least one patch for calibration"
+    for m, (momentum, use_running_stats) in zip(bns, old_settings):
+        m.momentum = momentum
+        m.use_running_stats = use_running_stats
+    return model
+
+
+@torch.no_grad()
+def fold_conv_bn(conv, bn):
+    """
+    returns a Conv3d that computes bn(conv(x)) with the running statistics of bn
+    """
+    fused = nn.Conv3d(
+        conv.in_channels,
+        conv.out_channels,
+        conv.kernel_size,
+        stride=conv.stride,
+        padding=conv.padding,
+        dilation=conv.dilation,
+        groups=conv.groups,
+        bias=True,
+        padding_mode=conv.padding_mode,
+    ).to(device=conv.weight.device, dtype=conv.weight.dtype)
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    fused.weight.copy_(conv.weight * scale.reshape(-1, 1, 1, 1, 1))
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+
+def fuse_for_inference(model, inplace=False):
+    """
+    folds the ContBatchNorm3d of every LUConv in model into its convolution. This uses the running statistics, so the
+    result equals set_frozen_stats(model) but saves one pass over every feature map. Inference only
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    for m in model.modules():
+        if isinstance(m, LUConv) and isinstance(m.bn1, ContBatchNorm3d):
+            m.conv1 = fold_conv_bn(m.conv1, m.bn1)
+            m.bn1 = nn.Identity()
+    return model
@@ -21,6 +21,7 @@ from monai.transforms import (
 
 sys.path.append("..")
 
+from dataset.h5_store import LoadCaseH5d
 from monai.config import DtypeLike, KeysCollection
 from monai.data import (
     CacheDataset,
@@ -201,12 +202,31 @@ def get_loader(args):
         args: Command line arguments containing dataset paths and hyperparameters.
     """
 
-    train_transforms = Compose(
-        [
+    if args.data_format == "h5":
+        load_transforms = [
+            LoadCaseH5d(
+                keys=["image", "label"],
+                class_names=list(abdomenatlas_set[args.dataset_version].values()),
+                roi_size=(
+                    (args.roi_x, args.roi_y, args.roi_z)
+                    if args.h5_crop_scale > 0
+                    else None
+                ),
+                pixdim=(args.space_x, args.space_y, args.space_z),
+                crop_scale=args.h5_crop_scale,
+            ),  # image and organ masks from one h5 file, only the crop region
+        ]
+    else:
+        load_transforms = [
             LoadSelectedImaged(
                 keys=["image"], dataset_version=args.dataset_version
             ),  # custom data loading
             AddChanneld(keys=["image"]),  # ensure a channel dimension
+        ]
+
+    train_transforms = Compose(
+        load_transforms
+        + [
             Orientationd(
                 keys=["image", "label"], axcodes="RAS"
             ),  # standardize orientation
@@ -263,7 +283,10 @@ def get_loader(args):
     for item in args.dataset_list:
         for line in open(os.path.join(args.data_txt_path, item + ".txt")):
             name = line.strip().split("\t")[0]
-            train_img_path = os.path.join(args.data_root_path, name, "ct.nii.gz")
+            if args.data_format == "h5":
+                train_img_path = os.path.join(args.data_root_path, name + ".h5")
+            else:
+                train_img_path = os.path.join(args.data_root_path, name, "ct.nii.gz")
             folder_name = os.path.join(args.data_root_path, name, "segmentations/")
             train_img.append(train_img_path)
             train_lbl_parents.append(folder_name)
@@ -17,6 +17,7 @@ from tensorboardX import SummaryWriter
 from torch.nn.parallel import DistributedDataParallel
 
 from utils import loss
+from utils.memory_planner import configure_activation_checkpointing
 
 torch.multiprocessing.set_sharing_strategy("file_system")
 
@@ -113,6 +114,7 @@ def process(args):
             out_channels=args.num_class,
             backbone=args.backbone,
             encoding=args.trans_encoding,
+            attn_backend=args.attn_backend,
         )
 
     # load pre-trained weights
@@ -127,6 +129,12 @@ def process(args):
                 model.organ_embedding.data = word_embedding.float()
                 print("load word embedding")
 
+    configure_activation_checkpointing(
+        model,
+        args,
+        output_file=os.path.join("out", args.log_name, "memory_plan.json"),
+        verbose=rank == 0,
+    )
     model.to(args.device)
     model.train()
 
@@ -293,6 +301,27 @@ def main():
     parser.add_argument(
         "--backbone", default="unet", help="model backbone, unet backbone by default"
     )
+    parser.add_argument(
+        "--attn_backend",
+        default="math",
+        help=(
+            "attention backend of swinunetr: math or sdpa (fused, requires torch>=2.0)"
+        ),
+    )
+    parser.add_argument(
+        "--memory_budget",
+        default=None,
+        type=float,
+        help=(
+            "target peak gpu memory in GB. Selects the blocks to checkpoint"
+            " (recompute in the backward pass) after a dry run on the cpu"
+        ),
+    )
+    parser.add_argument(
+        "--memory_plan",
+        default=None,
+        help="reuse a memory_plan.json written by --memory_budget",
+    )
     parser.add_argument(
         "--segresnet_init_filters",
         default=16,
@@ -363,6 +392,24 @@ def main():
         default="AbdomenAtlas1.1",
         help="dataset version for AbdomenAtlas, 1.1 by default",
     )
+    parser.add_argument(
+        "--data_format",
+        default="nifti",
+        choices=["nifti", "h5"],
+        help=(
+            "nifti: case/ct.nii.gz and case/segmentations/*.nii.gz, h5: case.h5"
+            " written by utils/convert_to_h5.py"
+        ),
+    )
+    parser.add_argument(
+        "--h5_crop_scale",
+        default=1.5,
+        type=float,
+        help=(
+            "h5 only. read a region of this many rois around the crop center instead"
+            " of the whole case, 0 reads the whole case"
+        ),
+    )
 
     args = parser.parse_args()
 
@@ -0,0 +1,422 @@
+import copy
+import functools
+import inspect
+import json
+import os
+
+import torch
+import torch.utils.checkpoint as checkpoint
+
+# blocks whose activations can be recomputed in the backward pass. Blocks are searched from the root of the model and
+# a matching block is not searched further, e.g. the Convolution layers inside an UnetrBasicBlock are not candidates
+CHECKPOINT_BLOCKS = (
+    # SwinUNETR, SMIT
+    "SwinTransformerBlock",
+    "UnetrBasicBlock",
+    "UnetrUpBlock",
+    "UnetrBasicBlock_No_DownSampling",
+    "UnetResBlock_No_Downsampleing",
+    # UNet3D
+    "DownTransition",
+    "UpTransition",
+    # DiNTS
+    "Cell",
+    "StemTS",
+    # MiT
+    "Block",
+    # MONAI SegResNet and UNet
+    "ResBlock",
+    "ResidualUnit",
+    "Convolution",
+)
+# parameter, gradient and the two moments of AdamW
+OPTIMIZER_COPIES = 4
+GB = 1024**3
+
+
+def _storage(t):
+    return t.untyped_storage() if hasattr(t, "untyped_storage") else t.storage()
+
+
+def _storage_nbytes(t):
+    storage = _storage(t)
+    if hasattr(storage, "nbytes"):
+        return storage.nbytes()
+    return storage.size() * t.element_size()
+
+
+def _tensor_nbytes(values):
+    return sum(
+        [v.numel() * v.element_size() for v in values if isinstance(v, torch.Tensor)]
+    )
+
+
+def find_checkpoint_blocks(model, block_names=CHECKPOINT_BLOCKS):
+    """
+    :return: [(qualified name, module)] of the outermost blocks of model whose class name is in block_names
+    """
+    blocks = []
+
+    def visit(module, prefix):
+        for name, child in module.named_children():
+            if type(child).__name__ in block_names:
+                blocks.append((prefix + name, child))
+            else:
+                visit(child, prefix + name + ".")
+
+    visit(model, "")
+    return blocks
+
+
+def _checkpointed_forward(module, *args, **kwargs):
+    forward = type(module).forward
+    if not torch.is_grad_enabled():
+        return forward(module, *args, **kwargs)
+    if len(kwargs) > 0:
+        # torch.utils.checkpoint only tracks positional tensors
+        bound = inspect.signature(forward).bind(module, *args, **kwargs)
+        args, kwargs = bound.args[1:], bound.kwargs
+    return checkpoint.checkpoint(
+        functools.partial(forward, module, **kwargs), *args, use_reentrant=False
+    )
+
+
+def set_checkpoint(module, enabled=True):
+    """
+    recomputes the activations of module in the backward pass instead of storing them. The forward method is replaced
+    on the instance, so the state dict keys do not change and direct module.forward(...) calls (DiNTS) are covered.
+    Batch norm layers in a checkpointed block update their running statistics twice per step
+    """
+    if enabled:
+        module.forward = functools.partial(_checkpointed_forward, module)
+    else:
+        module.__dict__.pop("forward", None)
+    return module
+
+
+class _SavedTensorRecorder:
+    """
+    attributes the tensors autograd saves for the backward pass to the innermost running candidate block
+    """
+
+    def __init__(self, model):
+        self.stack = []
+        self.order = []
+        self.saved = {}
+        self.inputs = {}
+        self.seen = set([_storage(p).data_ptr() for p in model.parameters()])
+
+    def pack(self, t):
+        try:
+            key = _storage(t).data_ptr()
+        except (RuntimeError, NotImplementedError):
+            return t
+        if key not in self.seen:
+            self.seen.add(key)
+            owner = self.stack[-1] if len(self.stack) > 0 else None
+            self.saved[owner] = self.saved.get(owner, 0) + _storage_nbytes(t)
+        # returning t itself would keep saved outputs alive through their own grad_fn (reference cycle)
+        return t.detach()
+
+    def probe(self, forward, name, *args, **kwargs):
+        if name not in self.inputs:
+            self.order.append(name)
+        self.inputs[name] = self.inputs.get(name, 0) + _tensor_nbytes(
+            list(args) + list(kwargs.values())
+        )
+        self.stack.append(name)
+        try:
+            return forward(*args, **kwargs)
+        finally:
+            self.stack.pop()
+
+
+def _run_recorded(model, blocks, x, backward=False):
+    recorder = _SavedTensorRecorder(model)
+    patched = []
+    for name, module in blocks:
+        # checkpointed blocks keep their checkpointed forward
+        forward = module.__dict__.get("forward")
+        patched.append((module, forward))
+        if forward is None:
+            forward = functools.partial(type(module).forward, module)
+        module.forward = functools.partial(recorder.probe, forward, name)
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(recorder.pack, lambda t: t):
+            out = model(x)
+        if backward:
+            outputs = out if isinstance(out, (tuple, list)) else [out]
+            sum([o.float().mean() for o in outputs if o.requires_grad]).backward()
+            model.zero_grad(set_to_none=True)
+    finally:
+        for module, forward in patched:
+            module.__dict__.pop("forward", None)
+            if forward is not None:
+                module.forward = forward
+    return recorder
+
+
+def _read_cpu_peak():
+    # peak resident set size of this process in bytes (linux only)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_cpu_peak():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _activation_bytes(plan):
+    """
+    :return: (activations kept after the forward pass, peak activations) per sample. Blocks are in execution order,
+    a checkpointed block keeps its inputs and recomputes its activations during the backward pass, when the blocks
+    executed after it have already released theirs
+    """
+    kept = plan["other_bytes"] + sum(
+        [
+            b["input_bytes"] if b["checkpoint"] else b["saved_bytes"]
+            for b in plan["blocks"]
+        ]
+    )
+    peak = kept
+    prefix = plan["other_bytes"]
+    for block in plan["blocks"]:
+        if block["checkpoint"]:
+            prefix += block["input_bytes"]
+            peak = max(peak, prefix + block["saved_bytes"])
+        else:
+            prefix += block["saved_bytes"]
+    return kept, peak
+
+
+def estimate_peak_bytes(plan):
+    """
+    static memory (weights, gradients, AdamW moments) + peak activations of the batch (see _activation_bytes)
+    """
+    return plan["static_bytes"] + plan["input_shape"][0] * _activation_bytes(plan)[1]
+
+
+def plan_activation_checkpointing(
+    model, input_shape, memory_budget, block_names=CHECKPOINT_BLOCKS, validate=True
+):
+    """
+    selects the blocks of model to checkpoint so that one training step fits into memory_budget (GB).
+
+    A dry run of the forward pass on the cpu with batch size 1 records the bytes every candidate block (see
+    CHECKPOINT_BLOCKS) saves for the backward pass and the bytes of its inputs. Blocks are then checkpointed greedily,
+    largest saving first, until estimate_peak_bytes is within the budget. The estimate does not include the cuda
+    context, cudnn workspaces and allocator fragmentation, keep 1-2 GB of headroom in memory_budget.
+    With validate, a second dry run (plan applied) measures the activations that are actually kept and the peak
+    resident memory of the cpu process, see validate_checkpoint_plan.
+    The dry runs train a copy of model under a forked rng, the batch norm running statistics of model and the torch
+    rng are left as they were.
+
+    :param model: model on the cpu, in training mode
+    :param input_shape: (batch size, channels, x, y, z) of one training step
+    :return: plan (json serializable dict), apply it with apply_checkpoint_plan
+    """
+    blocks = find_checkpoint_blocks(model, block_names)
+    if len(blocks) == 0:
+        raise ValueError(
+            "%s has no checkpointable blocks (%s)"
+            % (type(model).__name__, ", ".join(block_names))
+        )
+    dry_model = copy.deepcopy(model)
+    with torch.random.fork_rng(devices=[]):
+        x = torch.rand((1,) + tuple(input_shape[1:]))
+        recorder = _run_recorded(
+            dry_model, find_checkpoint_blocks(dry_model, block_names), x
+        )
+    # execution order, blocks that did not run go last
+    names = recorder.order + [n for n, _ in blocks if n not in recorder.inputs]
+    types = dict([(n, type(m).__name__) for n, m in blocks])
+
+    plan = {
+        "model": type(model).__name__,
+        "input_shape": list(input_shape),
+        "memory_budget_gb": memory_budget,
+        "static_bytes": OPTIMIZER_COPIES
+        * sum([p.numel() * p.element_size() for p in model.parameters()]),
+        "other_bytes": recorder.saved.get(None, 0),
+        "blocks": [
+            {
+                "name": name,
+                "type": types[name],
+                "saved_bytes": recorder.saved.get(name, 0),
+                "input_bytes": recorder.inputs.get(name, 0),
+                "checkpoint": False,
+            }
+            for name in names
+        ],
+    }
+    budget = memory_budget * GB
+    for block in sorted(
+        plan["blocks"], key=lambda b: b["input_bytes"] - b["saved_bytes"]
+    ):
+        before = estimate_peak_bytes(plan)
+        if before <= budget or block["saved_bytes"] <= block["input_bytes"]:
+            break
+        block["checkpoint"] = True
+        if estimate_peak_bytes(plan) >= before:
+            block["checkpoint"] = False
+    plan["estimated_peak_bytes"] = estimate_peak_bytes(plan)
+    plan["fits"] = plan["estimated_peak_bytes"] <= budget
+
+    if validate:
+        plan["validation"] = _validate_checkpoint_plan(dry_model, plan, block_names)
+    return plan
+
+
+def apply_checkpoint_plan(model, plan, block_names=CHECKPOINT_BLOCKS):
+    """
+    enables checkpointing on the blocks selected in plan (and disables it on the other candidates)
+    """
+    blocks = dict(find_checkpoint_blocks(model, block_names))
+    for block in plan["blocks"]:
+        if block["name"] not in blocks:
+            raise ValueError(
+                "block %s of the plan does not exist in %s"
+                % (block["name"], type(model).__name__)
+            )
+        set_checkpoint(blocks[block["name"]], block["checkpoint"])
+    return model
+
+
+def validate_checkpoint_plan(
+    model, plan, block_names=CHECKPOINT_BLOCKS, backward=False
+):
+    """
+    forward pass (+ backward pass) on the cpu (batch size 1) with plan applied, checkpointing is disabled again
+    afterwards. Checkpointed blocks keep their inputs, which are added to the recorded activations of the other blocks.
+    The cpu peak of the forward pass is about the kept activations. With backward it includes the recomputation, but
+    the dry run then needs about as much ram as the training step needs gpu memory. As plan_activation_checkpointing,
+    it runs on a copy of model under a forked rng
+    """
+    return _validate_checkpoint_plan(copy.deepcopy(model), plan, block_names, backward)
+
+
+def _validate_checkpoint_plan(dry_model, plan, block_names, backward=False):
+    blocks = find_checkpoint_blocks(dry_model, block_names)
+    apply_checkpoint_plan(dry_model, plan, block_names)
+    reset = _reset_cpu_peak()
+    base = _read_cpu_peak()
+    try:
+        with torch.random.fork_rng(devices=[]):
+            x = torch.rand((1,) + tuple(plan["input_shape"][1:]))
+            recorder = _run_recorded(dry_model, blocks, x, backward=backward)
+    finally:
+        for _, module in blocks:
+            set_checkpoint(module, False)
+    peak = _read_cpu_peak()
+    kept = sum(recorder.saved.values())
+    kept += sum([b["input_bytes"] for b in plan["blocks"] if b["checkpoint"]])
+    return {
+        "kept_activation_bytes": kept,
+        "estimated_activation_bytes": _activation_bytes(plan)[0],
+        "cpu_peak_bytes": peak - base if reset and base is not None else None,
+    }
+
+
+def log_checkpoint_plan(plan, output_file=None):
+    checkpointed = [b for b in plan["blocks"] if b["checkpoint"]]
+    print(
+        "activation checkpointing: %d of %d blocks of %s for input %s, budget %.1f GB"
+        % (
+            len(checkpointed),
+            len(plan["blocks"]),
+            plan["model"],
+            "x".join([str(s) for s in plan["input_shape"]]),
+            plan["memory_budget_gb"],
+        )
+    )
+    print(
+        "  not checkpointable (outside the candidate blocks): %.1f MB/sample"
+        % (plan["other_bytes"] / 1024**2)
+    )
+    for block in checkpointed:
+        print(
+            "  %-50s %-24s saves %7.1f MB/sample"
+            % (
+                block["name"],
+                block["type"],
+                (block["saved_bytes"] - block["input_bytes"]) / 1024**2,
+            )
+        )
+    print(
+        "estimated peak memory %.2f GB (%s)"
+        % (
+            plan["estimated_peak_bytes"] / GB,
+            "fits"
+            if plan["fits"]
+            else "does NOT fit, checkpointing more blocks does not lower it",
+        )
+    )
+    if "validation" in plan:
+        validation = plan["validation"]
+        print(
+            "dry run (batch 1): activations kept %.1f MB (estimated %.1f MB), cpu"
+            " peak %s"
+            % (
+                validation["kept_activation_bytes"] / 1024**2,
+                validation["estimated_activation_bytes"] / 1024**2,
+                "%.1f MB" % (validation["cpu_peak_bytes"] / 1024**2)
+                if validation["cpu_peak_bytes"] is not None
+                else "n/a",
+            )
+        )
+    if output_file is not None:
+        os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+        with open(output_file, "w") as f:
+            json.dump(plan, f, indent=2)
+
+
+def load_checkpoint_plan(plan_file):
+    with open(plan_file) as f:
+        return json.load(f)
+
+
+def configure_activation_checkpointing(model, args, output_file=None, verbose=True):
+    """
+    applies the memory options of the training scripts: --memory_plan (a plan saved by log_checkpoint_plan) or
+    --memory_budget (plan a new one for batch_size * num_samples patches of the roi). Call it on the cpu model, before
+    it is moved to the gpu and wrapped into DistributedDataParallel. In a distributed run only rank 0 plans, the
+    other ranks receive its plan
+    :return: the plan, None if neither option is set
+    """
+    if args.memory_plan is not None:
+        plan = load_checkpoint_plan(args.memory_plan)
+    elif args.memory_budget is not None:
+        distributed = torch.distributed.is_available() and (
+            torch.distributed.is_initialized()
+        )
+        plan = None
+        if not distributed or torch.distributed.get_rank() == 0:
+            input_shape = (
+                args.batch_size * args.num_samples,
+                1,
+                args.roi_x,
+                args.roi_y,
+                args.roi_z,
+            )
+            plan = plan_activation_checkpointing(model, input_shape, args.memory_budget)
+        if distributed:
+            objects = [plan]
+            torch.distributed.broadcast_object_list(objects, src=0)
+            plan = objects[0]
+    else:
+        return None
+    apply_checkpoint_plan(model, plan)
+    if verbose:
+        log_checkpoint_plan(plan, output_file)
+    return plan
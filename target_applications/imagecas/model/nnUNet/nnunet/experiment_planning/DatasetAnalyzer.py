@@ -19,6 +19,12 @@ from multiprocessing import Pool
 import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import *
 from nnunet.configuration import default_num_threads
+from nnunet.experiment_planning.dataset_fingerprint import (
+    QuantileSketch,
+    compute_case_fingerprint,
+    get_source_file,
+    is_fingerprint_valid,
+)
 from nnunet.paths import nnUNet_cropped_data, nnUNet_raw_data
 from nnunet.preprocessing.cropping import get_patient_identifiers_from_cropped_files
 from skimage.morphology import label
@@ -53,6 +59,44 @@ class DatasetAnalyzer(object):
         self.intensityproperties_file = join(
             self.folder_with_cropped_data, "intensityproperties.pkl"
         )
+        # one fingerprint per case. They are only recomputed if the cropped case changes, so rerunning the analysis
+        # after adding cases only needs to look at the new ones (even with overwrite=True)
+        self.fingerprints_folder = join(self.folder_with_cropped_data, "fingerprints")
+        self._fingerprints = None
+
+    def _load_or_compute_fingerprint(self, case_identifier):
+        fingerprint_file = join(self.fingerprints_folder, case_identifier + ".pkl")
+        source_file = get_source_file(self.folder_with_cropped_data, case_identifier)
+        if isfile(fingerprint_file):
+            fingerprint = load_pickle(fingerprint_file)
+            if is_fingerprint_valid(fingerprint, source_file):
+                return fingerprint, False
+        fingerprint = compute_case_fingerprint(
+            self.folder_with_cropped_data, case_identifier
+        )
+        save_pickle(fingerprint, fingerprint_file)
+        return fingerprint, True
+
+    def get_fingerprints(self):
+        """
+        returns an OrderedDict case_identifier -> fingerprint (see compute_case_fingerprint). Fingerprints are computed
+        in a process pool and stored per case, only new or changed cases are processed
+        """
+        if self._fingerprints is None:
+            maybe_mkdir_p(self.fingerprints_folder)
+            p = Pool(self.num_processes)
+            res = p.map(self._load_or_compute_fingerprint, self.patient_identifiers)
+            p.close()
+            p.join()
+            num_computed = sum([i[1] for i in res])
+            print(
+                "dataset fingerprints: %d computed, %d reused"
+                % (num_computed, len(res) - num_computed)
+            )
+            self._fingerprints = OrderedDict(
+                zip(self.patient_identifiers, [i[0] for i in res])
+            )
+        return self._fingerprints
 
     def load_properties_of_cropped(self, case_identifier):
         with open(
@@ -136,15 +180,15 @@ class DatasetAnalyzer(object):
         class_dct = self.get_classes()
 
         if self.overwrite or not isfile(self.props_per_case_file):
-            p = Pool(self.num_processes)
-            res = p.map(self._get_unique_labels, self.patient_identifiers)
-            p.close()
-            p.join()
+            fingerprints = self.get_fingerprints()
 
             props_per_patient = OrderedDict()
-            for p, unique_classes in zip(self.patient_identifiers, res):
+            for p in self.patient_identifiers:
                 props = dict()
-                props["has_classes"] = unique_classes
+                props["has_classes"] = np.array(
+                    list(fingerprints[p]["class_voxel_counts"].keys()),
+                    dtype=fingerprints[p]["seg_dtype"],
+                )
                 props_per_patient[p] = props
 
             save_pickle(props_per_patient, self.props_per_case_file)
@@ -188,6 +232,20 @@ class DatasetAnalyzer(object):
         voxels = list(modality[mask][::10])  # no need to take every voxel
         return voxels
 
+    @staticmethod
+    def _compute_stats_from_sketch(sketch):
+        if sketch.count == 0:
+            return np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan
+        return (
+            sketch.percentile(50),
+            sketch.mean(),
+            sketch.std(),
+            sketch.min,
+            sketch.max,
+            sketch.percentile(99.5),
+            sketch.percentile(00.5),
+        )
+
     @staticmethod
     def _compute_stats(voxels):
         if len(voxels) == 0:
@@ -203,22 +261,19 @@ class DatasetAnalyzer(object):
 
     def collect_intensity_properties(self, num_modalities):
         if self.overwrite or not isfile(self.intensityproperties_file):
-            p = Pool(self.num_processes)
+            fingerprints = self.get_fingerprints()
 
             results = OrderedDict()
             for mod_id in range(num_modalities):
                 results[mod_id] = OrderedDict()
-                v = p.starmap(
-                    self._get_voxels_in_foreground,
-                    zip(
-                        self.patient_identifiers,
-                        [mod_id] * len(self.patient_identifiers),
-                    ),
-                )
+                sketches = [
+                    fingerprints[i]["intensity_sketches"][mod_id]
+                    for i in self.patient_identifiers
+                ]
 
-                w = []
-                for iv in v:
-                    w += iv
+                merged = QuantileSketch()
+                for sk in sketches:
+                    merged.merge(sk)
 
                 (
                     median,
@@ -228,9 +283,9 @@ class DatasetAnalyzer(object):
                     mx,
                     percentile_99_5,
                     percentile_00_5,
-                ) = self._compute_stats(w)
+                ) = self._compute_stats_from_sketch(merged)
 
-                local_props = p.map(self._compute_stats, v)
+                local_props = [self._compute_stats_from_sketch(sk) for sk in sketches]
                 props_per_case = OrderedDict()
                 for i, pat in enumerate(self.patient_identifiers):
                     props_per_case[pat] = OrderedDict()
@@ -251,8 +306,6 @@ class DatasetAnalyzer(object):
                 results[mod_id]["percentile_99_5"] = percentile_99_5
                 results[mod_id]["percentile_00_5"] = percentile_00_5
 
-            p.close()
-            p.join()
             save_pickle(results, self.intensityproperties_file)
         else:
             results = load_pickle(self.intensityproperties_file)
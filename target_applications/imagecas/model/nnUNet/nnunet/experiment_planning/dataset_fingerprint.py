@@ -0,0 +1,182 @@
+#    Copyright 2020 Division of Medical Image Computing, German Cancer Research Center (DKFZ), Heidelberg, Germany
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from collections import OrderedDict
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import *
+
+# increase this whenever the content of the fingerprints changes. Fingerprints with another version are recomputed
+FINGERPRINT_VERSION = 1
+
+
+class QuantileSketch(object):
+    def __init__(self, relative_accuracy=0.005, min_abs_value=1e-8):
+        """
+        Mergeable quantile sketch with log spaced buckets (same idea as DDSketch). Every quantile is returned with a
+        relative error of at most relative_accuracy, no matter how many values were added. Sketches of different cases
+        can be merged by adding up the bucket counts, which is what makes incremental dataset analysis possible.
+        count, mean, sd, min and max are exact.
+        :param relative_accuracy:
+        :param min_abs_value: values with a smaller magnitude are counted as zero
+        """
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.min_abs_value = min_abs_value
+        self.positive = OrderedDict()
+        self.negative = OrderedDict()
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def _add_to_buckets(self, buckets, magnitudes):
+        if len(magnitudes) == 0:
+            return
+        idx = np.ceil(np.log(magnitudes) / np.log(self.gamma)).astype(np.int64)
+        offset = idx.min()
+        counts = np.bincount(idx - offset)
+        for i in np.nonzero(counts)[0]:
+            k = int(i + offset)
+            buckets[k] = buckets.get(k, 0) + int(counts[i])
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.sum_sq += float(np.square(values).sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        pos = values > self.min_abs_value
+        neg = values < -self.min_abs_value
+        self._add_to_buckets(self.positive, values[pos])
+        self._add_to_buckets(self.negative, -values[neg])
+        self.zero_count += int(len(values) - pos.sum() - neg.sum())
+        return self
+
+    def merge(self, other):
+        assert (
+            self.gamma == other.gamma
+        ), "can only merge sketches with the same accuracy"
+        for mine, theirs in (
+            (self.positive, other.positive),
+            (self.negative, other.negative),
+        ):
+            for k, v in theirs.items():
+                mine[k] = mine.get(k, 0) + v
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def _bucket_value(self, k):
+        return 2 * self.gamma**k / (self.gamma + 1)
+
+    def quantile(self, q):
+        """
+        :param q: in [0, 1]
+        """
+        if self.count == 0:
+            return np.nan
+        rank = q * (self.count - 1)
+        seen = 0
+        for k in sorted(self.negative.keys(), reverse=True):
+            seen += self.negative[k]
+            if seen > rank:
+                return float(np.clip(-self._bucket_value(k), self.min, self.max))
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for k in sorted(self.positive.keys()):
+            seen += self.positive[k]
+            if seen > rank:
+                return float(np.clip(self._bucket_value(k), self.min, self.max))
+        return self.max
+
+    def percentile(self, p):
+        return self.quantile(p / 100.0)
+
+    def mean(self):
+        if self.count == 0:
+            return np.nan
+        return self.sum / self.count
+
+    def std(self):
+        if self.count == 0:
+            return np.nan
+        return np.sqrt(max(self.sum_sq / self.count - self.mean() ** 2, 0))
+
+
+def get_source_file(folder_with_cropped_data, case_identifier):
+    # prefer the uncompressed copy of the cropper (ImageCropper(save_npy=True)) because it can be memory mapped
+    npy_file = join(folder_with_cropped_data, case_identifier + ".npy")
+    if isfile(npy_file):
+        return npy_file
+    return join(folder_with_cropped_data, case_identifier + ".npz")
+
+
+def is_fingerprint_valid(fingerprint, source_file):
+    return (
+        fingerprint.get("version") == FINGERPRINT_VERSION
+        and fingerprint.get("source_file") == os.path.basename(source_file)
+        and fingerprint.get("source_mtime") == os.path.getmtime(source_file)
+        and fingerprint.get("source_size") == os.path.getsize(source_file)
+    )
+
+
+def compute_case_fingerprint(folder_with_cropped_data, case_identifier):
+    """
+    everything DatasetAnalyzer needs to know about a case: spacing and shape, voxel counts per label and a quantile
+    sketch of the foreground intensities of each modality
+    """
+    source_file = get_source_file(folder_with_cropped_data, case_identifier)
+    if source_file.endswith(".npy"):
+        all_data = np.load(source_file, mmap_mode="r")
+    else:
+        all_data = np.load(source_file)["data"]
+    properties = load_pickle(join(folder_with_cropped_data, case_identifier + ".pkl"))
+
+    seg = np.asarray(all_data[-1])
+    seg_int = seg.astype(np.int64)
+    min_label = int(seg_int.min())
+    counts = np.bincount((seg_int - min_label).ravel())
+    class_voxel_counts = OrderedDict()
+    for i in np.nonzero(counts)[0]:
+        class_voxel_counts[int(i) + min_label] = int(counts[i])
+
+    foreground = seg > 0
+    intensity_sketches = []
+    for m in range(all_data.shape[0] - 1):
+        intensity_sketches.append(QuantileSketch().add(all_data[m][foreground]))
+
+    return {
+        "version": FINGERPRINT_VERSION,
+        "source_file": os.path.basename(source_file),
+        "source_mtime": os.path.getmtime(source_file),
+        "source_size": os.path.getsize(source_file),
+        "size_after_cropping": properties["size_after_cropping"],
+        "original_size_of_raw_data": properties["original_size_of_raw_data"],
+        "original_spacing": properties["original_spacing"],
+        "itk_spacing": properties["itk_spacing"],
+        "seg_dtype": seg.dtype,
+        "class_voxel_counts": class_voxel_counts,
+        "intensity_sketches": intensity_sketches,
+    }
@@ -13,19 +13,59 @@
 #    limitations under the License.
 
 
+import resource
 import shutil
 from copy import deepcopy
 from multiprocessing import Pool
 
 import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import *
-from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax
+from nnunet.inference.segmentation_export import (
+    save_segmentation_nifti_at_original_spacing,
+    save_segmentation_nifti_from_softmax,
+)
 from nnunet.postprocessing.connected_components import (
     apply_postprocessing_to_folder,
     load_postprocessing,
 )
 
 
+def get_regions_class_order(props, files):
+    reg_class_orders = [
+        p["regions_class_order"] if "regions_class_order" in p.keys() else None
+        for p in props
+    ]
+
+    if not all([i is None for i in reg_class_orders]):
+        # if reg_class_orders are not None then they must be the same in all pkls
+        tmp = reg_class_orders[0]
+        for r in reg_class_orders[1:]:
+            assert tmp == r, (
+                "If merging files with regions_class_order, the"
+                " regions_class_orders of all files must be the same."
+                " regions_class_order: %s, \n files: %s"
+                % (str(reg_class_orders), str(files))
+            )
+        return tmp
+    return None
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_softmax_member(npz_file):
+    """
+    if an uncompressed <case>.npy (for example from unpack_dataset(folder, key='softmax')) exists next to the npz, it
+    is memory mapped so that it can be read chunk by chunk. Otherwise the npz has to be decompressed as a whole
+    """
+    npy_file = npz_file[:-4] + ".npy"
+    if isfile(npy_file):
+        return np.load(npy_file, mmap_mode="r")
+    return np.load(npz_file)["softmax"]
+
+
 def merge_files(files, properties_files, out_file, override, store_npz):
     if override or not isfile(out_file):
         softmax = [np.load(f)["softmax"][None] for f in files]
@@ -33,24 +73,7 @@ def merge_files(files, properties_files, out_file, override, store_npz):
         softmax = np.mean(softmax, 0)
         props = [load_pickle(f) for f in properties_files]
 
-        reg_class_orders = [
-            p["regions_class_order"] if "regions_class_order" in p.keys() else None
-            for p in props
-        ]
-
-        if not all([i is None for i in reg_class_orders]):
-            # if reg_class_orders are not None then they must be the same in all pkls
-            tmp = reg_class_orders[0]
-            for r in reg_class_orders[1:]:
-                assert tmp == r, (
-                    "If merging files with regions_class_order, the"
-                    " regions_class_orders of all files must be the same."
-                    " regions_class_order: %s, \n files: %s"
-                    % (str(reg_class_orders), str(files))
-                )
-            regions_class_order = tmp
-        else:
-            regions_class_order = None
+        regions_class_order = get_regions_class_order(props, files)
 
         # Softmax probabilities are already at target spacing so this will not do any resampling (resampling parameters
         # don't matter here)
@@ -69,6 +92,70 @@ def merge_files(files, properties_files, out_file, override, store_npz):
             save_pickle(props, out_file[:-7] + ".pkl")
 
 
+def merge_files_streaming(
+    files, properties_files, out_file, override, store_npz, chunk_size=16
+):
+    """
+    Same result as merge_files, but the members are added one after the other into a single float16 running sum
+    (slab by slab along the first spatial axis, so memory mapped members are streamed from disk) and the segmentation
+    is computed from the sum slab by slab as well. Never holds more than one member and the accumulator in memory.
+    The sum is not divided by the number of members because that does not change the argmax (region thresholds are
+    scaled instead).
+    """
+    if not (override or not isfile(out_file)):
+        return
+    props = [load_pickle(f) for f in properties_files]
+    regions_class_order = get_regions_class_order(props, files)
+
+    accumulator = None
+    for f in files:
+        member = load_softmax_member(f)
+        if accumulator is None:
+            accumulator = np.zeros(member.shape, dtype=np.float16)
+        assert (
+            member.shape == accumulator.shape
+        ), "all members must have the same shape: %s" % str(files)
+        for z in range(0, member.shape[1], chunk_size):
+            accumulator[:, z : z + chunk_size] += member[:, z : z + chunk_size]
+        del member
+
+    shape_original_after_cropping = props[0].get("size_after_cropping")
+    if all(
+        [i == j for i, j in zip(accumulator.shape[1:], shape_original_after_cropping)]
+    ):
+        seg = np.zeros(accumulator.shape[1:], dtype=np.uint8)
+        for z in range(0, accumulator.shape[1], chunk_size):
+            chunk = accumulator[:, z : z + chunk_size]
+            if regions_class_order is None:
+                seg[z : z + chunk_size] = chunk.argmax(0)
+            else:
+                seg_chunk = seg[z : z + chunk_size]
+                for i, c in enumerate(regions_class_order):
+                    seg_chunk[chunk[i] > 0.5 * len(files)] = c
+        save_segmentation_nifti_at_original_spacing(seg, out_file, props[0])
+        del seg
+        accumulator /= len(files)
+    else:
+        # this should not happen because the npz files are exported at the original spacing, but if they are not we
+        # need to resample the softmax before the argmax
+        accumulator /= len(files)
+        save_segmentation_nifti_from_softmax(
+            accumulator,
+            out_file,
+            props[0],
+            3,
+            regions_class_order,
+            None,
+            None,
+            force_separate_z=None,
+        )
+
+    if store_npz:
+        np.savez_compressed(out_file[:-7] + ".npz", softmax=accumulator)
+        save_pickle(props, out_file[:-7] + ".pkl")
+    print("merged %s, peak RSS: %.1f MB" % (out_file, get_peak_rss_mb()))
+
+
 def merge(
     folders,
     output_folder,
@@ -76,6 +163,8 @@ def merge(
     override=True,
     postprocessing_file=None,
     store_npz=False,
+    streaming=False,
+    chunk_size=16,
 ):
     maybe_mkdir_p(output_folder)
 
@@ -108,16 +197,29 @@ def merge(
         out_files.append(join(output_folder, p + ".nii.gz"))
 
     p = Pool(threads)
-    p.starmap(
-        merge_files,
-        zip(
-            files,
-            property_files,
-            out_files,
-            [override] * len(out_files),
-            [store_npz] * len(out_files),
-        ),
-    )
+    if streaming:
+        p.starmap(
+            merge_files_streaming,
+            zip(
+                files,
+                property_files,
+                out_files,
+                [override] * len(out_files),
+                [store_npz] * len(out_files),
+                [chunk_size] * len(out_files),
+            ),
+        )
+    else:
+        p.starmap(
+            merge_files,
+            zip(
+                files,
+                property_files,
+                out_files,
+                [override] * len(out_files),
+                [store_npz] * len(out_files),
+            ),
+        )
     p.close()
     p.join()
 
@@ -183,6 +285,24 @@ def main():
     parser.add_argument(
         "--npz", action="store_true", required=False, help="stores npz and pkl"
     )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        required=False,
+        help=(
+            "accumulate the members one by one into a float16 running sum instead of "
+            "loading all of them at once. Members for which an uncompressed <case>.npy "
+            "exists next to the npz are memory mapped and streamed from disk. Use this "
+            "for large volumes and many folds"
+        ),
+    )
+    parser.add_argument(
+        "--chunk_size",
+        required=False,
+        default=16,
+        type=int,
+        help="number of slices processed at once in --streaming mode",
+    )
 
     args = parser.parse_args()
 
@@ -199,6 +319,8 @@ def main():
         override=True,
         postprocessing_file=pp_file,
         store_npz=npz,
+        streaming=args.streaming,
+        chunk_size=args.chunk_size,
     )
 
 
@@ -24,6 +24,10 @@ import SimpleITK as sitk
 import torch
 from batchgenerators.augmentations.utils import resize_segmentation
 from batchgenerators.utilities.file_and_folder_operations import *
+from nnunet.inference.preprocessing_cache import (
+    PreprocessingCache,
+    get_preprocessing_fingerprint,
+)
 from nnunet.inference.segmentation_export import (
     save_segmentation_nifti,
     save_segmentation_nifti_from_softmax,
@@ -45,6 +49,8 @@ def preprocess_save_to_queue(
     segs_from_prev_stage,
     classes,
     transpose_forward,
+    preprocessing_cache=None,
+    preprocessing_fingerprint=None,
 ):
     # suppress output
     # sys.stdout = open(os.devnull, 'w')
@@ -53,8 +59,18 @@ def preprocess_save_to_queue(
     for i, l in enumerate(list_of_lists):
         try:
             output_file = output_files[i]
-            print("preprocessing", output_file)
-            d, _, dct = preprocess_fn(l)
+            cached = None
+            if preprocessing_cache is not None:
+                cache_key = preprocessing_cache.get_key(l, preprocessing_fingerprint)
+                cached = preprocessing_cache.load(cache_key)
+            if cached is not None:
+                print("using cached preprocessing for", output_file)
+                d, dct = cached
+            else:
+                print("preprocessing", output_file)
+                d, _, dct = preprocess_fn(l)
+                if preprocessing_cache is not None:
+                    preprocessing_cache.save(cache_key, d, dct)
             # print(output_file, dct)
             if segs_from_prev_stage[i] is not None:
                 assert isfile(segs_from_prev_stage[i]) and segs_from_prev_stage[
@@ -86,7 +102,10 @@ def preprocess_save_to_queue(
             then be read (and finally deleted) by the Process. save_segmentation_nifti_from_softmax can take either 
             filename or np.ndarray and will handle this automatically"""
             print(d.shape)
-            if np.prod(d.shape) > (
+            if preprocessing_cache is not None and segs_from_prev_stage[i] is None:
+                # the data is already on disk, no need to send it through the queue
+                d = preprocessing_cache.get_data_file(cache_key)
+            elif np.prod(d.shape) > (
                 2e9 / 4 * 0.85
             ):  # *0.85 just to be save, 4 because float32 is 4 bytes
                 print(
@@ -111,12 +130,35 @@ def preprocess_save_to_queue(
     # sys.stdout = sys.__stdout__
 
 
+def load_preprocessed_data(d, preprocessing_cache=None):
+    """
+    preprocess_save_to_queue sends large cases (and all cached cases) as npy file name. Temporary files are removed
+    after loading, cache entries are kept
+    """
+    if isinstance(d, str):
+        data = np.load(d)
+        if preprocessing_cache is None or not preprocessing_cache.is_cache_file(d):
+            os.remove(d)
+        d = data
+    return d
+
+
 def preprocess_multithreaded(
-    trainer, list_of_lists, output_files, num_processes=2, segs_from_prev_stage=None
+    trainer,
+    list_of_lists,
+    output_files,
+    num_processes=2,
+    segs_from_prev_stage=None,
+    preprocessing_cache: PreprocessingCache = None,
 ):
     if segs_from_prev_stage is None:
         segs_from_prev_stage = [None] * len(list_of_lists)
 
+    if preprocessing_cache is not None:
+        preprocessing_fingerprint = get_preprocessing_fingerprint(trainer)
+    else:
+        preprocessing_fingerprint = None
+
     num_processes = min(len(list_of_lists), num_processes)
 
     classes = list(range(1, trainer.num_classes))
@@ -134,6 +176,8 @@ def preprocess_multithreaded(
                 segs_from_prev_stage[i::num_processes],
                 classes,
                 trainer.plans["transpose_forward"],
+                preprocessing_cache,
+                preprocessing_fingerprint,
             ),
         )
         pr.start()
@@ -157,6 +201,9 @@ def preprocess_multithreaded(
 
         q.close()
 
+        if preprocessing_cache is not None:
+            preprocessing_cache.evict()
+
 
 def predict_cases(
     model,
@@ -174,9 +221,11 @@ def predict_cases(
     step_size=0.5,
     checkpoint_name="model_final_checkpoint",
     segmentation_export_kwargs: dict = None,
+    preprocessing_cache: PreprocessingCache = None,
 ):
     """
     :param segmentation_export_kwargs:
+    :param preprocessing_cache: if not None, preprocessed cases are looked up in / added to this cache
     :param model: folder where the model is saved, must contain fold_x subfolders
     :param list_of_lists: [[case0_0000.nii.gz, case0_0001.nii.gz], [case1_0000.nii.gz, case1_0001.nii.gz], ...]
     :param output_filenames: [output_file_case0.nii.gz, output_file_case1.nii.gz, ...]
@@ -257,36 +306,37 @@ def predict_cases(
         cleaned_output_files,
         num_threads_preprocessing,
         segs_from_prev_stage,
+        preprocessing_cache,
     )
     print("starting prediction...")
     all_output_files = []
     for preprocessed in preprocessing:
         output_filename, (d, dct) = preprocessed
         all_output_files.append(all_output_files)
-        if isinstance(d, str):
-            data = np.load(d)
-            os.remove(d)
-            d = data
+        d = load_preprocessed_data(d, preprocessing_cache)
 
         print("predicting", output_filename)
-        softmax = []
+        # keep a running sum instead of stacking the softmax of all folds. This way we never hold more than one fold
+        # prediction plus the accumulator in memory
+        softmax_mean = None
         for p in params:
             trainer.load_checkpoint_ram(p, False)
-            softmax.append(
-                trainer.predict_preprocessed_data_return_seg_and_softmax(
-                    d,
-                    do_mirroring=do_tta,
-                    mirror_axes=trainer.data_aug_params["mirror_axes"],
-                    use_sliding_window=True,
-                    step_size=step_size,
-                    use_gaussian=True,
-                    all_in_gpu=all_in_gpu,
-                    mixed_precision=mixed_precision,
-                )[1][None]
-            )
-
-        softmax = np.vstack(softmax)
-        softmax_mean = np.mean(softmax, 0)
+            softmax = trainer.predict_preprocessed_data_return_seg_and_softmax(
+                d,
+                do_mirroring=do_tta,
+                mirror_axes=trainer.data_aug_params["mirror_axes"],
+                use_sliding_window=True,
+                step_size=step_size,
+                use_gaussian=True,
+                all_in_gpu=all_in_gpu,
+                mixed_precision=mixed_precision,
+            )[1]
+            if softmax_mean is None:
+                softmax_mean = softmax
+            else:
+                softmax_mean += softmax
+            del softmax
+        softmax_mean /= len(params)
 
         transpose_forward = trainer.plans.get("transpose_forward")
         if transpose_forward is not None:
@@ -396,6 +446,7 @@ def predict_cases_fast(
     step_size=0.5,
     checkpoint_name="model_final_checkpoint",
     segmentation_export_kwargs: dict = None,
+    preprocessing_cache: PreprocessingCache = None,
 ):
     assert len(list_of_lists) == len(output_filenames)
     if segs_from_prev_stage is not None:
@@ -463,6 +514,7 @@ def predict_cases_fast(
         cleaned_output_files,
         num_threads_preprocessing,
         segs_from_prev_stage,
+        preprocessing_cache,
     )
 
     print("starting prediction...")
@@ -472,9 +524,7 @@ def predict_cases_fast(
         print("got something")
         if isinstance(d, str):
             print("what I got is a string, so I need to load a file")
-            data = np.load(d)
-            os.remove(d)
-            d = data
+            d = load_preprocessed_data(d, preprocessing_cache)
 
         # preallocate the output arrays
         # same dtype as the return value in predict_preprocessed_data_return_seg_and_softmax (saves time)
@@ -587,6 +637,7 @@ def predict_cases_fastest(
     all_in_gpu=True,
     step_size=0.5,
     checkpoint_name="model_final_checkpoint",
+    preprocessing_cache: PreprocessingCache = None,
 ):
     assert len(list_of_lists) == len(output_filenames)
     if segs_from_prev_stage is not None:
@@ -634,6 +685,7 @@ def predict_cases_fastest(
         cleaned_output_files,
         num_threads_preprocessing,
         segs_from_prev_stage,
+        preprocessing_cache,
     )
 
     print("starting prediction...")
@@ -643,9 +695,7 @@ def predict_cases_fastest(
         print("got something")
         if isinstance(d, str):
             print("what I got is a string, so I need to load a file")
-            data = np.load(d)
-            os.remove(d)
-            d = data
+            d = load_preprocessed_data(d, preprocessing_cache)
 
         # preallocate the output arrays
         # same dtype as the return value in predict_preprocessed_data_return_seg_and_softmax (saves time)
@@ -796,6 +846,8 @@ def predict_from_folder(
     step_size: float = 0.5,
     checkpoint_name: str = "model_final_checkpoint",
     segmentation_export_kwargs: dict = None,
+    preprocessing_cache_dir: str = None,
+    preprocessing_cache_max_gb: float = 50,
 ):
     """
         here we use the standard naming scheme to generate list_of_lists and output_files needed by predict_cases
@@ -813,6 +865,9 @@ def predict_from_folder(
     :param tta:
     :param mixed_precision:
     :param overwrite_existing: if not None then it will be overwritten with whatever is in there. None is default (no overwrite)
+    :param preprocessing_cache_dir: if not None, preprocessed cases are cached here and reused when the same input
+    files are predicted again with a model that uses the same preprocessing (other fold, checkpoint, ...)
+    :param preprocessing_cache_max_gb: least recently used cache entries are evicted beyond this size
     :return:
     """
     maybe_mkdir_p(output_folder)
@@ -854,6 +909,13 @@ def predict_from_folder(
     else:
         lowres_segmentations = None
 
+    if preprocessing_cache_dir is not None:
+        preprocessing_cache = PreprocessingCache(
+            preprocessing_cache_dir, preprocessing_cache_max_gb
+        )
+    else:
+        preprocessing_cache = None
+
     if mode == "normal":
         if overwrite_all_in_gpu is None:
             all_in_gpu = False
@@ -876,6 +938,7 @@ def predict_from_folder(
             step_size=step_size,
             checkpoint_name=checkpoint_name,
             segmentation_export_kwargs=segmentation_export_kwargs,
+            preprocessing_cache=preprocessing_cache,
         )
     elif mode == "fast":
         if overwrite_all_in_gpu is None:
@@ -899,6 +962,7 @@ def predict_from_folder(
             step_size=step_size,
             checkpoint_name=checkpoint_name,
             segmentation_export_kwargs=segmentation_export_kwargs,
+            preprocessing_cache=preprocessing_cache,
         )
     elif mode == "fastest":
         if overwrite_all_in_gpu is None:
@@ -921,6 +985,7 @@ def predict_from_folder(
             all_in_gpu=all_in_gpu,
             step_size=step_size,
             checkpoint_name=checkpoint_name,
+            preprocessing_cache=preprocessing_cache,
         )
     else:
         raise ValueError("unrecognized mode. Must be normal, fast or fastest")
@@ -249,6 +249,27 @@ def main():
             " ~2x faster!)"
         ),
     )
+    parser.add_argument(
+        "--preprocessing_cache_dir",
+        required=False,
+        default=None,
+        help=(
+            "If set, preprocessed cases are cached in this folder (keyed by the content"
+            " of the input files and the preprocessing parameters) and reused when the"
+            " same cases are predicted again, for example with another checkpoint or"
+            " fold. Default: no cache"
+        ),
+    )
+    parser.add_argument(
+        "--preprocessing_cache_max_gb",
+        required=False,
+        default=50,
+        type=float,
+        help=(
+            "least recently used entries are removed from the preprocessing cache when"
+            " it grows beyond this size. Default: 50"
+        ),
+    )
 
     args = parser.parse_args()
     input_folder = args.input_folder
@@ -352,6 +373,8 @@ def main():
             overwrite_all_in_gpu=all_in_gpu,
             mixed_precision=not args.disable_mixed_precision,
             step_size=step_size,
+            preprocessing_cache_dir=args.preprocessing_cache_dir,
+            preprocessing_cache_max_gb=args.preprocessing_cache_max_gb,
         )
         lowres_segmentations = lowres_output_folder
         torch.cuda.empty_cache()
@@ -391,6 +414,8 @@ def main():
         mixed_precision=not args.disable_mixed_precision,
         step_size=step_size,
         checkpoint_name=args.chk,
+        preprocessing_cache_dir=args.preprocessing_cache_dir,
+        preprocessing_cache_max_gb=args.preprocessing_cache_max_gb,
     )
 
 
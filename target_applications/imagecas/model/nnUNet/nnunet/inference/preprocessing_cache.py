@@ -0,0 +1,130 @@
+#    Copyright 2020 Division of Medical Image Computing, German Cancer Research Center (DKFZ), Heidelberg, Germany
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import hashlib
+import json
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import *
+
+
+def get_preprocessing_fingerprint(trainer):
+    """
+    everything that influences the output of trainer.preprocess_patient. Two trainers (folds, checkpoints) with the
+    same fingerprint produce the same preprocessed data, so they can share cache entries
+    """
+    return {
+        "preprocessor_name": trainer.plans.get("preprocessor_name"),
+        "threeD": trainer.threeD,
+        "normalization_schemes": trainer.normalization_schemes,
+        "use_mask_for_norm": trainer.use_mask_for_norm,
+        "transpose_forward": trainer.transpose_forward,
+        "intensity_properties": trainer.intensity_properties,
+        "current_spacing": trainer.plans["plans_per_stage"][trainer.stage][
+            "current_spacing"
+        ],
+    }
+
+
+def hash_files(files, block_size=2**20):
+    h = hashlib.sha1()
+    for f in files:
+        with open(f, "rb") as fh:
+            for block in iter(lambda: fh.read(block_size), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+class PreprocessingCache(object):
+    def __init__(self, cache_dir, max_size_gb=50):
+        """
+        Content addressed cache of preprocessed test cases. An entry is identified by the hash of the bytes of the
+        input files and of the preprocessing fingerprint (see get_preprocessing_fingerprint), so predicting the same
+        test folder with another fold or checkpoint of the same plans reuses the preprocessed data. Entries are stored
+        as uncompressed npy (can be memory mapped) + pkl with the properties. When the cache grows beyond max_size_gb
+        the least recently used entries are removed by evict()
+        :param cache_dir:
+        :param max_size_gb:
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_gb * 1024**3
+        maybe_mkdir_p(cache_dir)
+
+    def get_key(self, input_files, fingerprint):
+        fp = json.dumps(fingerprint, sort_keys=True, default=str).encode()
+        return hashlib.sha1(hash_files(input_files).encode() + fp).hexdigest()
+
+    def get_data_file(self, key):
+        return join(self.cache_dir, key + ".npy")
+
+    def get_properties_file(self, key):
+        return join(self.cache_dir, key + ".pkl")
+
+    def is_cache_file(self, filename):
+        return os.path.abspath(os.path.dirname(filename)) == os.path.abspath(
+            self.cache_dir
+        )
+
+    def load(self, key, mmap_mode="r"):
+        """
+        returns (data, properties) or None if key is not in the cache
+        """
+        data_file = self.get_data_file(key)
+        properties_file = self.get_properties_file(key)
+        if not (isfile(data_file) and isfile(properties_file)):
+            return None
+        try:
+            data = np.load(data_file, mmap_mode=mmap_mode)
+            properties = load_pickle(properties_file)
+        except (OSError, ValueError, EOFError):
+            # entry got evicted or was corrupted while we were reading it
+            return None
+        # mark as recently used
+        os.utime(data_file)
+        return data, properties
+
+    def save(self, key, data, properties):
+        # write to temporary files and rename so that concurrent readers never see half written entries
+        tmp_suffix = ".%d.tmp" % os.getpid()
+        data_file = self.get_data_file(key)
+        properties_file = self.get_properties_file(key)
+        with open(data_file + tmp_suffix, "wb") as f:
+            np.save(f, data)
+        save_pickle(properties, properties_file + tmp_suffix)
+        os.replace(properties_file + tmp_suffix, properties_file)
+        os.replace(data_file + tmp_suffix, data_file)
+        return data_file
+
+    def evict(self):
+        """
+        removes the least recently used entries until the cache is smaller than max_size_gb. Must not be called while
+        predictions are running that may still read from the cache
+        """
+        entries = []
+        for f in subfiles(self.cache_dir, suffix=".npy", join=False):
+            key = f[:-4]
+            size = os.path.getsize(join(self.cache_dir, f))
+            if isfile(self.get_properties_file(key)):
+                size += os.path.getsize(self.get_properties_file(key))
+            entries.append((os.path.getmtime(join(self.cache_dir, f)), key, size))
+        entries.sort()
+        total = sum([i[2] for i in entries])
+        for _, key, size in entries:
+            if total <= self.max_size_bytes:
+                break
+            for f in (self.get_data_file(key), self.get_properties_file(key)):
+                if isfile(f):
+                    os.remove(f)
+            total -= size
+            print("evicted preprocessing cache entry", key)
@@ -287,3 +287,46 @@ def save_segmentation_nifti(
     sitk.WriteImage(seg_resized_itk, out_fname)
 
     sys.stdout = sys.__stdout__
+
+
+def save_segmentation_nifti_at_original_spacing(segmentation, out_fname, dct):
+    """
+    writes a segmentation that is already at the original spacing (shape must be size_after_cropping) to nifti. The
+    segmentation is pasted into the crop bbox of a uint8 array instead of the float array used by
+    save_segmentation_nifti, which matters for large volumes
+    :param segmentation:
+    :param out_fname:
+    :param dct:
+    :return:
+    """
+    shape_original_after_cropping = dct.get("size_after_cropping")
+    shape_original_before_cropping = dct.get("original_size_of_raw_data")
+    assert all(
+        [i == j for i, j in zip(segmentation.shape, shape_original_after_cropping)]
+    ), "segmentation must have shape size_after_cropping: %s vs %s" % (
+        str(segmentation.shape),
+        str(shape_original_after_cropping),
+    )
+
+    bbox = dct.get("crop_bbox")
+
+    if bbox is not None:
+        seg_old_size = np.zeros(shape_original_before_cropping, dtype=np.uint8)
+        for c in range(3):
+            bbox[c][1] = np.min(
+                (
+                    bbox[c][0] + segmentation.shape[c],
+                    shape_original_before_cropping[c],
+                )
+            )
+        seg_old_size[
+            bbox[0][0] : bbox[0][1], bbox[1][0] : bbox[1][1], bbox[2][0] : bbox[2][1]
+        ] = segmentation
+    else:
+        seg_old_size = segmentation.astype(np.uint8)
+
+    seg_resized_itk = sitk.GetImageFromArray(seg_old_size)
+    seg_resized_itk.SetSpacing(dct["itk_spacing"])
+    seg_resized_itk.SetOrigin(dct["itk_origin"])
+    seg_resized_itk.SetDirection(dct["itk_direction"])
+    sitk.WriteImage(seg_resized_itk, out_fname)
@@ -21,20 +21,74 @@ import SimpleITK as sitk
 from batchgenerators.utilities.file_and_folder_operations import *
 
 
-def create_nonzero_mask(data):
+def create_nonzero_mask(data, bbox=None):
+    """
+    if bbox is given (3d only) the mask is computed for that region only. The result is the same as cropping the full
+    mask to bbox as long as everything outside of bbox is zero
+    """
     from scipy.ndimage import binary_fill_holes
 
     assert (
         len(data.shape) == 4 or len(data.shape) == 3
     ), "data must have shape (C, X, Y, Z) or shape (C, X, Y)"
-    nonzero_mask = np.zeros(data.shape[1:], dtype=bool)
+    if bbox is not None:
+        shape = [i[1] - i[0] for i in bbox]
+    else:
+        shape = data.shape[1:]
+    nonzero_mask = np.zeros(shape, dtype=bool)
     for c in range(data.shape[0]):
-        this_mask = data[c] != 0
+        if bbox is not None:
+            this_mask = crop_to_bbox(data[c], bbox) != 0
+        else:
+            this_mask = data[c] != 0
         nonzero_mask = nonzero_mask | this_mask
     nonzero_mask = binary_fill_holes(nonzero_mask)
     return nonzero_mask
 
 
+def _any_nonzero(data, axis, start, stop):
+    slicer = [slice(None)] * len(data.shape)
+    slicer[axis + 1] = slice(start, stop)
+    return np.any(data[tuple(slicer)] != 0)
+
+
+def get_bbox_of_nonzero(data, stride=4):
+    """
+    Same result as get_bbox_from_mask(create_nonzero_mask(data)) (filling holes never changes the bbox), but without
+    materializing the full resolution mask and the coordinate arrays of np.where. The bbox is first estimated on a
+    strided view of the data. The estimate is a lower bound of the true bbox, so we only need to look at the slabs
+    between the image border and the estimate to find the exact bounds.
+    :param data: (C, X, Y, Z) or (C, X, Y)
+    :param stride:
+    :return: bbox or None if the strided view is all zero. That does not mean data is all zero: sparse nonzero
+    voxels can lie between the strided positions, so the caller has to fall back to the full resolution mask
+    """
+    spatial_dims = len(data.shape) - 1
+    coarse_view = data[(slice(None),) + (slice(None, None, stride),) * spatial_dims]
+    coarse_mask = np.any(coarse_view != 0, axis=0)
+    if not np.any(coarse_mask):
+        return None
+
+    bbox = []
+    for axis in range(spatial_dims):
+        other_axes = tuple([i for i in range(spatial_dims) if i != axis])
+        nonzero = np.where(np.any(coarse_mask, axis=other_axes))[0]
+        lb = int(nonzero[0]) * stride
+        ub = int(nonzero[-1]) * stride + 1
+
+        # refine: move the bounds outwards for as long as we find nonzero voxels between estimate and image border
+        for i in range(lb):
+            if _any_nonzero(data, axis, i, i + 1):
+                lb = i
+                break
+        for i in range(data.shape[axis + 1] - 1, ub - 1, -1):
+            if _any_nonzero(data, axis, i, i + 1):
+                ub = i + 1
+                break
+        bbox.append([lb, ub])
+    return bbox
+
+
 def get_bbox_from_mask(mask, outside_value=0):
     mask_voxel_coords = np.where(mask != outside_value)
     minzidx = int(np.min(mask_voxel_coords[0]))
@@ -91,38 +145,67 @@ def load_case_from_list_of_files(data_files, seg_file=None):
     return data_npy.astype(np.float32), seg_npy, properties
 
 
-def crop_to_nonzero(data, seg=None, nonzero_label=-1):
+def crop_to_nonzero(data, seg=None, nonzero_label=-1, allocate_output=None):
     """
 
     :param data:
     :param seg:
     :param nonzero_label: this will be written into the segmentation map
+    :param allocate_output: optional callable(shape) that returns a float32 array of shape
+    (data channels + seg channels, *cropped shape). If given, the cropped data (first channels) and segmentation (last
+    channels) are written directly into that array and the returned data and seg are views of it. Use this with
+    np.lib.format.open_memmap to write the cropped case to disk without intermediate copies
     :return:
     """
-    nonzero_mask = create_nonzero_mask(data)
-    bbox = get_bbox_from_mask(nonzero_mask, 0)
-
-    cropped_data = []
-    for c in range(data.shape[0]):
-        cropped = crop_to_bbox(data[c], bbox)
-        cropped_data.append(cropped[None])
-    data = np.vstack(cropped_data)
+    bbox = get_bbox_of_nonzero(data)
+    if bbox is None:
+        # the strided view missed the nonzero voxels (or there are none), use the full resolution mask
+        nonzero_mask = create_nonzero_mask(data)
+        bbox = get_bbox_from_mask(nonzero_mask, 0)
+
+    # holes can only be filled inside of the bbox, so there is no need to do that on the full image
+    nonzero_mask = create_nonzero_mask(data, bbox)
+
+    if allocate_output is not None:
+        num_seg = seg.shape[0] if seg is not None else 1
+        out = allocate_output((data.shape[0] + num_seg, *nonzero_mask.shape))
+        for c in range(data.shape[0]):
+            out[c] = crop_to_bbox(data[c], bbox)
+        if seg is not None:
+            for c in range(seg.shape[0]):
+                out[data.shape[0] + c] = crop_to_bbox(seg[c], bbox)
+        data = out[: data.shape[0]]
+        seg_out = out[data.shape[0] :]
+    else:
+        cropped_data = []
+        for c in range(data.shape[0]):
+            cropped = crop_to_bbox(data[c], bbox)
+            cropped_data.append(cropped[None])
+        data = np.vstack(cropped_data)
+        seg_out = None
 
     if seg is not None:
-        cropped_seg = []
-        for c in range(seg.shape[0]):
-            cropped = crop_to_bbox(seg[c], bbox)
-            cropped_seg.append(cropped[None])
-        seg = np.vstack(cropped_seg)
-
-    nonzero_mask = crop_to_bbox(nonzero_mask, bbox)[None]
+        if seg_out is not None:
+            seg = seg_out
+        else:
+            cropped_seg = []
+            for c in range(seg.shape[0]):
+                cropped = crop_to_bbox(seg[c], bbox)
+                cropped_seg.append(cropped[None])
+            seg = np.vstack(cropped_seg)
+
+    nonzero_mask = nonzero_mask[None]
     if seg is not None:
         seg[(seg == 0) & (nonzero_mask == 0)] = nonzero_label
     else:
         nonzero_mask = nonzero_mask.astype(int)
         nonzero_mask[nonzero_mask == 0] = nonzero_label
         nonzero_mask[nonzero_mask > 0] = 0
-        seg = nonzero_mask
+        if seg_out is not None:
+            seg_out[:] = nonzero_mask
+            seg = seg_out
+        else:
+            seg = nonzero_mask
     return data, seg, bbox
 
 
@@ -131,24 +214,29 @@ def get_patient_identifiers_from_cropped_files(folder):
 
 
 class ImageCropper(object):
-    def __init__(self, num_threads, output_folder=None):
+    def __init__(self, num_threads, output_folder=None, save_npy=False):
         """
         This one finds a mask of nonzero elements (must be nonzero in all modalities) and crops the image to that mask.
         In the case of BRaTS and ISLES data this results in a significant reduction in image size
         :param num_threads:
         :param output_folder: whete to store the cropped data
+        :param save_npy: if True, the workers write the cropped cases into memory mapped npy files (next to the
+        npz) which can then be memory mapped by the following steps instead of decompressing the npz
         :param list_of_files:
         """
         self.output_folder = output_folder
         self.num_threads = num_threads
+        self.save_npy = save_npy
 
         if self.output_folder is not None:
             maybe_mkdir_p(self.output_folder)
 
     @staticmethod
-    def crop(data, properties, seg=None):
+    def crop(data, properties, seg=None, allocate_output=None):
         shape_before = data.shape
-        data, seg, bbox = crop_to_nonzero(data, seg, nonzero_label=-1)
+        data, seg, bbox = crop_to_nonzero(
+            data, seg, nonzero_label=-1, allocate_output=allocate_output
+        )
         shape_after = data.shape
         print(
             "before crop:",
@@ -167,9 +255,9 @@ class ImageCropper(object):
         return data, seg, properties
 
     @staticmethod
-    def crop_from_list_of_files(data_files, seg_file=None):
+    def crop_from_list_of_files(data_files, seg_file=None, allocate_output=None):
         data, seg, properties = load_case_from_list_of_files(data_files, seg_file)
-        return ImageCropper.crop(data, properties, seg)
+        return ImageCropper.crop(data, properties, seg, allocate_output)
 
     def load_crop_save(self, case, case_identifier, overwrite_existing=False):
         try:
@@ -182,15 +270,37 @@ class ImageCropper(object):
                     os.path.join(self.output_folder, "%s.pkl" % case_identifier)
                 )
             ):
+                npy_file = os.path.join(self.output_folder, "%s.npy" % case_identifier)
+                # load_cropped prefers the npy, one left by an earlier run must not outlive the new npz
+                if os.path.isfile(npy_file):
+                    os.remove(npy_file)
+                all_data = []
+
+                # data and seg are cropped directly into this array, so we don't need to stack them afterwards
+                def allocate_output(shape):
+                    if self.save_npy:
+                        all_data.append(
+                            np.lib.format.open_memmap(
+                                npy_file + ".tmp", "w+", np.float32, shape
+                            )
+                        )
+                    else:
+                        all_data.append(np.empty(shape, dtype=np.float32))
+                    return all_data[0]
+
                 data, seg, properties = self.crop_from_list_of_files(
-                    case[:-1], case[-1]
+                    case[:-1], case[-1], allocate_output
                 )
+                all_data = all_data[0]
 
-                all_data = np.vstack((data, seg))
                 np.savez_compressed(
                     os.path.join(self.output_folder, "%s.npz" % case_identifier),
                     data=all_data,
                 )
+                if self.save_npy:
+                    all_data.flush()
+                    del all_data, data, seg
+                    os.replace(npy_file + ".tmp", npy_file)
                 with open(
                     os.path.join(self.output_folder, "%s.pkl" % case_identifier), "wb"
                 ) as f:
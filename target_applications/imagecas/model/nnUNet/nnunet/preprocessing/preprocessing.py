@@ -302,9 +302,14 @@ class GenericPreprocessor(object):
 
     @staticmethod
     def load_cropped(cropped_output_dir, case_identifier):
-        all_data = np.load(
-            os.path.join(cropped_output_dir, "%s.npz" % case_identifier)
-        )["data"]
+        # the cropper can leave an uncompressed copy (ImageCropper(save_npy=True)), no need to decompress the npz then
+        npy_file = os.path.join(cropped_output_dir, "%s.npy" % case_identifier)
+        if isfile(npy_file):
+            all_data = np.load(npy_file)
+        else:
+            all_data = np.load(
+                os.path.join(cropped_output_dir, "%s.npz" % case_identifier)
+            )["data"]
         data = all_data[:-1].astype(np.float32)
         seg = all_data[-1:]
         with open(
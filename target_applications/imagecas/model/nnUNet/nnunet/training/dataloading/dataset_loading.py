@@ -259,10 +259,37 @@ class DataLoader3D(SlimDataLoaderBase):
         seg_shape = (self.batch_size, num_seg, *self.patch_size)
         return data_shape, seg_shape
 
-    def generate_train_batch(self):
-        selected_keys = np.random.choice(self.list_of_keys, self.batch_size, True, None)
+    def allocate_batch(self):
         data = np.zeros(self.data_shape, dtype=np.float32)
         seg = np.zeros(self.seg_shape, dtype=np.float32)
+        return data, seg
+
+    def get_properties(self, key):
+        if "properties" in self._data[key].keys():
+            return self._data[key]["properties"]
+        return load_pickle(self._data[key]["properties_file"])
+
+    def get_foreground_classes(self, key, properties):
+        # this saves us a np.unique. Preprocessing already did that for all cases. Neat.
+        foreground_classes = np.array(
+            [
+                i
+                for i in properties["class_locations"].keys()
+                if len(properties["class_locations"][i]) != 0
+            ]
+        )
+        return foreground_classes[foreground_classes > 0]
+
+    def load_case_data(self, key):
+        # cases are stored as npz, but we require unpack_dataset to be run. This will decompress them into npy
+        # which is much faster to access
+        if isfile(self._data[key]["data_file"][:-4] + ".npy"):
+            return np.load(self._data[key]["data_file"][:-4] + ".npy", self.memmap_mode)
+        return np.load(self._data[key]["data_file"])["data"]
+
+    def generate_train_batch(self):
+        selected_keys = np.random.choice(self.list_of_keys, self.batch_size, True, None)
+        data, seg = self.allocate_batch()
         case_properties = []
         for j, i in enumerate(selected_keys):
             # oversampling foreground will improve stability of model training, especially if many patches are empty
@@ -272,20 +299,10 @@ class DataLoader3D(SlimDataLoaderBase):
             else:
                 force_fg = False
 
-            if "properties" in self._data[i].keys():
-                properties = self._data[i]["properties"]
-            else:
-                properties = load_pickle(self._data[i]["properties_file"])
+            properties = self.get_properties(i)
             case_properties.append(properties)
 
-            # cases are stored as npz, but we require unpack_dataset to be run. This will decompress them into npy
-            # which is much faster to access
-            if isfile(self._data[i]["data_file"][:-4] + ".npy"):
-                case_all_data = np.load(
-                    self._data[i]["data_file"][:-4] + ".npy", self.memmap_mode
-                )
-            else:
-                case_all_data = np.load(self._data[i]["data_file"])["data"]
+            case_all_data = self.load_case_data(i)
 
             # If we are doing the cascade then we will also need to load the segmentation of the previous stage and
             # concatenate it. Here it will be concatenates to the segmentation because the augmentations need to be
@@ -368,15 +385,7 @@ class DataLoader3D(SlimDataLoaderBase):
                         " nnU-Net!"
                     )
 
-                # this saves us a np.unique. Preprocessing already did that for all cases. Neat.
-                foreground_classes = np.array(
-                    [
-                        i
-                        for i in properties["class_locations"].keys()
-                        if len(properties["class_locations"][i]) != 0
-                    ]
-                )
-                foreground_classes = foreground_classes[foreground_classes > 0]
+                foreground_classes = self.get_foreground_classes(i, properties)
 
                 if len(foreground_classes) == 0:
                     # this only happens if some image does not contain foreground voxels at all
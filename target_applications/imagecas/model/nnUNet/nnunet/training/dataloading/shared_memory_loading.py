@@ -0,0 +1,251 @@
+#    Copyright 2020 Division of Medical Image Computing, German Cancer Research Center (DKFZ), Heidelberg, Germany
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
+from time import time
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import *
+from nnunet.configuration import default_num_threads
+from nnunet.training.dataloading.dataset_loading import DataLoader3D
+
+
+def convert_to_npy_atomic(args):
+    """
+    same as convert_to_npy but writes to a temporary file first and renames it. This way a data loader worker that
+    unpacks a case on demand and the background unpacker can never observe (or memmap) a half written npy file
+    """
+    if not isinstance(args, tuple):
+        key = "data"
+        npz_file = args
+    else:
+        npz_file, key = args
+    npy_file = npz_file[:-3] + "npy"
+    if isfile(npy_file):
+        return npy_file
+    tmp_file = npy_file + ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+    a = np.load(npz_file)[key]
+    with open(tmp_file, "wb") as f:
+        np.save(f, a)
+    os.replace(tmp_file, npy_file)
+    return npy_file
+
+
+def unpack_dataset_in_background(folder, threads=default_num_threads, key="data"):
+    """
+    starts unpacking all npz files in folder that do not have a npy counterpart yet and returns immediately. The
+    returned thread can be joined if you need to wait for it. Cases that are requested before the background unpacker
+    got to them are unpacked on demand by SharedMemoryDataLoader3D
+    :param folder:
+    :param threads:
+    :param key:
+    :return: threading.Thread
+    """
+    npz_files = [
+        i
+        for i in subfiles(folder, True, None, ".npz", True)
+        if not isfile(i[:-3] + "npy")
+    ]
+
+    def _run():
+        if len(npz_files) == 0:
+            return
+        p = Pool(threads)
+        p.map(convert_to_npy_atomic, zip(npz_files, [key] * len(npz_files)))
+        p.close()
+        p.join()
+
+    t = threading.Thread(target=_run, daemon=True)
+    t.start()
+    return t
+
+
+def _compact_dtype(max_value):
+    for dtype in (np.int16, np.int32):
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def build_case_index(dataset):
+    """
+    loads the properties of all cases exactly once (load_dataset only does that for small datasets) and stores them
+    in dataset[k]['properties']. class_locations are converted to the smallest integer dtype that can hold the
+    coordinates (they are int64 after preprocessing which is mostly wasted memory with thousands of sampled locations
+    per class and case) and the foreground classes are precomputed so that they do not need to be recomputed for every
+    sample.
+    :param dataset: as returned by load_dataset
+    :return: OrderedDict case identifier -> np.ndarray of foreground classes
+    """
+    foreground_classes = OrderedDict()
+    for k in dataset.keys():
+        if "properties" not in dataset[k].keys():
+            dataset[k]["properties"] = load_pickle(dataset[k]["properties_file"])
+        properties = dataset[k]["properties"]
+        if "class_locations" not in properties.keys():
+            raise RuntimeError(
+                "Please rerun the preprocessing with the newest version of nnU-Net!"
+            )
+        dtype = _compact_dtype(max(properties["size_after_resampling"]))
+        fg = []
+        for c in properties["class_locations"].keys():
+            locs = properties["class_locations"][c]
+            if len(locs) != 0:
+                properties["class_locations"][c] = np.ascontiguousarray(
+                    locs, dtype=dtype
+                )
+                if c > 0:
+                    fg.append(c)
+        foreground_classes[k] = np.array(fg)
+    return foreground_classes
+
+
+class BatchBufferRing(object):
+    def __init__(self, data_shape, seg_shape, num_buffers=4):
+        """
+        A ring of preallocated batch buffers of the process using it. next() hands out the buffers in round robin
+        order. A buffer is only reused after num_buffers - 1 other batches were produced, so num_buffers must be larger
+        than the number of batches that can be in flight (in the transforms and in the queue of the
+        MultiThreadedAugmenter, which pickles a batch in a feeder thread after put returned) at the same time.
+        :param data_shape:
+        :param seg_shape:
+        :param num_buffers:
+        """
+        assert num_buffers >= 2, "need at least 2 buffers in the ring"
+        self.num_buffers = num_buffers
+        self._buffers = [
+            (
+                np.empty(data_shape, dtype=np.float32),
+                np.empty(seg_shape, dtype=np.float32),
+            )
+            for _ in range(num_buffers)
+        ]
+        self._next = 0
+
+    def next(self):
+        buffers = self._buffers[self._next]
+        self._next = (self._next + 1) % self.num_buffers
+        return buffers
+
+
+class SharedMemoryDataLoader3D(DataLoader3D):
+    def __init__(
+        self,
+        data,
+        patch_size,
+        final_patch_size,
+        batch_size,
+        has_prev_stage=False,
+        oversample_foreground_percent=0.0,
+        memmap_mode="r",
+        pad_mode="edge",
+        pad_kwargs_data=None,
+        pad_sides=None,
+        num_buffers=4,
+        unpack_in_background=True,
+        report_every=50,
+    ):
+        """
+        Drop in replacement for DataLoader3D that
+        - reuses a ring of preallocated batch buffers instead of allocating new arrays for every batch. The batches
+        reach the main process pickled through the queue of the MultiThreadedAugmenter, so the buffers stay private to
+        the worker
+        - loads all case properties once and keeps them (with compacted class_locations) in memory, see
+        build_case_index
+        - only ever memmaps npy files. Missing npy files are unpacked in a background thread and, if a case is sampled
+        before the background thread got to it, unpacked on demand. npz files are never decompressed per sample
+        - prints samples/s of each augmentation worker every report_every batches (set to None to disable)
+        :param num_buffers: size of the buffer ring. Must exceed the number of batches a worker can have in flight
+        (num_cached_per_queue of the MultiThreadedAugmenter + 2 is a safe choice)
+        :param unpack_in_background: start unpacking missing npy files in a background thread
+        :param report_every:
+        """
+        self.num_buffers = num_buffers
+        self.report_every = report_every
+        self.foreground_classes = build_case_index(data)
+        self._ring = None
+        self._reset_throughput_stats()
+        self.unpack_threads = None
+        if unpack_in_background:
+            folders = sorted(set(os.path.dirname(data[k]["data_file"]) for k in data))
+            self.unpack_threads = [unpack_dataset_in_background(f) for f in folders]
+        super(SharedMemoryDataLoader3D, self).__init__(
+            data,
+            patch_size,
+            final_patch_size,
+            batch_size,
+            has_prev_stage,
+            oversample_foreground_percent,
+            memmap_mode,
+            pad_mode,
+            pad_kwargs_data,
+            pad_sides,
+        )
+
+    def __getstate__(self):
+        # threads cannot be sent to another process and the ring would only be copied. Workers allocate their own ring
+        state = self.__dict__.copy()
+        state["_ring"] = None
+        state["unpack_threads"] = None
+        return state
+
+    def _reset_throughput_stats(self):
+        self._num_samples = 0
+        self._num_batches = 0
+        self._time_generating = 0.0
+        self._time_window_start = None
+
+    def allocate_batch(self):
+        # allocated on first use, i.e. in the worker process
+        if self._ring is None:
+            self._ring = BatchBufferRing(
+                self.data_shape, self.seg_shape, self.num_buffers
+            )
+        return self._ring.next()
+
+    def get_properties(self, key):
+        return self._data[key]["properties"]
+
+    def get_foreground_classes(self, key, properties):
+        return self.foreground_classes[key]
+
+    def load_case_data(self, key):
+        npz_file = self._data[key]["data_file"]
+        return np.load(convert_to_npy_atomic(npz_file), self.memmap_mode)
+
+    def generate_train_batch(self):
+        start = time()
+        if self._time_window_start is None:
+            self._time_window_start = start
+        batch = super(SharedMemoryDataLoader3D, self).generate_train_batch()
+        self._time_generating += time() - start
+        self._num_samples += self.batch_size
+        self._num_batches += 1
+
+        if self.report_every is not None and self._num_batches >= self.report_every:
+            elapsed = time() - self._time_window_start
+            print(
+                "worker %d (pid %d): %.2f samples/s (%.2f samples/s spent in the data"
+                " loader)"
+                % (
+                    self.thread_id,
+                    os.getpid(),
+                    self._num_samples / max(elapsed, 1e-8),
+                    self._num_samples / max(self._time_generating, 1e-8),
+                )
+            )
+            self._reset_throughput_stats()
+        return batch
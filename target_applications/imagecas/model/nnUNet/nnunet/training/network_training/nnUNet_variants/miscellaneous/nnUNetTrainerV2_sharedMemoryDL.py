@@ -0,0 +1,61 @@
+#    Copyright 2020 Division of Medical Image Computing, German Cancer Research Center (DKFZ), Heidelberg, Germany
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from nnunet.training.dataloading.shared_memory_loading import SharedMemoryDataLoader3D
+from nnunet.training.network_training.nnUNetTrainerV2 import nnUNetTrainerV2
+
+
+class nnUNetTrainerV2_sharedMemoryDL(nnUNetTrainerV2):
+    """
+    uses SharedMemoryDataLoader3D for 3d configurations. The data loaders unpack the npz files in the background, so
+    the (blocking) unpack_dataset call in initialize is skipped
+    """
+
+    def get_basic_generators(self):
+        if not self.threeD:
+            return super().get_basic_generators()
+
+        self.load_dataset()
+        self.do_split()
+
+        # the data loader workers are started by the MultiThreadedAugmenter (default num_cached_per_queue=2), so the
+        # ring needs at least 2 buffers for the queue plus one being filled and one being augmented
+        dl_tr = SharedMemoryDataLoader3D(
+            self.dataset_tr,
+            self.basic_generator_patch_size,
+            self.patch_size,
+            self.batch_size,
+            False,
+            oversample_foreground_percent=self.oversample_foreground_percent,
+            pad_mode="constant",
+            pad_sides=self.pad_all_sides,
+            memmap_mode="r",
+            num_buffers=4,
+        )
+        dl_val = SharedMemoryDataLoader3D(
+            self.dataset_val,
+            self.patch_size,
+            self.patch_size,
+            self.batch_size,
+            False,
+            oversample_foreground_percent=self.oversample_foreground_percent,
+            pad_mode="constant",
+            pad_sides=self.pad_all_sides,
+            memmap_mode="r",
+            num_buffers=4,
+            unpack_in_background=False,
+            report_every=None,
+        )
+        self.unpack_data = False
+        return dl_tr, dl_val
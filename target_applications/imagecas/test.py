@@ -242,6 +242,7 @@ def process(args):
             attn_drop_rate=0.0,
             dropout_path_rate=0.0,
             use_checkpoint=False,
+            attn_backend=args.attn_backend,
         )
         store_dict = model.state_dict()
         model_dict = torch.load(args.pretrain)["net"]
@@ -387,6 +388,13 @@ def main():
         default="unet",
         help="model backbone:unet|swintransformer|segresnet|swinunetr",
     )
+    parser.add_argument(
+        "--attn_backend",
+        default="math",
+        help=(
+            "attention backend of swinunetr: math or sdpa (fused, requires torch>=2.0)"
+        ),
+    )
     parser.add_argument("--fold", default=1, type=int, help="data fold")
     args = parser.parse_args()
 
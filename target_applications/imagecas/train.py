@@ -29,6 +29,7 @@ from tensorboardX import SummaryWriter
 from torch.nn.parallel import DistributedDataParallel
 
 from utils.generate_model_medical_net import generate_model
+from utils.memory_planner import configure_activation_checkpointing
 from utils.utils import NUM_CLASS, TEMPLATE, check_data, dice_score, get_key
 
 torch.multiprocessing.set_sharing_strategy("file_system")
@@ -134,6 +135,7 @@ def process(args):
             attn_drop_rate=0.0,
             dropout_path_rate=0.0,
             use_checkpoint=False,
+            attn_backend=args.attn_backend,
         )
         # Load pre-trained weights
         store_dict = model.state_dict()
@@ -263,6 +265,12 @@ def process(args):
         else:
             print("This is SegResNet training from scratch")
 
+    configure_activation_checkpointing(
+        model,
+        args,
+        output_file=os.path.join("out", args.log_name, "memory_plan.json"),
+        verbose=rank == 0,
+    )
     model.to(args.device)
     model.train()
 
@@ -426,6 +434,27 @@ def main():
         default="unet",
         help="model backbone:unet|swintransformer|segresnet|swinunetr",
     )
+    parser.add_argument(
+        "--attn_backend",
+        default="math",
+        help=(
+            "attention backend of swinunetr: math or sdpa (fused, requires torch>=2.0)"
+        ),
+    )
+    parser.add_argument(
+        "--memory_budget",
+        default=None,
+        type=float,
+        help=(
+            "target peak gpu memory in GB. Selects the blocks to checkpoint"
+            " (recompute in the backward pass) after a dry run on the cpu"
+        ),
+    )
+    parser.add_argument(
+        "--memory_plan",
+        default=None,
+        help="reuse a memory_plan.json written by --memory_budget",
+    )
     parser.add_argument("--fold", default=1, type=int, help="data fold")
 
     args = parser.parse_args()
@@ -12,6 +12,7 @@ from monai.inferers import sliding_window_inference
 from monai.networks.nets import SegResNet
 from tqdm import tqdm
 
+from utils.roi_inference import coarse_to_fine_inference, format_timings
 from utils.utils_test import invert_transform
 
 torch.multiprocessing.set_sharing_strategy("file_system")
@@ -23,6 +24,12 @@ def validation(model, ValLoader, val_transforms, args):
         os.makedirs(save_dir)
     model.eval()
     selected_class_map = taskmap_set[args.map_type]
+    # classes whose bounding box the fine pass of --coarse_to_fine covers, all foreground classes by default
+    if args.coarse_classes is None:
+        target_classes = list(range(1, args.num_class))
+    else:
+        class_index = dict([(v, k) for k, v in selected_class_map.items()])
+        target_classes = [class_index[c] for c in args.coarse_classes]
     for index, batch in enumerate(tqdm(ValLoader)):
         image, name = batch["image"].to(args.device), batch["name_img"]
         image_file_path = os.path.join(args.data_root_path, name[0], "ct.nii.gz")
@@ -45,16 +52,32 @@ def validation(model, ValLoader, val_transforms, args):
         original_affine = nib.load(image_file_path).affine
         with torch.no_grad():
             image = batch["image"].to("cuda")  # Ensure images are sent to the GPU
-            val_outputs = sliding_window_inference(
-                image,
-                (args.roi_x, args.roi_y, args.roi_z),
-                1,
-                model,
-                overlap=args.overlap,
-                mode="gaussian",
-                sw_device="cuda",
-                device="cuda",
-            )
+            if args.coarse_to_fine:
+                val_outputs, timings = coarse_to_fine_inference(
+                    image,
+                    model,
+                    (args.roi_x, args.roi_y, args.roi_z),
+                    target_classes,
+                    activation="softmax",
+                    coarse_scale=args.coarse_scale,
+                    coarse_overlap=args.coarse_overlap,
+                    overlap=args.overlap,
+                    margin=args.roi_margin,
+                    sw_device="cuda",
+                    device="cuda",
+                )
+                print("%s: %s" % (name[0], format_timings(timings)))
+            else:
+                val_outputs = sliding_window_inference(
+                    image,
+                    (args.roi_x, args.roi_y, args.roi_z),
+                    1,
+                    model,
+                    overlap=args.overlap,
+                    mode="gaussian",
+                    sw_device="cuda",
+                    device="cuda",
+                )
             val_outputs = F.softmax(val_outputs, dim=1)
             hard_val_outputs = torch.argmax(val_outputs, dim=1).unsqueeze(1)
 
@@ -228,6 +251,13 @@ def main():
     parser.add_argument(
         "--backbone", default="unet", help="backbone [swinunetr or unet]"
     )
+    parser.add_argument(
+        "--attn_backend",
+        default="math",
+        help=(
+            "attention backend of swinunetr: math or sdpa (fused, requires torch>=2.0)"
+        ),
+    )
     parser.add_argument("--create_dataset", action="store_true", default=False)
     parser.add_argument(
         "--saveprobabilities",
@@ -236,6 +266,38 @@ def main():
         help="save the probabilities of the model",
     )
     parser.add_argument("--stage", default="test", help="train or test")
+    parser.add_argument(
+        "--coarse_to_fine",
+        action="store_true",
+        default=False,
+        help=(
+            "localize the target classes with a low resolution pass, then run the full"
+            " resolution sliding window only inside their padded bounding box"
+        ),
+    )
+    parser.add_argument(
+        "--coarse_scale",
+        default=0.5,
+        type=float,
+        help="downsampling factor of the coarse pass",
+    )
+    parser.add_argument(
+        "--coarse_overlap", default=0.25, type=float, help="overlap of the coarse pass"
+    )
+    parser.add_argument(
+        "--roi_margin",
+        default=16,
+        type=int,
+        help="voxels added on each side of the coarse bounding box",
+    )
+    parser.add_argument(
+        "--coarse_classes",
+        nargs="+",
+        default=None,
+        help=(
+            "class names localized by the coarse pass (default: all foreground classes)"
+        ),
+    )
 
     args = parser.parse_args()
 
@@ -284,6 +346,7 @@ def main():
             attn_drop_rate=0.0,
             dropout_path_rate=0.0,
             use_checkpoint=False,
+            attn_backend=args.attn_backend,
         )
         store_dict = model.state_dict()
         model_dict = torch.load(args.checkpoint, map_location="cpu")["net"]
@@ -23,6 +23,8 @@ from optimizers.lr_scheduler import LinearWarmupCosineAnnealingLR
 from tensorboardX import SummaryWriter
 from torch.nn.parallel import DistributedDataParallel
 
+from utils.memory_planner import configure_activation_checkpointing
+
 
 # Set fixed random seed for reproducibility
 def set_seed(seed):
@@ -137,6 +139,7 @@ def process(args):
             attn_drop_rate=0.0,
             dropout_path_rate=0.0,
             use_checkpoint=False,
+            attn_backend=args.attn_backend,
         )
         # Load pre-trained weights
         store_dict = model.state_dict()
@@ -197,6 +200,14 @@ def process(args):
         else:
             print("This is SegResNet training from scratch")
 
+    configure_activation_checkpointing(
+        model,
+        args,
+        output_file=os.path.join(
+            args.log_checkpoint_savepath, args.log_name, "memory_plan.json"
+        ),
+        verbose=rank == 0,
+    )
     model.to(args.device)
     model.train()
 
@@ -407,6 +418,27 @@ def main():
         default="unet",
         help="model backbone, also avaliable for swinunetr",
     )
+    parser.add_argument(
+        "--attn_backend",
+        default="math",
+        help=(
+            "attention backend of swinunetr: math or sdpa (fused, requires torch>=2.0)"
+        ),
+    )
+    parser.add_argument(
+        "--memory_budget",
+        default=None,
+        type=float,
+        help=(
+            "target peak gpu memory in GB. Selects the blocks to checkpoint"
+            " (recompute in the backward pass) after a dry run on the cpu"
+        ),
+    )
+    parser.add_argument(
+        "--memory_plan",
+        default=None,
+        help="reuse a memory_plan.json written by --memory_budget",
+    )
     parser.add_argument(
         "--print_params",
         action="store_true",
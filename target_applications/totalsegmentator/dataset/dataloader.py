@@ -51,6 +51,7 @@ from monai.transforms import (
 )
 
 sys.path.append("..")
+from dataset.h5_store import LoadCaseH5d
 from monai.config import DtypeLike, KeysCollection
 from monai.config.type_definitions import NdarrayOrTensor
 from monai.data import (
@@ -288,13 +289,45 @@ class LoadImaged_totoalseg(MapTransform):
         return organ_lbl, mata_infomation
 
 
+def get_h5_loader(args, crop=True):
+    """
+    LoadImaged_totoalseg + AddChanneld for cases converted by utils/convert_to_h5.py. With crop (and --h5_crop_scale)
+    only the region around the crop center is read
+    """
+    organ_map = totalseg_taskmap_set[args.map_type]
+    return LoadCaseH5d(
+        keys=["image", "label"],
+        class_names=[organ_map[index] for index in sorted(organ_map)],
+        label_mode="index",
+        roi_size=(
+            (args.roi_x, args.roi_y, args.roi_z)
+            if crop and args.h5_crop_scale > 0
+            else None
+        ),
+        pixdim=(args.space_x, args.space_y, args.space_z),
+        crop_scale=args.h5_crop_scale,
+    )
+
+
 def get_loader(args):
-    train_transforms = Compose(
-        [
+    if args.data_format == "h5":
+        train_load_transforms = [get_h5_loader(args)]
+        val_load_transforms = [get_h5_loader(args, crop=False)]
+    else:
+        train_load_transforms = [
             LoadImaged_totoalseg(
                 keys=["image"], map_type=args.map_type
             ),  # 'cardiac', 'organs', 'vertebrae', 'muscles', 'ribs'
             AddChanneld(keys=["image", "label"]),
+        ]
+        val_load_transforms = [
+            LoadImaged_totoalseg(keys=["image"], map_type=args.map_type),
+            AddChanneld(keys=["image", "label"]),
+        ]
+
+    train_transforms = Compose(
+        train_load_transforms
+        + [
             Orientationd(keys=["image", "label"], axcodes="RAS"),
             Spacingd(
                 keys=["image", "label"],
@@ -340,9 +373,8 @@ def get_loader(args):
     )
 
     val_transforms = Compose(
-        [
-            LoadImaged_totoalseg(keys=["image"], map_type=args.map_type),
-            AddChanneld(keys=["image", "label"]),
+        val_load_transforms
+        + [
             Orientationd(keys=["image", "label"], axcodes="RAS"),
             Spacingd(
                 keys=["image", "label"],
@@ -395,7 +427,10 @@ def get_loader(args):
         )
         for line in open(train_txt_path):
             name = line.strip().split("\t")[0]
-            train_img_path = os.path.join(args.dataset_path, name, "ct.nii.gz")
+            if args.data_format == "h5":
+                train_img_path = os.path.join(args.dataset_path, name + ".h5")
+            else:
+                train_img_path = os.path.join(args.dataset_path, name, "ct.nii.gz")
             train_lbl_path = os.path.join(args.dataset_path, name, "segmentations/")
             train_img.append(train_img_path)
             train_lbl.append(train_lbl_path)
@@ -413,7 +448,10 @@ def get_loader(args):
         val_txt_path = os.path.join(args.data_txt_path, "val.txt")
         for line in open(val_txt_path):
             name = line.strip().split("\t")[0]
-            val_img_path = os.path.join(args.dataset_path, name, "ct.nii.gz")
+            if args.data_format == "h5":
+                val_img_path = os.path.join(args.dataset_path, name + ".h5")
+            else:
+                val_img_path = os.path.join(args.dataset_path, name, "ct.nii.gz")
             val_lbl_path = os.path.join(args.dataset_path, name, "segmentations/")
             val_img.append(val_img_path)
             val_lbl.append(val_lbl_path)
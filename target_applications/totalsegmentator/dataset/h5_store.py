@@ -0,0 +1,122 @@
+import math
+from typing import Optional, Sequence
+
+import h5py
+import numpy as np
+import torch
+from monai.config import KeysCollection
+from monai.data import MetaTensor
+from monai.transforms import MapTransform, Randomizable
+
+try:
+    # registers the blosc/lz4 filters of files written with --compression blosc or lz4
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+def unpack_labels(packed, bits):
+    """
+    :param packed: bit packed label (see utils/convert_to_h5.py)
+    :param bits: bit of every output channel, None for a class missing in the case (all zeros)
+    :return: (len(bits), X, Y, Z) uint8 masks
+    """
+    label = np.zeros((len(bits),) + packed.shape, dtype=np.uint8)
+    for channel, bit in enumerate(bits):
+        if bit is not None:
+            label[channel] = (packed >> packed.dtype.type(bit)) & 1
+    return label
+
+
+def crop_affine(affine, start):
+    affine = np.array(affine, dtype=np.float64)
+    affine[:3, 3] = affine[:3, :3] @ np.asarray(start, dtype=np.float64) + affine[:3, 3]
+    return affine
+
+
+class LoadCaseH5d(Randomizable, MapTransform):
+    """
+    Loads the image and label of a case converted by utils/convert_to_h5.py (one chunked HDF5 file per case).
+
+    Without roi_size the whole case is read. With roi_size only a region around a random center is read from disk:
+    roi_size voxels at the pixdim spacing, scaled by crop_scale so that the following spatial transforms
+    (Spacingd, RandCropByPosNegLabeld) still have room. The center is a stored foreground voxel with probability
+    pos / (pos + neg), a uniformly random voxel otherwise, as in RandCropByPosNegLabeld.
+
+    Args:
+        keys: image and label keys, the value of the image key is the path of the h5 file.
+        class_names: label channels, in order.
+        label_mode: "channels" gives one channel per class name (as LoadSelectedImaged), "index" a single channel
+            with the position of the class in class_names (1 based, as LoadImaged_totoalseg).
+        roi_size, pixdim, crop_scale, pos, neg: region read from disk, see above.
+    """
+
+    def __init__(
+        self,
+        keys: KeysCollection,
+        class_names: Sequence[str],
+        label_mode: str = "channels",
+        roi_size: Optional[Sequence[int]] = None,
+        pixdim: Optional[Sequence[float]] = None,
+        crop_scale: float = 1.5,
+        pos: float = 2.0,
+        neg: float = 1.0,
+        allow_missing_keys: bool = False,
+    ) -> None:
+        super().__init__(keys, allow_missing_keys)
+        if label_mode not in ("channels", "index"):
+            raise ValueError(
+                "label_mode should be channels or index, got %s" % label_mode
+            )
+        self.image_key, self.label_key = self.keys
+        self.class_names = list(class_names)
+        self.label_mode = label_mode
+        self.roi_size = roi_size
+        self.pixdim = pixdim
+        self.crop_scale = crop_scale
+        self.pos_ratio = pos / (pos + neg)
+
+    def randomize(self, shape, spacing, foreground):
+        if self.roi_size is None:
+            return tuple(slice(0, s) for s in shape)
+        size = []
+        for roi, target, native, s in zip(self.roi_size, self.pixdim, spacing, shape):
+            size.append(min(int(math.ceil(roi * target / native * self.crop_scale)), s))
+        if len(foreground) > 0 and self.R.rand() < self.pos_ratio:
+            center = foreground[self.R.randint(len(foreground))]
+        else:
+            center = [self.R.randint(s) for s in shape]
+        box = []
+        for c, sz, s in zip(center, size, shape):
+            start = int(np.clip(c - sz // 2, 0, s - sz))
+            box.append(slice(start, start + sz))
+        return tuple(box)
+
+    def __call__(self, data):
+        d = dict(data)
+        path = d[self.image_key]
+        with h5py.File(path, "r") as h5f:
+            affine = np.array(h5f.attrs["affine_matrix"])
+            stored_names = [str(name) for name in h5f.attrs["class_names"]]
+            box = self.randomize(
+                h5f["image"].shape, h5f.attrs["spacing"], h5f["foreground"][...]
+            )
+            image = h5f["image"][box].astype(np.float32)
+            packed = h5f["label"][box]
+
+        bits = [
+            stored_names.index(name) if name in stored_names else None
+            for name in self.class_names
+        ]
+        label = unpack_labels(packed, bits)
+        if self.label_mode == "index":
+            index_label = np.zeros((1,) + packed.shape, dtype=np.uint8)
+            for channel in range(len(bits)):
+                index_label[0][label[channel] == 1] = channel + 1
+            label = index_label
+
+        affine = torch.as_tensor(crop_affine(affine, [s.start for s in box]))
+        meta = {"filename_or_obj": path, "spatial_shape": np.array(image.shape)}
+        d[self.image_key] = MetaTensor(image[None], affine=affine, meta=dict(meta))
+        d[self.label_key] = MetaTensor(label, affine=affine.clone(), meta=dict(meta))
+        return d
@@ -233,6 +233,7 @@ def process(args):
             attn_drop_rate=0.0,
             dropout_path_rate=0.0,
             use_checkpoint=False,
+            attn_backend=args.attn_backend,
         )
         store_dict = model.state_dict()
         model_dict = torch.load(args.pretrain)["net"]
@@ -257,6 +258,7 @@ def process(args):
             attn_drop_rate=0.0,
             dropout_path_rate=0.0,
             use_checkpoint=False,
+            attn_backend=args.attn_backend,
         )
         store_dict = model.state_dict()
         model_dict = torch.load(args.pretrain)["net"]
@@ -466,6 +468,13 @@ def main():
         default="unet",
         help="model backbone, also avaliable for swinunetr",
     )
+    parser.add_argument(
+        "--attn_backend",
+        default="math",
+        help=(
+            "attention backend of swinunetr: math or sdpa (fused, requires torch>=2.0)"
+        ),
+    )
     parser.add_argument(
         "--train_type", default="scratch", help="either train from scratch or transfer"
     )
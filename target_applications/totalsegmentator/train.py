@@ -27,6 +27,7 @@ from optimizers.lr_scheduler import LinearWarmupCosineAnnealingLR
 from tensorboardX import SummaryWriter
 from torch.nn.parallel import DistributedDataParallel
 
+from utils.memory_planner import configure_activation_checkpointing
 from utils.utils import NUM_CLASS, TEMPLATE, check_data, dice_score, get_key
 
 torch.multiprocessing.set_sharing_strategy("file_system")
@@ -121,6 +122,7 @@ def process(args):
             attn_drop_rate=0.0,
             dropout_path_rate=0.0,
             use_checkpoint=False,
+            attn_backend=args.attn_backend,
         )
         store_dict = model.state_dict()
         model_dict = torch.load(args.pretrain, map_location="cpu")["state_dict"]
@@ -148,6 +150,7 @@ def process(args):
             attn_drop_rate=0.0,
             dropout_path_rate=0.0,
             use_checkpoint=False,
+            attn_backend=args.attn_backend,
         )
         store_dict = model.state_dict()
         model_dict = torch.load(args.pretrain)["state_dict"]
@@ -171,6 +174,7 @@ def process(args):
             attn_drop_rate=0.0,
             dropout_path_rate=0.0,
             use_checkpoint=False,
+            attn_backend=args.attn_backend,
         )
         ssl_dict = torch.load(args.pretrain)
         ssl_weights = ssl_dict["model"]
@@ -229,6 +233,7 @@ def process(args):
             attn_drop_rate=0.0,
             dropout_path_rate=0.0,
             use_checkpoint=False,
+            attn_backend=args.attn_backend,
         )
         # Load pre-trained weights
         store_dict = model.state_dict()
@@ -289,6 +294,12 @@ def process(args):
         else:
             print("This is SegResNet training from scratch")
 
+    configure_activation_checkpointing(
+        model,
+        args,
+        output_file="out/" + args.log_name + "/memory_plan.json",
+        verbose=rank == 0,
+    )
     model.to(args.device)
     model.train()
 
@@ -517,9 +528,48 @@ def main():
         default="unet",
         help="model backbone, also avaliable for swinunetr",
     )
+    parser.add_argument(
+        "--attn_backend",
+        default="math",
+        help=(
+            "attention backend of swinunetr: math or sdpa (fused, requires torch>=2.0)"
+        ),
+    )
+    parser.add_argument(
+        "--memory_budget",
+        default=None,
+        type=float,
+        help=(
+            "target peak gpu memory in GB. Selects the blocks to checkpoint"
+            " (recompute in the backward pass) after a dry run on the cpu"
+        ),
+    )
+    parser.add_argument(
+        "--memory_plan",
+        default=None,
+        help="reuse a memory_plan.json written by --memory_budget",
+    )
     parser.add_argument(
         "--percent", default=1081, type=int, help="percent of training data"
     )
+    parser.add_argument(
+        "--data_format",
+        default="nifti",
+        choices=["nifti", "h5"],
+        help=(
+            "nifti: case/ct.nii.gz and case/segmentations/*.nii.gz, h5: case.h5"
+            " written by utils/convert_to_h5.py (train and val)"
+        ),
+    )
+    parser.add_argument(
+        "--h5_crop_scale",
+        default=1.5,
+        type=float,
+        help=(
+            "h5 only. read a region of this many rois around the crop center instead"
+            " of the whole case, 0 reads the whole case"
+        ),
+    )
 
     args = parser.parse_args()
 
@@ -1,31 +1,119 @@
 """
 source /data/zzhou82/environments/syn/bin/activate
-python -W ignore annotation_quality_assessment.py --datapath /Volumes/T9/AbdomenAtlasPro -o /Users/zongweizhou/Desktop/error_analysis --aorta --csvname aorta.csv
-python -W ignore annotation_quality_assessment.py --datapath /Volumes/T9/AbdomenAtlasPro -o /Users/zongweizhou/Desktop/error_analysis --kidney --csvname kidney.csv
+python -W ignore annotation_quality_assessment.py --datapath /Volumes/T9/AbdomenAtlasPro -o /Users/zongweizhou/Desktop/error_analysis
+python -W ignore annotation_quality_assessment.py --datapath /Volumes/T9/AbdomenAtlasPro -o /Users/zongweizhou/Desktop/error_analysis --rules aorta
+python -W ignore annotation_quality_assessment.py --datapath /Volumes/T9/AbdomenAtlasPro -o /Users/zongweizhou/Desktop/error_analysis --update
+
+All selected rules run in a single pass: the masks of a case are loaded once (the union of the masks the rules need)
+and the cases are processed in parallel. The report (--csvname) has one row per case and, per rule, whether an error
+was detected and its value. <rule>.csv lists the error cases of each rule (input of annotation_transfer.py).
+With --update, rules already in the report are not recomputed, so adding a rule only loads the masks it needs.
 """
 
 import argparse
 import csv
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
 
 from helper_functions import *
+from tqdm import tqdm
+
+# rule name -> (masks the rule reads, function(pid, masks) -> (error detected, value))
+RULES = {}
+
+
+def register_rule(name, class_names):
+    def register(fn):
+        RULES[name] = (list(class_names), fn)
+        return fn
+
+    return register
+
+
+@register_rule("aorta", ["liver", "aorta", "lung_left", "lung_right", "postcava"])
+def aorta_rule(pid, masks):
+    return aorta_error_masks(pid, masks)
+
+
+@register_rule("kidney", ["kidney_left", "kidney_right"])
+def kidney_rule(pid, masks):
+    return kidney_error_masks(pid, masks)
 
 
-def error_detection_per_case(pid, args):
-    if args.aorta:
-        return aorta_error(pid, args.datapath)
-    if args.kidney:
-        return kidney_error(pid, args.datapath)
+def error_detection_per_case(pid, rules, datapath):
+    """
+    :return: dict rule -> (error detected, value) for the rules of a case
+    """
+    class_names = []
+    for rule in rules:
+        for class_name in RULES[rule][0]:
+            if class_name not in class_names:
+                class_names.append(class_name)
+    masks = load_case_masks(pid, class_names, datapath)
+    return dict([(rule, RULES[rule][1](pid, masks)) for rule in rules])
+
+
+def load_report(report_file):
+    """
+    :return: dict pid -> dict rule -> (error detected, value), from a report written by write_report
+    """
+    results = {}
+    if not os.path.isfile(report_file):
+        return results
+    with open(report_file, newline="") as csvfile:
+        reader = csv.DictReader(csvfile)
+        rules = [c for c in reader.fieldnames if c in RULES]
+        for row in reader:
+            results[row["Patient ID"]] = dict(
+                [
+                    (rule, (row[rule] == "1", float(row[rule + " value"])))
+                    for rule in rules
+                    if row[rule] != ""
+                ]
+            )
+    return results
+
+
+def write_report(report_file, results, rules):
+    tmp_file = report_file + ".tmp"
+    with open(tmp_file, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        header = ["Patient ID"]
+        for rule in rules:
+            header += [rule, rule + " value"]
+        writer.writerow(header)
+        for pid in sorted(results):
+            row = [pid]
+            for rule in rules:
+                if rule in results[pid]:
+                    error_detected, value = results[pid][rule]
+                    row += [int(error_detected), value]
+                else:
+                    row += ["", ""]
+            writer.writerow(row)
+    os.replace(tmp_file, report_file)
 
 
 def main(args):
-    if os.path.isfile(os.path.join(args.csvpath, args.csvname)):
-        os.remove(os.path.join(args.csvpath, args.csvname))
+    rules = list(args.rules)
+    # the single rule flags of the former interface
+    if args.aorta and "aorta" not in rules:
+        rules.append("aorta")
+    if args.kidney and "kidney" not in rules:
+        rules.append("kidney")
+    if len(rules) == 0:
+        rules = list(RULES)
+    for rule in rules:
+        if rule not in RULES:
+            raise ValueError(
+                "unknown rule {}, registered rules: {}".format(rule, ", ".join(RULES))
+            )
+
     if not os.path.exists(args.csvpath):
         os.makedirs(args.csvpath)
-    with open(os.path.join(args.csvpath, args.csvname), "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["Patient ID"])
+    report_file = os.path.join(args.csvpath, args.csvname)
+    results = load_report(report_file) if args.update else {}
 
     folder_names = [
         name
@@ -33,26 +121,58 @@ def main(args):
         if os.path.isdir(os.path.join(args.datapath, name))
     ]
     folder_names = sorted(folder_names)
-    error_list = []
-
+    todo = {}
     for pid in folder_names:
-        error_detected = error_detection_per_case(pid, args)
-        if error_detected:
-            error_list.append(pid)
-
-            with open(
-                os.path.join(args.csvpath, args.csvname), "a", newline=""
-            ) as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow([pid])
+        missing = [rule for rule in rules if rule not in results.get(pid, {})]
+        if len(missing) > 0:
+            todo[pid] = missing
 
     print(
-        "\n> Overall error report {:.1f}% = {}/{}".format(
-            100.0 * len(error_list) / len(folder_names),
-            len(error_list),
+        ">> {} rules ({}) on {} cases, {} cases to process with {} workers".format(
+            len(rules),
+            ", ".join(rules),
             len(folder_names),
+            len(todo),
+            args.num_workers,
         )
     )
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        futures = {
+            executor.submit(error_detection_per_case, pid, missing, args.datapath): pid
+            for pid, missing in todo.items()
+        }
+
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            pid = futures[future]
+            try:
+                results.setdefault(pid, {}).update(future.result())
+            except Exception as e:
+                print(f"Error processing {pid}: {e}")
+
+    all_rules = rules + sorted(
+        set(rule for r in results.values() for rule in r if rule not in rules)
+    )
+    write_report(report_file, results, all_rules)
+
+    for rule in rules:
+        error_list = sorted(
+            pid for pid in folder_names if results.get(pid, {}).get(rule, (False,))[0]
+        )
+        with open(
+            os.path.join(args.csvpath, rule + ".csv"), "w", newline=""
+        ) as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["Patient ID"])
+            for pid in error_list:
+                writer.writerow([pid])
+        print(
+            "\n> Overall {} error report {:.1f}% = {}/{}".format(
+                rule,
+                100.0 * len(error_list) / max(len(folder_names), 1),
+                len(error_list),
+                len(folder_names),
+            )
+        )
 
 
 if __name__ == "__main__":
@@ -75,8 +195,16 @@ if __name__ == "__main__":
         "--csvname",
         dest="csvname",
         type=str,
-        default="aorta.csv",
-        help="the directory of the saved csv file recording all the error cases",
+        default="annotation_quality.csv",
+        help="the report with one row per case and one column per rule",
+    )
+    parser.add_argument(
+        "--rules",
+        nargs="*",
+        default=[],
+        help="rules to check (default: all registered rules: {})".format(
+            ", ".join(RULES)
+        ),
     )
     parser.add_argument(
         "--aorta",
@@ -90,6 +218,15 @@ if __name__ == "__main__":
         default=False,
         help="check label quality for kidney?",
     )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        default=False,
+        help="keep the results of the existing report, only run the missing rules",
+    )
+    parser.add_argument(
+        "--num_workers", default=cpu_count(), type=int, help="parallel cases"
+    )
     args = parser.parse_args()
 
     main(args)
@@ -1,15 +1,98 @@
 """
 source /data/zzhou82/environments/syn/bin/activate
-python -W ignore annotation_quality_assessment.py --datapath /Volumes/T9/AbdomenAtlasPro --aorta
+python -W ignore annotation_refinement.py --datapath /Volumes/T9/AbdomenAtlasPro --kidney
+python -W ignore annotation_refinement.py --datapath /Volumes/T9/AbdomenAtlasPro --fixes kidney_largest_cc kidney_overlap --dry_run
+python -W ignore annotation_refinement.py --datapath /Volumes/T9/AbdomenAtlasPro --fixes kidney_overlap --manifest refinement.jsonl
+
+The selected fixes run in a single pass per case on uint8 masks, cases are processed in parallel. Only the masks a fix
+changed are written, to a temporary file that is then renamed over the original. With --dry_run nothing is written
+and the number of changed voxels per mask is printed. Every processed case is appended to the manifest (jsonl), a
+rerun skips the cases already refined with the same fixes.
 """
 
 import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
 
 from helper_functions import *
+from tqdm import tqdm
+
+# fix name -> (masks the fix reads, function(masks) -> dict of the changed masks)
+FIXES = {}
+
+
+def register_fix(name, class_names):
+    def register(fn):
+        FIXES[name] = (list(class_names), fn)
+        return fn
+
+    return register
+
+
+@register_fix("kidney_largest_cc", ["kidney_left", "kidney_right"])
+def kidney_largest_cc_fix(masks):
+    return dict(
+        [
+            (class_name, largest_cc_fix(masks[class_name]))
+            for class_name in ["kidney_left", "kidney_right"]
+        ]
+    )
+
+
+@register_fix("kidney_overlap", ["kidney_left", "kidney_right"])
+def kidney_overlap_fix(masks):
+    kidney_left, kidney_right = overlap_fix(masks["kidney_left"], masks["kidney_right"])
+    return {"kidney_left": kidney_left, "kidney_right": kidney_right}
+
+
+def refine_case(pid, fixes, datapath, dry_run=False):
+    """
+    :return: dict class name -> number of voxels changed by the fixes, for the masks that changed
+    """
+    class_names = []
+    for fix in fixes:
+        for class_name in FIXES[fix][0]:
+            if class_name not in class_names:
+                class_names.append(class_name)
+    masks, headers = {}, {}
+    for class_name in class_names:
+        data, affine, header = load_mask(pid, class_name, datapath)
+        masks[class_name] = data
+        headers[class_name] = (affine, header)
+
+    original = dict(masks)
+    for fix in fixes:
+        masks.update(FIXES[fix][1](masks))
+
+    changed = {}
+    for class_name in class_names:
+        if masks[class_name] is None or masks[class_name] is original[class_name]:
+            continue
+        num_voxels = int(np.count_nonzero(masks[class_name] != original[class_name]))
+        if num_voxels == 0:
+            continue
+        changed[class_name] = num_voxels
+        if not dry_run:
+            affine, header = headers[class_name]
+            save_mask(masks[class_name], affine, header, pid, class_name, datapath)
+    return changed
 
 
 def main(args):
+    fixes = list(args.fixes)
+    # the single class flag of the former interface
+    if args.kidney and "kidney_largest_cc" not in fixes:
+        fixes.append("kidney_largest_cc")
+    if len(fixes) == 0:
+        print(">> no fix selected, registered fixes: {}".format(", ".join(FIXES)))
+        return
+    for fix in fixes:
+        if fix not in FIXES:
+            raise ValueError(
+                "unknown fix {}, registered fixes: {}".format(fix, ", ".join(FIXES))
+            )
+
     folder_names = [
         name
         for name in os.listdir(args.datapath)
@@ -17,9 +100,70 @@ def main(args):
     ]
     folder_names = sorted(folder_names)
 
-    for pid in folder_names:
-        if args.kidney:
-            kidney_postprocessing(pid, args.datapath)
+    done = set()
+    if args.manifest is not None and not args.dry_run:
+        done = set(
+            record["pid"]
+            for record in read_manifest(args.manifest)
+            if record.get("fixes") == fixes
+        )
+    todo = [pid for pid in folder_names if pid not in done]
+
+    print(
+        ">> {} fixes ({}) on {} cases, {} cases to process with {} workers{}".format(
+            len(fixes),
+            ", ".join(fixes),
+            len(folder_names),
+            len(todo),
+            args.num_workers,
+            " (dry run)" if args.dry_run else "",
+        )
+    )
+    manifest = None
+    if args.manifest is not None and not args.dry_run:
+        manifest = open(args.manifest, "a")
+    num_changed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+            futures = {
+                executor.submit(
+                    refine_case, pid, fixes, args.datapath, args.dry_run
+                ): pid
+                for pid in todo
+            }
+
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                pid = futures[future]
+                try:
+                    changed = future.result()
+                except Exception as e:
+                    print(f"Error processing {pid}: {e}")
+                    continue
+                if len(changed) > 0:
+                    num_changed += 1
+                    if args.dry_run:
+                        print(
+                            "{}: {}".format(
+                                pid,
+                                ", ".join(
+                                    "{} {} voxels".format(class_name, num_voxels)
+                                    for class_name, num_voxels in changed.items()
+                                ),
+                            )
+                        )
+                if manifest is not None:
+                    append_manifest(
+                        manifest, {"pid": pid, "fixes": fixes, "changed": changed}
+                    )
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+    print(
+        "\n> {} {}/{} cases".format(
+            "Would change" if args.dry_run else "Changed", num_changed, len(todo)
+        )
+    )
 
 
 if __name__ == "__main__":
@@ -31,6 +175,12 @@ if __name__ == "__main__":
         default="/Volumes/T9/AbdomenAtlasPro",
         help="the directory of the AbdomenAtlas dataset",
     )
+    parser.add_argument(
+        "--fixes",
+        nargs="*",
+        default=[],
+        help="fixes to apply, in order (registered fixes: {})".format(", ".join(FIXES)),
+    )
     parser.add_argument(
         "--aorta",
         action="store_true",
@@ -41,7 +191,22 @@ if __name__ == "__main__":
         "--kidney",
         action="store_true",
         default=False,
-        help="check label quality for kidney?",
+        help="keep the largest connected component of the kidneys (kidney_largest_cc)",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        default=False,
+        help="print the changed voxels per mask without writing",
+    )
+    parser.add_argument(
+        "--manifest",
+        default=None,
+        type=str,
+        help="jsonl of the refined cases, cases already in it are skipped",
+    )
+    parser.add_argument(
+        "--num_workers", default=cpu_count(), type=int, help="parallel cases"
     )
     args = parser.parse_args()
 
@@ -3,14 +3,57 @@ source /data/zzhou82/environments/syn/bin/activate
 python -W ignore annotation_transfer.py --source_datapath /Volumes/T9/HGFC_inference_separate_data --destination_datapath /Volumes/T9/AbdomenAtlasPro -o error_analysis/aorta.csv -c aorta
 python -W ignore annotation_transfer.py --source_datapath /Volumes/T9/HGFC_inference_separate_data --destination_datapath /Volumes/T9/AbdomenAtlasPro -o error_analysis/kidney.csv -c kidney_left
 python -W ignore annotation_transfer.py --source_datapath /Volumes/Expansion/AbdomenAtlas/AbdomenAtlasPro --destination_datapath /Volumes/T9/AbdomenAtlasPro -o /Volumes/T9/error_analysis/aorta.csv -c aorta
+python -W ignore annotation_transfer.py --source_datapath /Volumes/T9/HGFC_inference_separate_data --destination_datapath /Volumes/T9/AbdomenAtlasPro -o error_analysis/kidney.csv -c kidney_left kidney_right --dry_run
+
+The masks of the error cases are copied in parallel, each to a temporary file renamed over the destination. With
+--dry_run nothing is copied and the number of voxels each copy would change is printed. Every transferred case is
+appended to the manifest (jsonl), a rerun skips the cases already transferred for the same classes.
 """
 
 import argparse
 import csv
 import os
-import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
 
 from helper_functions import *
+from tqdm import tqdm
+
+
+def changed_voxels(source_path, destination_path):
+    source = np.asanyarray(nib.load(source_path).dataobj).astype(np.uint8)
+    if not os.path.isfile(destination_path):
+        return int(np.count_nonzero(source))
+    destination = np.asanyarray(nib.load(destination_path).dataobj).astype(np.uint8)
+    if source.shape != destination.shape:
+        raise ValueError(
+            "{} has shape {}, {} {}".format(
+                source_path, source.shape, destination_path, destination.shape
+            )
+        )
+    return int(np.count_nonzero(source != destination))
+
+
+def transfer_case(pid, class_names, source_datapath, destination_datapath, dry_run):
+    """
+    :return: dict class name -> number of changed voxels (dry run) or None (copied)
+    """
+    transferred = {}
+    for class_name in class_names:
+        source_path = os.path.join(
+            source_datapath, pid, "segmentations", class_name + ".nii.gz"
+        )
+        destination_path = os.path.join(
+            destination_datapath, pid, "segmentations", class_name + ".nii.gz"
+        )
+        if not os.path.isfile(source_path):
+            raise FileNotFoundError("no such file {}".format(source_path))
+        if dry_run:
+            transferred[class_name] = changed_voxels(source_path, destination_path)
+        else:
+            copy_file_atomic(source_path, destination_path)
+            transferred[class_name] = None
+    return transferred
 
 
 def main(args):
@@ -22,17 +65,65 @@ def main(args):
         for row in reader:
             error_id_list.append(row[0])
 
-    for pid in error_id_list:
-        source_path = os.path.join(
-            args.source_datapath, pid, "segmentations", args.class_name + ".nii.gz"
+    done = set()
+    if args.manifest is not None and not args.dry_run:
+        done = set(
+            record["pid"]
+            for record in read_manifest(args.manifest)
+            if record.get("class_names") == args.class_names
         )
-        destination_path = os.path.join(
-            args.destination_datapath, pid, "segmentations", args.class_name + ".nii.gz"
+    todo = [pid for pid in error_id_list if pid not in done]
+
+    print(
+        ">> {} of {} cases to transfer ({}) with {} workers{}".format(
+            len(todo),
+            len(error_id_list),
+            ", ".join(args.class_names),
+            args.num_workers,
+            " (dry run)" if args.dry_run else "",
         )
-        if os.path.isfile(source_path):
-            shutil.copy(source_path, destination_path)
-        else:
-            print(">> Error: no such file {}".format(source_path))
+    )
+    manifest = None
+    if args.manifest is not None and not args.dry_run:
+        manifest = open(args.manifest, "a")
+    try:
+        with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+            futures = {
+                executor.submit(
+                    transfer_case,
+                    pid,
+                    args.class_names,
+                    args.source_datapath,
+                    args.destination_datapath,
+                    args.dry_run,
+                ): pid
+                for pid in todo
+            }
+
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                pid = futures[future]
+                try:
+                    transferred = future.result()
+                except Exception as e:
+                    print(f"Error processing {pid}: {e}")
+                    continue
+                if args.dry_run:
+                    print(
+                        "{}: {}".format(
+                            pid,
+                            ", ".join(
+                                "{} {} voxels".format(class_name, num_voxels)
+                                for class_name, num_voxels in transferred.items()
+                            ),
+                        )
+                    )
+                if manifest is not None:
+                    append_manifest(
+                        manifest, {"pid": pid, "class_names": args.class_names}
+                    )
+    finally:
+        if manifest is not None:
+            manifest.close()
 
 
 if __name__ == "__main__":
@@ -60,10 +151,26 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "-c",
-        dest="class_name",
+        dest="class_names",
+        nargs="+",
+        type=str,
+        default=["aorta"],
+        help="the class names in error cases",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        default=False,
+        help="print the changed voxels per mask without copying",
+    )
+    parser.add_argument(
+        "--manifest",
+        default=None,
         type=str,
-        default="aorta",
-        help="the class name in error cases",
+        help="jsonl of the transferred cases, cases already in it are skipped",
+    )
+    parser.add_argument(
+        "--num_workers", default=cpu_count(), type=int, help="parallel cases"
     )
     args = parser.parse_args()
 
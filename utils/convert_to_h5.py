@@ -0,0 +1,249 @@
+"""
+python convert_to_h5.py --src_dir /Users/zongwei.zhou/Desktop/AbdomenAtlas_Core --dst_dir /Users/zongwei.zhou/Desktop/AbdomenAtlas_Core_H5
+python convert_to_h5.py --src_dir /Users/zongwei.zhou/Desktop/AbdomenAtlas_Core --dst_dir /Users/zongwei.zhou/Desktop/AbdomenAtlas_Core_H5 --benchmark 10
+
+Converts every case of a BDMAP style dataset (case/ct.nii.gz, case/segmentations/*.nii.gz) into a single chunked
+HDF5 file case.h5, read by LoadCaseH5d (supervised_pretraining/dataset/h5_store.py):
+- image: ct in RAS orientation (nib.as_closest_canonical), int16, chunked
+- label: all organ masks bit packed into one dataset, bit k is class_names[k]
+- foreground: random sample of the foreground voxel coordinates, used to draw positive crops without reading the label
+- attrs: affine_matrix (of the RAS volume), spacing, class_names, and the ct header in the header group as in
+standardization_V3.py
+Chunks are compressed with blosc/lz4 if hdf5plugin is installed, otherwise with lzf (built into h5py).
+"""
+
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
+
+import h5py
+import nibabel as nib
+import numpy as np
+from tqdm import tqdm
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+H5_FORMAT_VERSION = 1
+COMPRESSIONS = ["blosc", "lz4", "lzf", "gzip", "none"]
+
+
+def compression_kwargs(compression):
+    if compression in ("blosc", "lz4") and hdf5plugin is None:
+        print("hdf5plugin is not installed, using lzf instead of %s" % compression)
+        compression = "lzf"
+    if compression == "blosc":
+        return dict(
+            hdf5plugin.Blosc(cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE)
+        )
+    if compression == "lz4":
+        return dict(hdf5plugin.LZ4())
+    if compression == "lzf":
+        return {"compression": "lzf", "shuffle": True}
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": 1, "shuffle": True}
+    return {}
+
+
+def label_dtype(num_classes):
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if num_classes <= np.iinfo(dtype).bits:
+            return dtype
+    raise ValueError("at most 64 classes can be bit packed, got %d" % num_classes)
+
+
+def load_canonical(nifti_path):
+    """
+    volume in RAS orientation without going through float64: integer data stays integer
+    """
+    nii_img = nib.as_closest_canonical(nib.load(nifti_path))
+    return np.asanyarray(nii_img.dataobj), nii_img
+
+
+def convert_case(case_dir, h5_path, args):
+    image, ct_img = load_canonical(os.path.join(case_dir, "ct.nii.gz"))
+    if image.dtype.kind == "f":
+        image = np.round(image)
+    image = np.clip(image, -32768, 32767).astype(np.int16)
+
+    mask_files = sorted(glob.glob(os.path.join(case_dir, "segmentations", "*.nii.gz")))
+    class_names = [os.path.basename(f)[: -len(".nii.gz")] for f in mask_files]
+    dtype = label_dtype(len(class_names))
+    label = np.zeros(image.shape, dtype=dtype)
+    for bit, mask_file in enumerate(mask_files):
+        mask, _ = load_canonical(mask_file)
+        if mask.shape != image.shape:
+            raise ValueError(
+                "%s has shape %s, the ct %s" % (mask_file, mask.shape, image.shape)
+            )
+        label[mask > 0] |= dtype(1 << bit)
+
+    foreground = np.argwhere(label != 0).astype(np.int32)
+    if len(foreground) > args.foreground_samples:
+        rng = np.random.RandomState(0)
+        foreground = foreground[
+            rng.choice(len(foreground), args.foreground_samples, replace=False)
+        ]
+
+    chunks = tuple(min(args.chunk_size, s) for s in image.shape)
+    kwargs = compression_kwargs(args.compression)
+    tmp_path = h5_path + ".tmp"
+    with h5py.File(tmp_path, "w") as h5f:
+        h5f.create_dataset("image", data=image, chunks=chunks, **kwargs)
+        h5f.create_dataset("label", data=label, chunks=chunks, **kwargs)
+        h5f.create_dataset("foreground", data=foreground)
+        h5f.attrs["version"] = H5_FORMAT_VERSION
+        h5f.attrs["affine_matrix"] = ct_img.affine.tolist()
+        h5f.attrs["spacing"] = [float(s) for s in ct_img.header.get_zooms()[:3]]
+        h5f.attrs["class_names"] = class_names
+        header_group = h5f.create_group("header")
+        for key, value in ct_img.header.items():
+            header_group.attrs[key] = value
+    os.replace(tmp_path, h5_path)
+
+
+def benchmark(case_ids, args):
+    """
+    read throughput of the nifti files (ct and all masks, as the training loaders read them) and of the h5 files
+    (whole case, and one random roi of --roi voxels)
+    """
+    rng = np.random.RandomState(0)
+    timings = {"nii.gz": [], "h5": [], "h5 roi": []}
+    num_voxels = {"nii.gz": 0, "h5": 0, "h5 roi": 0}
+    for case_id in case_ids:
+        case_dir = os.path.join(args.src_dir, case_id)
+        h5_path = os.path.join(args.dst_dir, case_id + ".h5")
+
+        start = time.time()
+        image = nib.load(os.path.join(case_dir, "ct.nii.gz")).get_fdata()
+        for mask_file in glob.glob(os.path.join(case_dir, "segmentations", "*.nii.gz")):
+            nib.load(mask_file).get_fdata()
+        num_voxels["nii.gz"] += image.size
+        timings["nii.gz"].append(time.time() - start)
+
+        start = time.time()
+        with h5py.File(h5_path, "r") as h5f:
+            image = h5f["image"][...]
+            label = h5f["label"][...]
+        num_voxels["h5"] += image.size
+        timings["h5"].append(time.time() - start)
+
+        start = time.time()
+        with h5py.File(h5_path, "r") as h5f:
+            shape = h5f["image"].shape
+            lower = [rng.randint(0, max(s - args.roi, 0) + 1) for s in shape]
+            index = tuple(slice(lo, lo + args.roi) for lo in lower)
+            image = h5f["image"][index]
+            label = h5f["label"][index]
+        num_voxels["h5 roi"] += image.size
+        timings["h5 roi"].append(time.time() - start)
+
+    for name, values in timings.items():
+        print(
+            "%-7s %7.3f s/case  %8.1f M voxels/s (ct and all masks)"
+            % (
+                name,
+                np.mean(values),
+                num_voxels[name] / 1e6 / max(np.sum(values), 1e-9),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--src_dir", default=None, type=str, help="the directory of nifti cases"
+    )
+    parser.add_argument(
+        "--dst_dir", default=None, type=str, help="the directory of the h5 files"
+    )
+    parser.add_argument(
+        "--chunk_size", default=64, type=int, help="edge length of the h5 chunks"
+    )
+    parser.add_argument(
+        "--compression",
+        default="blosc",
+        choices=COMPRESSIONS,
+        help="blosc (lz4 + byte shuffle) and lz4 need hdf5plugin",
+    )
+    parser.add_argument(
+        "--foreground_samples",
+        default=20000,
+        type=int,
+        help="foreground voxel coordinates stored for positive crops",
+    )
+    parser.add_argument(
+        "--num_workers", default=cpu_count(), type=int, help="conversion processes"
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="convert cases that already exist"
+    )
+    parser.add_argument(
+        "--benchmark",
+        default=0,
+        type=int,
+        help="afterwards, compare read throughput on this many converted cases",
+    )
+    parser.add_argument(
+        "--roi", default=96, type=int, help="roi edge length of the benchmark"
+    )
+
+    args = parser.parse_args()
+
+    assert args.src_dir is not None
+    assert args.dst_dir is not None
+
+    if not os.path.exists(args.dst_dir):
+        os.makedirs(args.dst_dir)
+
+    case_ids = sorted(
+        f
+        for f in os.listdir(args.src_dir)
+        if os.path.isfile(os.path.join(args.src_dir, f, "ct.nii.gz"))
+    )
+    todo = [
+        case_id
+        for case_id in case_ids
+        if args.overwrite
+        or not os.path.isfile(os.path.join(args.dst_dir, case_id + ".h5"))
+    ]
+    print(
+        ">> {} of {} cases to convert with {} processes".format(
+            len(todo), len(case_ids), args.num_workers
+        )
+    )
+
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        futures = {
+            executor.submit(
+                convert_case,
+                os.path.join(args.src_dir, case_id),
+                os.path.join(args.dst_dir, case_id + ".h5"),
+                args,
+            ): case_id
+            for case_id in todo
+        }
+
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            case_id = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error processing {case_id}: {e}")
+
+    if args.benchmark > 0:
+        converted = [
+            case_id
+            for case_id in case_ids
+            if os.path.isfile(os.path.join(args.dst_dir, case_id + ".h5"))
+        ]
+        benchmark(converted[: args.benchmark], args)
+
+
+if __name__ == "__main__":
+    main()
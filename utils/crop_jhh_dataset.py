@@ -1,15 +1,30 @@
 """
 python crop_jhh_dataset.py --ctpath /Users/zongwei.zhou/Desktop/14_FELIX/img --maskpath /Users/zongwei.zhou/Desktop/14_FELIX/label_6cls --savepath /Users/zongwei.zhou/Desktop/JHH_ROI_0.5mm
+python crop_jhh_dataset.py --ctpath /Users/zongwei.zhou/Desktop/14_FELIX/img --maskpath /Users/zongwei.zhou/Desktop/14_FELIX/label_6cls --savepath /Users/zongwei.zhou/Desktop/JHH_ROI_0.5mm --memory_limit 64 --num_workers 32
+python crop_jhh_dataset.py --ctpath /Users/zongwei.zhou/Desktop/14_FELIX/img --maskpath /Users/zongwei.zhou/Desktop/14_FELIX/label_6cls --savepath /tmp/JHH_ROI_benchmark --benchmark 3
+
+The mask is read once in its stored integer type and kept as uint8, the crop box comes from the largest connected
+component of labels 1-5, and only the box of the ct is read from disk (proxy slicing, never the whole float64
+volume). combined_labels and the class files come from a single lookup table pass over the cropped mask. Cases are
+admitted to the process pool while their memory, estimated from the nifti headers, fits in --memory_limit.
 """
 
 import argparse
 import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import time
+from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import cpu_count
 
 import cc3d
 import nibabel as nib
 import numpy as np
+from memory_scheduler import (
+    is_scaled,
+    peak_rss_mb,
+    physical_memory,
+    reset_peak_rss,
+    run_scheduled,
+)
 from tqdm import tqdm
 
 CLASSNAME = [
@@ -19,6 +34,9 @@ CLASSNAME = [
     "pnet",
 ]
 
+# labels of the pancreas and its lesions, the crop box is the largest connected component of their union
+PANCREAS_LABELS = [1, 2, 3, 4, 5]
+
 
 def intensity_clip(ct):
     ct[ct < -1000] = -1000
@@ -27,46 +45,81 @@ def intensity_clip(ct):
     return ct
 
 
-def process_mask_and_ct(patientID, args):
-    mask_path = os.path.join(args.maskpath, patientID + ".nii.gz")
-    ct_path = os.path.join(args.ctpath, patientID + ".nii.gz")
-
-    mask_nifti = nib.load(mask_path)
-    mask = mask_nifti.get_fdata()
-
-    ct_nifti = nib.load(ct_path)
-    ct = ct_nifti.get_fdata()
-
-    # Create a union of labels 1 through 5
-    union_mask = np.isin(mask, [1, 2, 3, 4, 5])
+def build_label_lut():
+    """
+    :return: (1 + len(CLASSNAME), 256) int8, row 0 maps a label to combined_labels, row k + 1 to CLASSNAME[k]
+    """
+    labels = np.arange(256)
+    lut = np.zeros((1 + len(CLASSNAME), 256), dtype=np.int8)
+    # labels 1 and 2 are merged, the other labels are kept
+    lut[0] = np.where(np.isin(labels, [1, 2]), 1, labels).astype(np.int8)
+    for k, class_name in enumerate(CLASSNAME):
+        if class_name == "pancreas":
+            lut[k + 1] = np.where(np.isin(labels, PANCREAS_LABELS), 1, labels).astype(
+                np.int8
+            )
+        elif class_name == "pdac":
+            lut[k + 1] = labels == 3
+        elif class_name == "cyst":
+            lut[k + 1] = labels == 4
+        elif class_name == "pnet":
+            lut[k + 1] = labels == 5
+    return lut
+
+
+def load_mask(mask_nifti):
+    # the stored labels as uint8, a scaled (float) mask is rounded
+    mask = np.asanyarray(mask_nifti.dataobj)
+    if mask.dtype.kind == "f":
+        mask = np.round(mask)
+    return mask.astype(np.uint8)
+
+
+def crop_box(mask, args):
+    """
+    removes every voxel outside the largest connected component of labels 1-5 from mask (in place)
+    :return: crop box of the component plus padding, None if the mask has no label 1-5
+    """
+    union_mask = np.zeros(256, dtype=np.uint8)
+    union_mask[PANCREAS_LABELS] = 1
+    union_mask = union_mask[mask]
+    if not union_mask.any():
+        return None
 
     # Get a labeling of the k largest objects in the image.
     # The output will be relabeled from 1 to N.
-    labels_out, _ = cc3d.largest_k(
-        union_mask,
-        k=1,
-        connectivity=26,
-        delta=0,
-        return_N=True,
+    labels_out = cc3d.largest_k(union_mask, k=1, connectivity=26, delta=0)
+    mask[labels_out == 0] = 0
+    bounding_box = cc3d.statistics(labels_out)["bounding_boxes"][1]
+    del union_mask, labels_out
+
+    padding = (args.x_padding, args.y_padding, args.z_padding)
+    return tuple(
+        slice(max(0, s.start - p), min(size, s.stop + p))
+        for s, p, size in zip(bounding_box, padding, mask.shape)
     )
-    union_mask *= labels_out > 0  # to get original labels
-    mask[union_mask == 0] = 0
 
-    slice_x = np.any(union_mask, axis=(1, 2))
-    slice_y = np.any(union_mask, axis=(0, 2))
-    slice_z = np.any(union_mask, axis=(0, 1))
 
-    x_start = max(0, np.argmax(slice_x) - args.x_padding)
-    x_end = min(len(slice_x), len(slice_x) - np.argmax(slice_x[::-1]) + args.x_padding)
-
-    y_start = max(0, np.argmax(slice_y) - args.y_padding)
-    y_end = min(len(slice_y), len(slice_y) - np.argmax(slice_y[::-1]) + args.y_padding)
-
-    z_start = max(0, np.argmax(slice_z) - args.z_padding)
-    z_end = min(len(slice_z), len(slice_z) - np.argmax(slice_z[::-1]) + args.z_padding)
+def process_mask_and_ct(patientID, args):
+    """
+    :return: seconds, peak memory of the case (MB) and cropped shape
+    """
+    start = time.time()
+    reset_peak_rss()
+    mask_path = os.path.join(args.maskpath, patientID + ".nii.gz")
+    ct_path = os.path.join(args.ctpath, patientID + ".nii.gz")
 
-    cropped_mask = mask[x_start:x_end, y_start:y_end, z_start:z_end]
-    cropped_ct = intensity_clip(ct[x_start:x_end, y_start:y_end, z_start:z_end])
+    mask_nifti = nib.load(mask_path)
+    mask = load_mask(mask_nifti)
+    box = crop_box(mask, args)
+    if box is None:
+        raise ValueError("no pancreas label in {}".format(mask_path))
+    cropped_mask = mask[box]
+    del mask
+
+    # only the crop box of the ct is read, copied as the proxy may return a read-only view
+    ct_nifti = nib.load(ct_path)
+    cropped_ct = intensity_clip(np.array(ct_nifti.dataobj[box]))
 
     if args.saveformat == "bodymaps":
         if not os.path.exists(os.path.join(args.savepath, patientID)):
@@ -75,10 +128,12 @@ def process_mask_and_ct(patientID, args):
             cropped_ct.astype(np.int16), ct_nifti.affine, ct_nifti.header
         )
         nib.save(cropped_ct_nifti, os.path.join(args.savepath, patientID, "ct.nii.gz"))
+        del cropped_ct, cropped_ct_nifti
 
-        combined_labels = np.where(np.isin(cropped_mask, [1, 2]), 1, cropped_mask)
+        # combined_labels and every class in one gather
+        split_labels = build_label_lut()[:, cropped_mask]
         combined_labels_nifti = nib.Nifti1Image(
-            combined_labels.astype(np.int8), mask_nifti.affine, mask_nifti.header
+            split_labels[0], mask_nifti.affine, mask_nifti.header
         )
         nib.save(
             combined_labels_nifti,
@@ -88,20 +143,9 @@ def process_mask_and_ct(patientID, args):
         if not os.path.exists(os.path.join(args.savepath, patientID, "segmentations")):
             os.makedirs(os.path.join(args.savepath, patientID, "segmentations"))
 
-        for class_name in CLASSNAME:
-            if class_name == "pancreas":
-                cls_mask = np.where(
-                    np.isin(cropped_mask, [1, 2, 3, 4, 5]), 1, cropped_mask
-                )
-            elif class_name == "pdac":
-                cls_mask = cropped_mask == 3
-            elif class_name == "cyst":
-                cls_mask = cropped_mask == 4
-            elif class_name == "pnet":
-                cls_mask = cropped_mask == 5
-
+        for k, class_name in enumerate(CLASSNAME):
             cropped_mask_nifti = nib.Nifti1Image(
-                cls_mask.astype(np.int8), mask_nifti.affine, mask_nifti.header
+                split_labels[k + 1], mask_nifti.affine, mask_nifti.header
             )
             nib.save(
                 cropped_mask_nifti,
@@ -110,6 +154,120 @@ def process_mask_and_ct(patientID, args):
                 ),
             )
 
+    return (
+        time.time() - start,
+        peak_rss_mb(),
+        tuple(cropped_mask.shape),
+    )
+
+
+def process_mask_and_ct_float64(patientID, args):
+    """
+    the former implementation (float64 volumes, per class np.isin), without saving, as the reference of --benchmark
+    :return: seconds, peak memory of the case (MB), cropped ct, combined_labels and class masks
+    """
+    start = time.time()
+    reset_peak_rss()
+    mask_nifti = nib.load(os.path.join(args.maskpath, patientID + ".nii.gz"))
+    mask = mask_nifti.get_fdata()
+    ct = nib.load(os.path.join(args.ctpath, patientID + ".nii.gz")).get_fdata()
+    union_mask = np.isin(mask, PANCREAS_LABELS)
+    labels_out = cc3d.largest_k(union_mask, k=1, connectivity=26, delta=0)
+    union_mask *= labels_out > 0
+    mask[union_mask == 0] = 0
+    bounds = []
+    for axis, padding in zip(
+        [(1, 2), (0, 2), (0, 1)], [args.x_padding, args.y_padding, args.z_padding]
+    ):
+        present = np.any(union_mask, axis=axis)
+        bounds.append(
+            slice(
+                max(0, np.argmax(present) - padding),
+                min(len(present), len(present) - np.argmax(present[::-1]) + padding),
+            )
+        )
+    cropped_mask = mask[tuple(bounds)]
+    cropped_ct = intensity_clip(ct[tuple(bounds)]).astype(np.int16)
+    combined_labels = np.where(np.isin(cropped_mask, [1, 2]), 1, cropped_mask)
+    # pancreas, pdac, cyst, pnet
+    class_masks = [np.where(np.isin(cropped_mask, PANCREAS_LABELS), 1, cropped_mask)]
+    class_masks += [cropped_mask == label for label in (3, 4, 5)]
+    return (
+        time.time() - start,
+        peak_rss_mb(),
+        [cropped_ct, combined_labels.astype(np.int8)]
+        + [m.astype(np.int8) for m in class_masks],
+    )
+
+
+def estimate_memory(patientID, args):
+    """
+    peak memory (bytes) of process_mask_and_ct from the nifti headers: the mask as read and as uint8, the union mask
+    and the component labels, and at most the whole ct as read and as int16 (the crop box is not known beforehand)
+    """
+    mask_img = nib.load(os.path.join(args.maskpath, patientID + ".nii.gz"))
+    ct_img = nib.load(os.path.join(args.ctpath, patientID + ".nii.gz"))
+    num_voxels = int(np.prod(mask_img.shape[:3]))
+    mask_bytes = 8 if is_scaled(mask_img) else mask_img.get_data_dtype().itemsize
+    ct_bytes = 8 if is_scaled(ct_img) else ct_img.get_data_dtype().itemsize
+    return int(num_voxels * (mask_bytes + 1 + 1 + 2 + ct_bytes + 2))
+
+
+def report_case(patientID, estimate, result, error):
+    if error is not None:
+        print(f"Error processing {patientID}: {error}")
+        return
+    seconds, peak_mb, shape = result
+    tqdm.write(
+        "{}: crop {}, {:.1f} s, estimated {:.0f} MB, worker peak {:.0f} MB".format(
+            patientID, shape, seconds, estimate / 1024**2, peak_mb
+        )
+    )
+
+
+def benchmark(patientIDlist, args):
+    """
+    time and peak memory of the former float64 implementation and of process_mask_and_ct, each case in a fresh
+    process, and whether the files saved by process_mask_and_ct agree with the former outputs
+    """
+    for patientID in patientIDlist:
+        results = {}
+        for name, fn in (
+            ("float64", process_mask_and_ct_float64),
+            ("uint8", process_mask_and_ct),
+        ):
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                try:
+                    results[name] = executor.submit(fn, patientID, args).result()
+                except Exception as e:
+                    print(f"Error processing {patientID}: {e}")
+        if len(results) < 2:
+            continue
+        shape = nib.load(os.path.join(args.ctpath, patientID + ".nii.gz")).shape
+        saved_files = [
+            os.path.join(args.savepath, patientID, "ct.nii.gz"),
+            os.path.join(args.savepath, patientID, "combined_labels.nii.gz"),
+        ] + [
+            os.path.join(args.savepath, patientID, "segmentations", c + ".nii.gz")
+            for c in CLASSNAME
+        ]
+        same = all(
+            np.array_equal(np.asanyarray(nib.load(f).dataobj), reference)
+            for f, reference in zip(saved_files, results["float64"][2])
+        )
+        print(
+            "{} {}: float64 {:.1f} s {:.0f} MB, uint8 {:.1f} s {:.0f} MB, same"
+            " output: {}".format(
+                patientID,
+                shape,
+                results["float64"][0],
+                results["float64"][1],
+                results["uint8"][0],
+                results["uint8"][1],
+                same,
+            )
+        )
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -127,6 +285,24 @@ def main():
     parser.add_argument("--x_padding", default=48, type=int, help="x padding")
     parser.add_argument("--y_padding", default=48, type=int, help="y padding")
     parser.add_argument("--z_padding", default=48, type=int, help="z padding")
+    parser.add_argument(
+        "--num_workers", default=cpu_count(), type=int, help="maximum processes"
+    )
+    parser.add_argument(
+        "--memory_limit",
+        default=0.7 * physical_memory() / 1024**3,
+        type=float,
+        help="GB the running cases may use together (estimated from the headers)",
+    )
+    parser.add_argument(
+        "--benchmark",
+        default=0,
+        type=int,
+        help=(
+            "compare time and peak memory with the float64 implementation on this many"
+            " cases"
+        ),
+    )
 
     args = parser.parse_args()
 
@@ -137,29 +313,38 @@ def main():
     if not os.path.exists(args.savepath):
         os.makedirs(args.savepath)
 
-    patientIDlist = [
+    patientIDlist = sorted(
         f.split(".nii")[0]
         for f in os.listdir(args.maskpath)
         if os.path.isfile(os.path.join(args.maskpath, f))
-    ]
+    )
 
-    # for patientID in tqdm(patientIDlist, desc="Processing masks"):
-    #     process_mask_and_ct(patientID, args)
+    if args.benchmark > 0:
+        patientIDlist = patientIDlist[: args.benchmark]
 
-    print(">> {} CPU cores are secured.".format(cpu_count()))
+    cases = {}
+    for patientID in patientIDlist:
+        try:
+            cases[patientID] = estimate_memory(patientID, args)
+        except Exception as e:
+            print(f"Error processing {patientID}: {e}")
 
-    with ProcessPoolExecutor(max_workers=cpu_count()) as executor:
-        futures = {
-            executor.submit(process_mask_and_ct, patientID, args): patientID
-            for patientID in patientIDlist
-        }
+    print(
+        ">> {} cases, {} workers, {:.1f} GB memory limit".format(
+            len(cases), args.num_workers, args.memory_limit
+        )
+    )
+    run_scheduled(
+        cases,
+        process_mask_and_ct,
+        (args,),
+        args.num_workers,
+        args.memory_limit * 1024**3,
+        report_case,
+    )
 
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            patientID = futures[future]
-            try:
-                future.result()
-            except Exception as e:
-                print(f"Error processing {patientID}: {e}")
+    if args.benchmark > 0:
+        benchmark(list(cases), args)
 
 
 if __name__ == "__main__":
@@ -1,53 +1,16 @@
 """
 python download_files_from_huggingface.py --repo_id MrGiovanni/BodyMaps --output_dir /Users/zongwei.zhou/Desktop/BodyMaps
+python download_files_from_huggingface.py --repo_id MrGiovanni/BodyMaps --output_dir /Users/zongwei.zhou/Desktop/BodyMaps --manifest BodyMaps.jsonl
+python download_files_from_huggingface.py --backend local --repo_id /path/to/a/copy/of/the/repo --output_dir /tmp/BodyMaps
+
+Files are downloaded straight into output_dir by a bounded thread pool with retries, and verified (size and hash).
+Files already in output_dir (or in the manifest) are skipped, so an interrupted download is resumed by a rerun.
 """
 
 import argparse
 import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from multiprocessing import cpu_count
-
-from huggingface_hub import HfApi, hf_hub_download
-from tqdm import tqdm
-
-
-def download_file(dataset_file, output_dir, repo_id, repo_type):
-    """
-    This function downloads a file from the Hugging Face Hub using the hf_hub_download function.
-
-    Args:
-    - dataset_file: The file to download
-    - output_dir: The directory to save the file to
-    - repo_id: The repository ID to download from
-    - repo_type: The type of repository to download from (e.g. dataset, space)
-    """
-    try:
-        # Download using hf_hub_download
-        downloaded_file = hf_hub_download(
-            repo_id=repo_id, filename=dataset_file.rfilename, repo_type=repo_type
-        )
-
-        # Construct the output path
-        folder = os.path.dirname(dataset_file.rfilename)  # Extract folder
-        filename = os.path.basename(dataset_file.rfilename)  # Extract filename
-        output_path = os.path.join(output_dir, folder, filename)
-
-        # Ensure parent directories exist
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-
-        # Read the downloaded file's content
-        with open(downloaded_file, "rb") as f:
-            file_bytes = f.read()
-
-        # Write the file to disk
-        with open(output_path, "wb") as f:
-            f.write(file_bytes)
-
-    except Exception as e:
-        print(
-            f"Error downloading {dataset_file.rfilename}: {e}"
-        )  # Use rfilename for clarity
 
+from hf_transfer import HuggingFaceBackend, LocalBackend, download_all
 
 if __name__ == "__main__":
     # Argument parsing
@@ -58,7 +21,10 @@ if __name__ == "__main__":
         "--repo_id",
         type=str,
         required=True,
-        help="The ID of the Hugging Face dataset repository",
+        help=(
+            "The ID of the Hugging Face dataset repository (a directory with --backend"
+            " local)"
+        ),
     )
     parser.add_argument(
         "--output_dir",
@@ -72,27 +38,64 @@ if __name__ == "__main__":
         default="dataset",
         help="The type of repository to download from (e.g. dataset, space)",
     )
+    parser.add_argument(
+        "--revision", type=str, default=None, help="branch, tag or commit"
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="hf",
+        choices=["hf", "local"],
+        help=(
+            "hf: the Hugging Face Hub, local: a directory standing in for the"
+            " repository"
+        ),
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help=(
+            "jsonl of the verified files (default: .download_manifest.jsonl in"
+            " output_dir)"
+        ),
+    )
+    parser.add_argument("--num_workers", type=int, default=8, help="parallel downloads")
+    parser.add_argument(
+        "--retries", type=int, default=3, help="retries of a failed download"
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=1.0,
+        help="seconds before the first retry, doubled at every retry",
+    )
+    parser.add_argument(
+        "--no_hash",
+        action="store_true",
+        help="only verify the file sizes",
+    )
 
     args = parser.parse_args()
 
-    # Get dataset info
-    api = HfApi()
-    dataset_info = api.dataset_info(repo_id=args.repo_id)
-    files = dataset_info.siblings
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.manifest is None:
+        args.manifest = os.path.join(args.output_dir, ".download_manifest.jsonl")
 
-    print(">> {} CPU cores are secured.".format(cpu_count()))
+    if args.backend == "local":
+        backend = LocalBackend(args.repo_id)
+    else:
+        backend = HuggingFaceBackend(
+            args.repo_id, repo_type=args.repo_type, revision=args.revision
+        )
 
-    # Download files in parallel
-    with ProcessPoolExecutor(max_workers=cpu_count()) as executor:
-        futures = {
-            executor.submit(
-                download_file, file, args.output_dir, args.repo_id, args.repo_type
-            ): file
-            for file in tqdm(files)
-        }
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            file_id = futures[future]
-            try:
-                future.result()
-            except Exception as e:
-                print(f"Error processing {file_id}: {e}")
+    downloaded, skipped, failed = download_all(
+        backend,
+        args.output_dir,
+        manifest_file=args.manifest,
+        num_workers=args.num_workers,
+        retries=args.retries,
+        backoff=args.backoff,
+        check_hash=not args.no_hash,
+    )
+    print(">> {} downloaded, {} skipped, {} failed".format(downloaded, skipped, failed))
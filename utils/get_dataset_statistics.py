@@ -1,39 +1,270 @@
 """bash
 python get_dataset_statistics.py --datapath /Users/zongwei.zhou/Dropbox\ \(ASU\)/PublicResource/SuPreM/AbdomenAtlas/AbdomenAtlasDemo
+python get_dataset_statistics.py --datapath /Users/zongwei.zhou/Dropbox\ \(ASU\)/PublicResource/SuPreM/AbdomenAtlas/AbdomenAtlasDemo --manifest statistics.parquet
+python get_dataset_statistics.py --manifest dataset_statistics.csv --query_only --histogram spacing_z liver_ml --prevalence
+
+Writes one row per case to the manifest (--manifest, csv or parquet): shape, spacing, orientation and data type from
+the ct header, number of slices, intensity range of the ct and the volume (ml) of every organ mask. Shape, spacing and
+orientation are read from the header only; the intensity range and organ volumes need the voxels and are computed in
+parallel. A rerun only processes the cases whose files changed (mtime) or are new, and drops the deleted cases.
+Histograms and per organ prevalence are answered from the manifest, with --query_only without touching the dataset.
 """
 
 import argparse
+import glob
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
 
 import nibabel as nib
+import numpy as np
+import pandas as pd
 from tqdm import tqdm
 
+VOLUME_SUFFIX = "_ml"
 
-def main():
-    parser = argparse.ArgumentParser()
 
-    parser.add_argument("--datapath", default=None, type=str, help="data directory")
+def case_files(datapath, pid):
+    files = [os.path.join(datapath, pid, "ct.nii.gz")]
+    files += sorted(glob.glob(os.path.join(datapath, pid, "segmentations", "*.nii.gz")))
+    return [f for f in files if os.path.isfile(f)]
 
-    args = parser.parse_args()
 
-    assert args.datapath is not None
+def case_mtime(files):
+    # integer nanoseconds, a float mtime does not survive the csv round trip exactly
+    return max([os.stat(f).st_mtime_ns for f in files]) if len(files) > 0 else 0
+
+
+def num_slices_from_shape(shape):
+    # the slice axis is the last one, unless the volume is stored with 512 slices last and a different first axis
+    if shape[2] == 512 and shape[0] != 512:
+        return int(shape[0])
+    return int(shape[2])
+
+
+def header_statistics(nii):
+    shape = nii.header.get_data_shape()[:3]
+    spacing = nii.header.get_zooms()[:3]
+    return {
+        "shape_x": int(shape[0]),
+        "shape_y": int(shape[1]),
+        "shape_z": int(shape[2]),
+        "spacing_x": float(spacing[0]),
+        "spacing_y": float(spacing[1]),
+        "spacing_z": float(spacing[2]),
+        "orientation": "".join(nib.aff2axcodes(nii.affine)),
+        "dtype": str(nii.get_data_dtype()),
+        "num_slices": num_slices_from_shape(shape),
+    }
+
 
-    folder_names = [
+def case_statistics(datapath, pid, intensity=True):
+    files = case_files(datapath, pid)
+    row = {"pid": pid, "mtime_ns": case_mtime(files)}
+    ct_path = os.path.join(datapath, pid, "ct.nii.gz")
+    voxel_volume = None
+    if os.path.isfile(ct_path):
+        ct = nib.load(ct_path)
+        row.update(header_statistics(ct))
+        voxel_volume = float(np.prod(ct.header.get_zooms()[:3])) / 1000.0
+        if intensity:
+            # scaled values as get_fdata, without the float64 copy of the volume
+            data = np.asanyarray(ct.dataobj)
+            row["intensity_min"] = float(data.min())
+            row["intensity_max"] = float(data.max())
+
+    for mask_path in files[1:]:
+        mask = nib.load(mask_path)
+        if voxel_volume is None:
+            row.update(header_statistics(mask))
+            voxel_volume = float(np.prod(mask.header.get_zooms()[:3])) / 1000.0
+        class_name = os.path.basename(mask_path)[: -len(".nii.gz")]
+        num_voxels = np.count_nonzero(np.asanyarray(mask.dataobj))
+        row[class_name + VOLUME_SUFFIX] = round(num_voxels * voxel_volume, 4)
+    return row
+
+
+def read_manifest(manifest_file):
+    if not os.path.isfile(manifest_file):
+        return pd.DataFrame(columns=["pid", "mtime_ns"])
+    if manifest_file.endswith(".parquet"):
+        df = pd.read_parquet(manifest_file)
+    else:
+        df = pd.read_csv(manifest_file, dtype={"pid": str})
+    return df
+
+
+def write_manifest(df, manifest_file):
+    df = df.sort_values("pid").reset_index(drop=True)
+    tmp_file = os.path.join(
+        os.path.dirname(os.path.abspath(manifest_file)),
+        ".tmp." + os.path.basename(manifest_file),
+    )
+    if manifest_file.endswith(".parquet"):
+        df.to_parquet(tmp_file, index=False)
+    else:
+        df.to_csv(tmp_file, index=False)
+    os.replace(tmp_file, manifest_file)
+
+
+def update_manifest(args):
+    """
+    :return: manifest with a row for every case of args.datapath, only new or modified cases are recomputed
+    """
+    df = read_manifest(args.manifest)
+    folder_names = sorted(
         name
         for name in os.listdir(args.datapath)
         if os.path.isdir(os.path.join(args.datapath, name))
+    )
+    # a manifest without mtime_ns (float mtime of an older version) is recomputed
+    cached = dict(zip(df["pid"], df["mtime_ns"])) if "mtime_ns" in df else {}
+    # cases of a manifest written with --no_intensity are recomputed for the intensity range
+    no_intensity = set()
+    if args.intensity:
+        if "intensity_min" in df:
+            no_intensity = set(df.loc[df["intensity_min"].isna(), "pid"])
+        else:
+            no_intensity = set(cached)
+    todo = [
+        pid
+        for pid in folder_names
+        if pid not in cached
+        or pid in no_intensity
+        or cached[pid] != case_mtime(case_files(args.datapath, pid))
     ]
-    num_slices = 0
+    print(
+        ">> {} cases, {} new or modified, {} removed, {} processes".format(
+            len(folder_names),
+            len(todo),
+            len(set(cached) - set(folder_names)),
+            args.num_workers,
+        )
+    )
 
-    for pid in tqdm(folder_names):
-        mask_path = os.path.join(args.datapath, pid, "segmentations", "liver.nii.gz")
-        mask = nib.load(mask_path)
-        mask_shape = mask.header["dim"]
-        if mask_shape[3] == 512 and mask_shape[1] != 512:
-            num_slices += mask_shape[1]
-        else:
-            num_slices += mask_shape[3]
-    print(">> Total number of slices = {}".format(num_slices))
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        futures = {
+            executor.submit(case_statistics, args.datapath, pid, args.intensity): pid
+            for pid in todo
+        }
+
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            pid = futures[future]
+            try:
+                rows.append(future.result())
+            except Exception as e:
+                print(f"Error processing {pid}: {e}")
+
+    updated = set(row["pid"] for row in rows)
+    df = df[df["pid"].isin(folder_names) & ~df["pid"].isin(updated)]
+    if len(df) == 0:
+        df = pd.DataFrame(rows, columns=None if len(rows) > 0 else ["pid", "mtime_ns"])
+    elif len(rows) > 0:
+        df = pd.concat([df, pd.DataFrame(rows)], ignore_index=True)
+    # organ columns after the header columns, in alphabetical order
+    volume_columns = sorted(c for c in df.columns if c.endswith(VOLUME_SUFFIX))
+    df = df[[c for c in df.columns if c not in volume_columns] + volume_columns]
+    write_manifest(df, args.manifest)
+    return df
+
+
+def organ_columns(df):
+    return [c for c in df.columns if c.endswith(VOLUME_SUFFIX)]
+
+
+def print_histogram(df, column, bins):
+    if column not in df or df[column].isna().all():
+        print(">> no values for {}".format(column))
+        return
+    values = df[column].dropna()
+    if not pd.api.types.is_numeric_dtype(values):
+        print("\n> {}".format(column))
+        for value, count in values.value_counts().items():
+            print("  {:>16} {:6d}".format(value, count))
+        return
+    counts, edges = np.histogram(values, bins=bins)
+    width = 40.0 / max(counts.max(), 1)
+    print(
+        "\n> {} (n={}, min {:.4g}, median {:.4g}, max {:.4g})".format(
+            column, len(values), values.min(), values.median(), values.max()
+        )
+    )
+    for count, lo, hi in zip(counts, edges[:-1], edges[1:]):
+        print(
+            "  [{:10.4g}, {:10.4g}) {:6d} {}".format(
+                lo, hi, count, "#" * int(round(count * width))
+            )
+        )
+
+
+def print_prevalence(df):
+    print("\n> organ prevalence (cases with a non empty mask) and median volume (ml)")
+    for column in organ_columns(df):
+        volumes = df[column]
+        present = volumes > 0
+        print(
+            "  {:<32} {:6.1f}% = {}/{}  {:10.1f}".format(
+                column[: -len(VOLUME_SUFFIX)],
+                100.0 * present.sum() / max(len(df), 1),
+                int(present.sum()),
+                len(df),
+                volumes[present].median() if present.any() else 0.0,
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--datapath", default=None, type=str, help="data directory")
+    parser.add_argument(
+        "--manifest",
+        default="dataset_statistics.csv",
+        type=str,
+        help=(
+            "per case statistics, csv or parquet (by the file extension, needs pyarrow)"
+        ),
+    )
+    parser.add_argument(
+        "--query_only",
+        action="store_true",
+        help="answer the queries from the manifest without scanning the dataset",
+    )
+    parser.add_argument(
+        "--no_intensity",
+        dest="intensity",
+        action="store_false",
+        help="skip the intensity range, which is the only reason to read the ct voxels",
+    )
+    parser.add_argument(
+        "--histogram", nargs="*", default=[], help="manifest columns to histogram"
+    )
+    parser.add_argument("--bins", default=10, type=int, help="histogram bins")
+    parser.add_argument(
+        "--prevalence", action="store_true", help="print the per organ prevalence"
+    )
+    parser.add_argument(
+        "--num_workers", default=cpu_count(), type=int, help="parallel cases"
+    )
+
+    args = parser.parse_args()
+
+    if args.query_only:
+        assert os.path.isfile(args.manifest), "no manifest {}".format(args.manifest)
+        df = read_manifest(args.manifest)
+    else:
+        assert args.datapath is not None
+        df = update_manifest(args)
+
+    if "num_slices" not in df or df["num_slices"].isna().all():
+        print(">> No case statistics in {}".format(args.manifest))
+        return
+    print(">> Total number of slices = {}".format(int(df["num_slices"].sum())))
+    for column in args.histogram:
+        print_histogram(df, column, args.bins)
+    if args.prevalence:
+        print_prevalence(df)
 
 
 if __name__ == "__main__":
@@ -1,14 +1,17 @@
+import json
 import os
+import shutil
 
+import cc3d
 import nibabel as nib
 import numpy as np
-from skimage.measure import label
 
 
 def getLargestCC(segmentation):
-    labels = label(segmentation)
-    assert labels.max() != 0  # assume at least 1 CC
-    largestCC = labels == np.argmax(np.bincount(labels.flat)[1:]) + 1
+    # 26-connectivity, the full connectivity skimage.measure.label uses by default
+    segmentation = np.asarray(segmentation, dtype=np.uint8)
+    assert segmentation.any()  # assume at least 1 CC
+    largestCC = cc3d.largest_k(segmentation, k=1, connectivity=26) > 0
     return largestCC
 
 
@@ -16,14 +19,68 @@ def load_mask(pid, class_name, datapath):
     mask_path = os.path.join(datapath, pid, "segmentations", class_name + ".nii.gz")
     if os.path.isfile(mask_path):
         nii = nib.load(mask_path)
-        return nii.get_fdata().astype(np.uint8), nii.affine, nii.header
+        return np.asanyarray(nii.dataobj).astype(np.uint8), nii.affine, nii.header
     else:
         return None, None, None
 
 
+def load_case_masks(pid, class_names, datapath):
+    """
+    loads every mask of class_names of a case once, as uint8 without a float64 copy
+    :return: dict class name -> mask, None for a missing mask
+    """
+    masks = {}
+    for class_name in class_names:
+        mask_path = os.path.join(datapath, pid, "segmentations", class_name + ".nii.gz")
+        if os.path.isfile(mask_path):
+            masks[class_name] = np.asanyarray(nib.load(mask_path).dataobj).astype(
+                np.uint8
+            )
+        else:
+            masks[class_name] = None
+    return masks
+
+
 def save_mask(data, affine, header, pid, class_name, datapath):
     nifti_path = os.path.join(datapath, pid, "segmentations", class_name + ".nii.gz")
-    nib.save(nib.Nifti1Image(data, affine=affine, header=header), nifti_path)
+    save_nifti_atomic(nib.Nifti1Image(data, affine=affine, header=header), nifti_path)
+
+
+def save_nifti_atomic(nii, nifti_path):
+    # a reader (or a killed run) never sees a partially written file
+    tmp_path = os.path.join(
+        os.path.dirname(nifti_path), ".tmp." + os.path.basename(nifti_path)
+    )
+    nib.save(nii, tmp_path)
+    os.replace(tmp_path, nifti_path)
+
+
+def copy_file_atomic(source_path, destination_path):
+    tmp_path = os.path.join(
+        os.path.dirname(destination_path), ".tmp." + os.path.basename(destination_path)
+    )
+    shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, destination_path)
+
+
+def read_manifest(manifest_file):
+    """
+    records of a jsonl manifest, lines cut by an interrupted run are ignored
+    """
+    records = []
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+
+def append_manifest(manifest, record):
+    manifest.write(json.dumps(record) + "\n")
+    manifest.flush()
 
 
 def check_dim(list_of_array):
@@ -34,84 +91,132 @@ def check_dim(list_of_array):
     return True
 
 
-def aorta_error(pid, datapath):
-    liver, _, _ = load_mask(pid, "liver", datapath)
-    aorta, _, _ = load_mask(pid, "aorta", datapath)
-    lung_left, _, _ = load_mask(pid, "lung_left", datapath)
-    lung_right, _, _ = load_mask(pid, "lung_right", datapath)
-    postcava, _, _ = load_mask(pid, "postcava", datapath)
-
-    assert check_dim([liver, aorta, lung_left, lung_right, postcava])
-
-    error_count = 0
-
-    if (liver.shape[0] == 512 and liver.shape[1] == 512) or (
-        liver.shape[0] != liver.shape[1] and liver.shape[1] != liver.shape[2]
+def get_slice_axis(shape):
+    # axial axis, same heuristic for the orientation of the volume as the original slice loop
+    if (shape[0] == 512 and shape[1] == 512) or (
+        shape[0] != shape[1] and shape[1] != shape[2]
     ):
-        for i in range(liver.shape[-1]):
-            if error2d_isliver_noaorta(
-                liver[:, :, i], aorta[:, :, i]
-            ) or error2d_ispostcava_islung_nonaorta(
-                postcava[:, :, i],
-                lung_right[:, :, i],
-                lung_left[:, :, i],
-                aorta[:, :, i],
-            ):
-                error_count += 1
-        error_percent = 100.0 * error_count / liver.shape[-1]
-        print(
-            "> {} has {:.1f}% ({}/{}) errors in aorta".format(
-                pid,
-                error_percent,
-                error_count,
-                liver.shape[-1],
-            )
+        return 2
+    return 0
+
+
+def slice_presence(mask, axis, num_slices):
+    """
+    :return: bool array, True for the slices along axis where mask has a voxel (all False for a missing mask)
+    """
+    if mask is None:
+        return np.zeros(num_slices, dtype=bool)
+    other = tuple(a for a in range(mask.ndim) if a != axis)
+    return mask.any(axis=other)
+
+
+def aorta_error_masks(pid, masks):
+    """
+    slices with liver but no aorta, or with postcava and lung but no aorta. An error if more than 3% of the slices
+    :return: error detected, percent of error slices
+    """
+    names = ["liver", "aorta", "lung_left", "lung_right", "postcava"]
+    available = [masks[name] for name in names if masks.get(name) is not None]
+    if len(available) == 0:
+        return False, 0.0
+    assert check_dim(available)
+
+    axis = get_slice_axis(available[0].shape)
+    num_slices = available[0].shape[axis]
+    present = dict(
+        [(name, slice_presence(masks.get(name), axis, num_slices)) for name in names]
+    )
+    error_slices = np.zeros(num_slices, dtype=bool)
+    if masks.get("liver") is not None and masks.get("aorta") is not None:
+        # error2d_isliver_noaorta
+        error_slices |= present["liver"] & ~present["aorta"]
+    if all(masks.get(name) is not None for name in names[1:]):
+        # error2d_ispostcava_islung_nonaorta
+        error_slices |= (
+            present["postcava"]
+            & (present["lung_right"] | present["lung_left"])
+            & ~present["aorta"]
         )
-
-    else:
-        for i in range(liver.shape[0]):
-            if error2d_isliver_noaorta(
-                liver[i, :, :], aorta[i, :, :]
-            ) or error2d_ispostcava_islung_nonaorta(
-                postcava[i, :, :],
-                lung_right[i, :, :],
-                lung_left[i, :, :],
-                aorta[i, :, :],
-            ):
-                error_count += 1
-        error_percent = 100.0 * error_count / liver.shape[0]
-        print(
-            "> {} has {:.1f}% ({}/{}) errors in aorta".format(
-                pid,
-                error_percent,
-                error_count,
-                liver.shape[0],
-            )
+    error_count = int(error_slices.sum())
+    error_percent = 100.0 * error_count / num_slices
+    print(
+        "> {} has {:.1f}% ({}/{}) errors in aorta".format(
+            pid,
+            error_percent,
+            error_count,
+            num_slices,
         )
-    if error_percent > 3:
-        error_detected = True
-    else:
-        error_detected = False
-
-    return error_detected
+    )
+    return error_percent > 3, error_percent
 
 
-def kidney_error(pid, datapath):
-    error_detected = False
+def aorta_error(pid, datapath):
+    masks = load_case_masks(
+        pid, ["liver", "aorta", "lung_left", "lung_right", "postcava"], datapath
+    )
+    error_detected, _ = aorta_error_masks(pid, masks)
+    return error_detected
 
-    kidney_left, _, _ = load_mask(pid, "kidney_left", datapath)
-    kidney_right, _, _ = load_mask(pid, "kidney_right", datapath)
 
+def kidney_error_masks(pid, masks):
+    """
+    voxels labeled as both left and right kidney
+    :return: error detected, number of overlapping voxels
+    """
+    kidney_left, kidney_right = masks.get("kidney_left"), masks.get("kidney_right")
+    if kidney_left is None or kidney_right is None:
+        return False, 0
     assert check_dim([kidney_left, kidney_right])
 
-    kidney_lr_overlap = error3d_overlaps(kidney_left, kidney_right)
+    kidney_lr_overlap = int(np.count_nonzero(np.logical_and(kidney_left, kidney_right)))
     if kidney_lr_overlap > 0:
         print("> {} has {} px overlap betwee kidney L&R".format(pid, kidney_lr_overlap))
-        error_detected = True
+    return kidney_lr_overlap > 0, kidney_lr_overlap
 
+
+def kidney_error(pid, datapath):
+    masks = load_case_masks(pid, ["kidney_left", "kidney_right"], datapath)
+    error_detected, _ = kidney_error_masks(pid, masks)
     return error_detected
 
 
+def largest_cc_fix(mask):
+    """
+    keeps the largest connected component of mask (uint8), a missing or empty mask is returned unchanged
+    """
+    if mask is None or not mask.any():
+        return mask
+    return getLargestCC(mask).astype(np.uint8)
+
+
+def overlap_fix(mask_a, mask_b):
+    """
+    voxels labeled in both masks go to the mask whose exclusive voxels have the closer centroid
+    :return: mask_a, mask_b without overlap
+    """
+    if mask_a is None or mask_b is None:
+        return mask_a, mask_b
+    both = np.logical_and(mask_a, mask_b)
+    if not both.any():
+        return mask_a, mask_b
+    centroids = []
+    for mask in (mask_a, mask_b):
+        exclusive = np.argwhere(np.logical_and(mask, ~both))
+        centroids.append(
+            exclusive.mean(axis=0) if len(exclusive) > 0 else np.full(3, np.inf)
+        )
+    coords = np.argwhere(both)
+    closer_to_a = np.linalg.norm(coords - centroids[0], axis=1) <= np.linalg.norm(
+        coords - centroids[1], axis=1
+    )
+    mask_a, mask_b = mask_a.copy(), mask_b.copy()
+    index_a = tuple(coords[~closer_to_a].T)
+    index_b = tuple(coords[closer_to_a].T)
+    mask_a[index_a] = 0
+    mask_b[index_b] = 0
+    return mask_a, mask_b
+
+
 def kidney_postprocessing(pid, datapath):
     kidney_left, kidney_left_affine, kidney_left_header = load_mask(
         pid, "kidney_left", datapath
@@ -120,8 +225,8 @@ def kidney_postprocessing(pid, datapath):
         pid, "kidney_right", datapath
     )
 
-    kidney_left = getLargestCC(kidney_left)
-    kidney_right = getLargestCC(kidney_right)
+    kidney_left = largest_cc_fix(kidney_left)
+    kidney_right = largest_cc_fix(kidney_right)
 
     save_mask(
         kidney_left,
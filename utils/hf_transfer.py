@@ -0,0 +1,336 @@
+"""
+Transfer manager of download_files_from_huggingface.py and upload_folders_huggingface.py.
+
+- backends: HuggingFaceBackend (a Hugging Face Hub repository) and LocalBackend (a directory standing in for the
+  repository, to test a transfer without network). Both list the files of the repository with their size and hash,
+  download a file straight to its destination and commit a batch of files.
+- downloads run on a bounded thread pool with retries and exponential backoff, every file is verified (size, then
+  sha256 for lfs files or the git blob sha1 for the others) before it is recorded in the manifest.
+- the manifest (jsonl, one record per verified file) makes a rerun skip the files already transferred, files already
+  on disk are verified and recorded instead of being transferred again.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+try:
+    from huggingface_hub import CommitOperationAdd, HfApi, hf_hub_download
+except ImportError:
+    HfApi = None
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# path relative to the repository root (posix), size in bytes, sha256 (lfs files) or git blob sha1 (the others)
+RemoteFile = namedtuple("RemoteFile", ["path", "size", "sha256", "git_sha1"])
+
+
+def file_hashes(path):
+    """
+    :return: sha256 and git blob sha1 of a file, read in chunks
+    """
+    sha256 = hashlib.sha256()
+    git_sha1 = hashlib.sha1(b"blob %d\0" % os.path.getsize(path))
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            git_sha1.update(chunk)
+    return sha256.hexdigest(), git_sha1.hexdigest()
+
+
+def verify_file(local_path, remote_file, check_hash=True):
+    if not os.path.isfile(local_path):
+        return False
+    if os.path.getsize(local_path) != remote_file.size:
+        return False
+    if not check_hash or (remote_file.sha256 is None and remote_file.git_sha1 is None):
+        return True
+    sha256, git_sha1 = file_hashes(local_path)
+    if remote_file.sha256 is not None:
+        return sha256 == remote_file.sha256
+    return git_sha1 == remote_file.git_sha1
+
+
+def copy_file_atomic(source_path, destination_path):
+    os.makedirs(os.path.dirname(destination_path) or ".", exist_ok=True)
+    tmp_path = destination_path + ".incomplete"
+    with open(source_path, "rb") as src, open(tmp_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    os.replace(tmp_path, destination_path)
+
+
+class LocalBackend:
+    """
+    a directory standing in for a repository
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def list_files(self):
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in sorted(filenames):
+                local_path = os.path.join(dirpath, filename)
+                path = os.path.relpath(local_path, self.root).replace(os.sep, "/")
+                sha256, _ = file_hashes(local_path)
+                files.append(
+                    RemoteFile(path, os.path.getsize(local_path), sha256, None)
+                )
+        return sorted(files)
+
+    def download(self, remote_file, output_dir):
+        local_path = os.path.join(output_dir, remote_file.path)
+        copy_file_atomic(os.path.join(self.root, remote_file.path), local_path)
+        return local_path
+
+    def upload(self, local_files, commit_message):
+        for local_path, path_in_repo in local_files:
+            copy_file_atomic(local_path, os.path.join(self.root, path_in_repo))
+
+
+class HuggingFaceBackend:
+    """
+    a repository of the Hugging Face Hub, hf_hub_download writes the files straight into the output directory
+    (local_dir) instead of the cache
+    """
+
+    def __init__(self, repo_id, repo_type="dataset", revision=None, num_threads=5):
+        if HfApi is None:
+            raise ImportError(
+                "huggingface_hub is required for the Hugging Face backend"
+            )
+        self.api = HfApi()
+        self.repo_id = repo_id
+        self.repo_type = repo_type
+        self.revision = revision
+        self.num_threads = num_threads
+
+    def list_files(self):
+        files = []
+        for entry in self.api.list_repo_tree(
+            self.repo_id,
+            recursive=True,
+            repo_type=self.repo_type,
+            revision=self.revision,
+        ):
+            if not hasattr(entry, "size"):
+                continue  # folder
+            if entry.lfs is not None:
+                files.append(RemoteFile(entry.path, entry.size, entry.lfs.sha256, None))
+            else:
+                files.append(RemoteFile(entry.path, entry.size, None, entry.blob_id))
+        return sorted(files)
+
+    def download(self, remote_file, output_dir):
+        return hf_hub_download(
+            repo_id=self.repo_id,
+            filename=remote_file.path,
+            repo_type=self.repo_type,
+            revision=self.revision,
+            local_dir=output_dir,
+        )
+
+    def upload(self, local_files, commit_message):
+        operations = [
+            CommitOperationAdd(path_in_repo=path_in_repo, path_or_fileobj=local_path)
+            for local_path, path_in_repo in local_files
+        ]
+        self.api.create_commit(
+            repo_id=self.repo_id,
+            operations=operations,
+            commit_message=commit_message,
+            repo_type=self.repo_type,
+            revision=self.revision,
+            num_threads=self.num_threads,
+        )
+
+
+class Manifest:
+    """
+    jsonl of the transferred files, appended by the worker threads
+    """
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.records = {}
+        self.lock = threading.Lock()
+        if manifest_file is not None and os.path.isfile(manifest_file):
+            with open(manifest_file) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # line cut by an interrupted run
+                    self.records[record["path"]] = record
+
+    def get(self, path):
+        return self.records.get(path)
+
+    def add(self, record):
+        with self.lock:
+            self.records[record["path"]] = record
+            if self.manifest_file is not None:
+                with open(self.manifest_file, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+
+
+def with_retries(fn, retries, backoff):
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2**attempt
+            print(f"Retrying in {delay:.1f} s after: {e}")
+            time.sleep(delay)
+
+
+def download_all(
+    backend,
+    output_dir,
+    manifest_file=None,
+    num_workers=8,
+    retries=3,
+    backoff=1.0,
+    check_hash=True,
+):
+    """
+    :return: number of downloaded, skipped and failed files
+    """
+    manifest = Manifest(manifest_file)
+    files = backend.list_files()
+
+    todo, skipped = [], 0
+    for remote_file in files:
+        local_path = os.path.join(output_dir, remote_file.path)
+        record = manifest.get(remote_file.path)
+        if (
+            record is not None
+            and record["size"] == remote_file.size
+            and record.get("sha256") == remote_file.sha256
+            and record.get("git_sha1") == remote_file.git_sha1
+            and os.path.isfile(local_path)
+            and os.path.getsize(local_path) == remote_file.size
+        ):
+            skipped += 1
+        elif verify_file(local_path, remote_file, check_hash):
+            manifest.add(remote_file._asdict())
+            skipped += 1
+        else:
+            todo.append(remote_file)
+    print(
+        ">> {} files, {} already present, {} to download with {} threads".format(
+            len(files), skipped, len(todo), num_workers
+        )
+    )
+
+    def download_one(remote_file):
+        def attempt():
+            local_path = backend.download(remote_file, output_dir)
+            if not verify_file(local_path, remote_file, check_hash):
+                os.remove(local_path)
+                raise ValueError("size or hash mismatch")
+
+        with_retries(attempt, retries, backoff)
+        manifest.add(remote_file._asdict())
+
+    downloaded, failed = 0, 0
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(download_one, f): f for f in todo}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            remote_file = futures[future]
+            try:
+                future.result()
+                downloaded += 1
+            except Exception as e:
+                failed += 1
+                print(f"Error downloading {remote_file.path}: {e}")
+    return downloaded, skipped, failed
+
+
+def get_commit_groups(files, files_per_commit, bytes_per_commit):
+    # consecutive groups of at most files_per_commit files and bytes_per_commit bytes (at least one file)
+    group, group_size = [], 0
+    for local_path, path_in_repo, size in files:
+        if len(group) > 0 and (
+            len(group) == files_per_commit or group_size + size > bytes_per_commit
+        ):
+            yield group
+            group, group_size = [], 0
+        group.append((local_path, path_in_repo, size))
+        group_size += size
+    if len(group) > 0:
+        yield group
+
+
+def upload_folder(
+    backend,
+    base_folder,
+    manifest_file=None,
+    files_per_commit=1000,
+    bytes_per_commit=50 * 1024**3,
+    retries=3,
+    backoff=1.0,
+):
+    """
+    commits the files of base_folder that are new or changed (size or mtime) since the manifest
+    :return: number of uploaded, skipped and failed files
+    """
+    manifest = Manifest(manifest_file)
+    files, skipped = [], 0
+    for dirpath, _, filenames in os.walk(base_folder):
+        for filename in sorted(filenames):
+            local_path = os.path.join(dirpath, filename)
+            path_in_repo = os.path.relpath(local_path, base_folder).replace(os.sep, "/")
+            stat = os.stat(local_path)
+            record = manifest.get(path_in_repo)
+            if (
+                record is not None
+                and record["size"] == stat.st_size
+                and record["mtime"] == stat.st_mtime
+            ):
+                skipped += 1
+            else:
+                files.append((local_path, path_in_repo, stat.st_size))
+    files.sort(key=lambda f: f[1])
+    print(">> {} files already uploaded, {} to upload".format(skipped, len(files)))
+
+    uploaded, failed = 0, 0
+    groups = list(get_commit_groups(files, files_per_commit, bytes_per_commit))
+    for i, group in enumerate(groups):
+        print(f"Committing {i + 1}/{len(groups)} ({len(group)} files)")
+        try:
+            with_retries(
+                lambda: backend.upload(
+                    [
+                        (local_path, path_in_repo)
+                        for local_path, path_in_repo, _ in group
+                    ],
+                    f"Upload part {i + 1}/{len(groups)}",
+                ),
+                retries,
+                backoff,
+            )
+        except Exception as e:
+            failed += len(group)
+            print(f"Error committing part {i + 1}: {e}")
+            continue
+        for local_path, path_in_repo, size in group:
+            manifest.add(
+                {
+                    "path": path_in_repo,
+                    "size": size,
+                    "mtime": os.stat(local_path).st_mtime,
+                }
+            )
+        uploaded += len(group)
+    return uploaded, skipped, failed
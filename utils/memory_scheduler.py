@@ -0,0 +1,124 @@
+"""
+Memory-bounded process pool shared by standardization_V2_multiprocess.py and crop_jhh_dataset.py.
+
+Every case comes with an estimate of its peak memory (from the nifti headers). A case is admitted to the pool only
+while the estimates of the running cases fit in the memory limit (at least one case always runs), largest cases first,
+smaller cases fill the remaining memory. A worker killed by the system (e.g. out of memory) breaks the pool: the cases
+that were running in it are reported as errors and a new pool takes the remaining cases.
+"""
+
+import os
+import resource
+import sys
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from tqdm import tqdm
+
+
+def is_scaled(img):
+    # a scaled nifti is read as float64
+    slope, inter = img.header.get_slope_inter()
+    return (slope is not None and slope != 1) or (inter is not None and inter != 0)
+
+
+def physical_memory():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def reset_peak_rss():
+    """
+    resets the peak resident set size of the process (linux >= 4.0), call it in the worker when a case starts so
+    peak_rss_mb is the peak of that case and not of every case the worker ran
+
+    :return: whether the peak was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # peak of the whole process, kilobytes on linux, bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def run_scheduled(cases, task, task_args, num_workers, memory_limit, on_result):
+    """
+    runs task(case, *task_args) for every case on a process pool of num_workers processes
+
+    :param cases: case -> estimated peak memory (bytes)
+    :param memory_limit: bytes the running cases may use together
+    :param on_result: on_result(case, estimate, result, error), called in the main process when a case finishes,
+        error is None or the exception of the case
+    """
+    pending = sorted(cases.items(), key=lambda item: item[1], reverse=True)
+    running = {}
+    used = 0
+    executor = ProcessPoolExecutor(max_workers=num_workers)
+    progress = tqdm(total=len(pending))
+
+    def finish(future):
+        # :return: whether the pool of the case is broken
+        nonlocal used
+        case, estimate = running.pop(future)
+        used -= estimate
+        try:
+            result, error = future.result(), None
+        except Exception as e:
+            result, error = None, e
+        on_result(case, estimate, result, error)
+        progress.update(1)
+        progress.set_postfix(
+            running=len(running), memory_gb="%.1f" % (used / 1024**3)
+        )
+        return isinstance(error, BrokenProcessPool)
+
+    try:
+        while pending or running:
+            broken = False
+            i = 0
+            while i < len(pending) and len(running) < num_workers:
+                case, estimate = pending[i]
+                if running and used + estimate > memory_limit:
+                    i += 1
+                    continue
+                try:
+                    future = executor.submit(task, case, *task_args)
+                except BrokenProcessPool:
+                    broken = True
+                    break
+                running[future] = (case, estimate)
+                used += estimate
+                pending.pop(i)
+
+            if running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    broken = finish(future) or broken
+
+            if broken:
+                # a broken pool fails every case still running in it
+                for future in wait(running, return_when=ALL_COMPLETED)[0]:
+                    finish(future)
+                tqdm.write(
+                    ">> a worker died (e.g. killed when out of memory), the cases it"
+                    " was running are marked as errors, restarting the pool for the {}"
+                    " remaining cases".format(len(pending))
+                )
+                executor.shutdown(wait=True)
+                executor = ProcessPoolExecutor(max_workers=num_workers)
+    finally:
+        progress.close()
+        executor.shutdown(wait=True)
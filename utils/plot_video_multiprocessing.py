@@ -7,12 +7,14 @@ import os
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from multiprocessing import cpu_count
 
-import cv2
-import imageio
-import nibabel as nib
-import numpy as np
-from PIL import Image
 from tqdm import tqdm
+from video_renderer import (
+    KEEP,
+    add_render_arguments,
+    build_color_lut,
+    render_case,
+    report_case,
+)
 
 low_range = -150
 high_range = 250
@@ -65,195 +67,33 @@ CLASS_IND = {
 }
 
 
-def add_colorful_mask(image, mask, class_index):
-    image[mask == class_index["spleen"], 0] = 255  # spleen (255,0,0)
-
-    image[mask == class_index["kidney_right"], 1] = 255  # kidney_right (0,255,0)
-    image[mask == class_index["kidney_left"], 1] = 255  # kidney_left (0,255,0)
-    image[mask == class_index["kidney tumor"], 1] = 255  # kidney tumor (0,255,0)
-    image[mask == class_index["kidney cyst"], 1] = 255  # kidney cyst (0,255,0)
-
-    image[mask == class_index["gall_bladder"], 0] = 255  # gall_bladder (255,255,0)
-    image[mask == class_index["gall_bladder"], 1] = 255  #
-
-    # image[mask == class_index['esophagus'], 1] = 255   # esophagus (0,255,255)
-    # image[mask == class_index['esophagus'], 2] = 255   #
-    image[mask == class_index["liver"], 0] = 255  # liver (255,0,255)
-    image[mask == class_index["hepatic vessel"], 0] = 255  # hepatic vessel (255,0,255)
-    image[mask == class_index["liver tumor"], 0] = 255  # liver tumors (255,0,255)
-    image[
-        mask == class_index["hepatic vessel tumor"], 0
-    ] = 255  # hepatic vessel tumors (255,0,255)
-    image[mask == class_index["liver"], 2] = 255  # liver (255,0,255)
-    image[mask == class_index["hepatic vessel"], 2] = 255  # hepatic vessel (255,0,255)
-    image[mask == class_index["liver tumor"], 2] = 255  # liver tumors (255,0,255)
-    image[
-        mask == class_index["hepatic vessel tumor"], 2
-    ] = 255  # hepatic vessel tumors (255,0,255)
-
-    image[mask == class_index["stomach"], 0] = 255
-    image[mask == class_index["stomach"], 1] = 239  # stomach (255,239,255)
-    image[mask == class_index["stomach"], 2] = 213  #
-
-    image[mask == class_index["aorta"], 1] = 255
-    image[mask == class_index["aorta"], 2] = 255  # aorta (0,255,255)
-
-    image[mask == class_index["postcava"], 0] = 205  # postcava (205,133,63)
-    image[mask == class_index["postcava"], 1] = 133  #
-    image[
-        mask == class_index["postcava"], 2
-    ] = 63  # + image[mask == class_index['postcava'], 2] * 0.2   #
-
-    # image[mask == class_index['portal and splenic vein'], 0] = 0 + image[mask == class_index['portal and splenic vein'], 0] * 0.5 # portal and splenic vein (0,0,255)
-    # image[mask == class_index['portal and splenic vein'], 1] = 0 + image[mask == class_index['portal and splenic vein'], 1] * 0.5 #
-    # image[mask == class_index['portal and splenic vein'], 2] = 255  #
-
-    image[mask == class_index["pancreas"], 0] = 102  # pancreas (102,205,170)
-    image[mask == class_index["pancreas"], 1] = 205
-    image[mask == class_index["pancreas"], 2] = 170  #
-    image[
-        mask == class_index["pancreatic tumor"], 0
-    ] = 102  # pancreatic tumors (102,205,170)
-    image[mask == class_index["pancreatic tumor"], 1] = 205
-    image[mask == class_index["pancreatic tumor"], 2] = 170
-
-    # image[mask == class_index['adrenal gland R'], 0] = 0 + image[mask == class_index['adrenal gland R'], 0] * 0.5 # adrenal gland R (0,255,0)
-    # image[mask == class_index['adrenal gland R'], 1] = 255 #
-    # image[mask == class_index['adrenal gland R'], 2] = 0 + image[mask == class_index['adrenal gland R'], 2] * 0.5  #
-    # image[mask == class_index['adrenal gland L'], 0] = 0 + image[mask == class_index['adrenal gland L'], 0] * 0.5 # adrenal gland L (0,255,0)
-    # image[mask == class_index['adrenal gland L'], 1] = 255 #
-    # image[mask == class_index['adrenal gland L'], 2] = 0 + image[mask == class_index['adrenal gland L'], 2] * 0.5 #
-
-    # image[mask == class_index['duodenum'], 0] = 255 # duodenum (255,80,80)
-    # image[mask == class_index['duodenum'], 1] = 80 + image[mask == class_index['duodenum'], 1] * 0.6 #
-    # image[mask == class_index['duodenum'], 2] = 80 + image[mask == class_index['duodenum'], 2] * 0.6 #
-
-    # image[mask == class_index['lung R'], 0] = 200 + image[mask == class_index['lung R'], 0] * 0.2  # lung R (200,128,0)
-    # image[mask == class_index['lung R'], 2] = 128 + image[mask == class_index['lung R'], 2] * 0.5  #
-    # image[mask == class_index['lung L'], 0] = 200 + image[mask == class_index['lung L'], 0] * 0.2  # lung L (200,128,0)
-    # image[mask == class_index['lung L'], 2] = 128 + image[mask == class_index['lung L'], 2] * 0.5  #
-    # image[mask == class_index['lung tumor'], 0] = 200 + image[mask == class_index['lung tumor'], 0] * 0.2  # lung tumor (200,128,0)
-    # image[mask == class_index['lung tumor'], 2] = 128 + image[mask == class_index['lung tumor'], 2] * 0.5  #
-
-    # image[mask == class_index['colon'], 0] = 170  # colon (170,0,255)
-    # image[mask == class_index['colon'], 1] = 0 + image[mask == class_index['colon'], 1] * 0.7    #
-    # image[mask == class_index['colon'], 2] = 255  #
-    # image[mask == class_index['colon tumor'], 0] = 170  # colon tumors (170,0,255)
-    # image[mask == class_index['colon tumor'], 1] = 0 + image[mask == class_index['colon tumor'], 1] * 0.7    #
-    # image[mask == class_index['colon tumor'], 2] = 255  #
-
-    # image[mask == class_index['prostate'], 0] = 0    # prostate (0,128,128)
-    # image[mask == class_index['prostate'], 1] = 128  #
-    # image[mask == class_index['prostate'], 2] = 128 + image[mask == class_index['prostate'], 2] * 0.5  #
-
-    # image[mask == class_index['celiac trunk'], 0] = 255    # celiac trunk (255,0,0)
-    # image[mask == class_index['celiac trunk'], 1] = 0 + image[mask == class_index['celiac trunk'], 1] * 0.5  #
-    # image[mask == class_index['celiac trunk'], 2] = 0  #
-
-    return image
-
-
-def load_individual_maps(segmentation_dir):
-    mask_path = os.path.join(segmentation_dir, "liver.nii.gz")
-    mask = nib.load(mask_path).get_fdata().astype(np.uint8)
-
-    for c in class_of_interest:
-        mask_path = os.path.join(segmentation_dir, c + ".nii.gz")
-        c_mask = nib.load(mask_path).get_fdata().astype(np.uint8)
-        mask[c_mask == 1] = CLASS_IND[c]
-
-    return mask
-
-
-def full_make_png(case_name, args):
-    for plane in ["axial", "coronal", "sagittal"]:
-        if not os.path.exists(os.path.join(args.png_save_path, plane, case_name)):
-            os.makedirs(os.path.join(args.png_save_path, plane, case_name))
-
-    image_name = f"ct.nii.gz"
-
-    image_path = os.path.join(args.abdomen_atlas, case_name, image_name)
-
-    # single case
-    image = nib.load(image_path).get_fdata().astype(np.int16)
-    mask = load_individual_maps(
-        os.path.join(args.abdomen_atlas, case_name, "segmentations")
-    )
-
-    # change orientation
-    ornt = nib.orientations.axcodes2ornt(
-        ("F", "L", "U"), (("L", "R"), ("B", "F"), ("D", "U"))
-    )
-    image = nib.orientations.apply_orientation(image, ornt)
-    mask = nib.orientations.apply_orientation(mask, ornt)
-
-    image[image > high_range] = high_range
-    image[image < low_range] = low_range
-    image = np.round((image - low_range) / (high_range - low_range) * 255.0).astype(
-        np.uint8
-    )
-    image = np.repeat(
-        image.reshape(image.shape[0], image.shape[1], image.shape[2], 1), 3, axis=3
-    )
-
-    image_mask = add_colorful_mask(image, mask, CLASS_IND)
-
-    for z in range(mask.shape[2]):
-        Image.fromarray(image_mask[:, :, z, :]).save(
-            os.path.join(args.png_save_path, "axial", case_name, str(z) + ".png")
-        )
-
-    for z in range(mask.shape[1]):
-        Image.fromarray(image_mask[:, z, :, :]).save(
-            os.path.join(args.png_save_path, "sagittal", case_name, str(z) + ".png")
-        )
-
-    for z in range(mask.shape[0]):
-        Image.fromarray(image_mask[z, :, :, :]).save(
-            os.path.join(args.png_save_path, "coronal", case_name, str(z) + ".png")
-        )
-
-
-def make_avi(case_name, plane, args):
-    if not os.path.exists(os.path.join(args.video_save_path, plane)):
-        os.makedirs(os.path.join(args.video_save_path, plane))
-    if not os.path.exists(os.path.join(args.gif_save_path, plane)):
-        os.makedirs(os.path.join(args.gif_save_path, plane))
-
-    image_folder = os.path.join(args.png_save_path, plane, case_name)
-    video_name = os.path.join(args.video_save_path, plane, case_name + ".avi")
-    gif_name = os.path.join(args.gif_save_path, plane, case_name + ".gif")
-
-    images = [img for img in os.listdir(image_folder) if img.endswith(".png")]
-
-    for i in range(len(images)):
-        images[i] = images[i].replace(".png", "")
-        images[i] = int(images[i])
-    images.sort()
-
-    frame = cv2.imread(os.path.join(image_folder, str(images[0]) + ".png"))
-    height, width, layers = frame.shape
-
-    video = cv2.VideoWriter(video_name, 0, args.FPS, (width, height))
-
-    imgs = []
-    for image in images:
-        img = cv2.imread(os.path.join(image_folder, str(image) + ".png"))
-        video.write(img)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        imgs.append(img)
-
-    cv2.destroyAllWindows()
-    video.release()
-    imageio.mimsave(gif_name, imgs, duration=args.FPS * 0.4)
+# (offset, scale) of the red, green and blue channel of every class, out = offset + scale * gray
+CLASS_COLOR = {
+    "spleen": ((255, 0), KEEP, KEEP),  # spleen (255,0,0)
+    "kidney_right": (KEEP, (255, 0), KEEP),  # kidney_right (0,255,0)
+    "kidney_left": (KEEP, (255, 0), KEEP),  # kidney_left (0,255,0)
+    "kidney tumor": (KEEP, (255, 0), KEEP),  # kidney tumor (0,255,0)
+    "kidney cyst": (KEEP, (255, 0), KEEP),  # kidney cyst (0,255,0)
+    "gall_bladder": ((255, 0), (255, 0), KEEP),  # gall_bladder (255,255,0)
+    "liver": ((255, 0), KEEP, (255, 0)),  # liver (255,0,255)
+    "hepatic vessel": ((255, 0), KEEP, (255, 0)),  # hepatic vessel (255,0,255)
+    "liver tumor": ((255, 0), KEEP, (255, 0)),  # liver tumors (255,0,255)
+    "hepatic vessel tumor": ((255, 0), KEEP, (255, 0)),  # (255,0,255)
+    "stomach": ((255, 0), (239, 0), (213, 0)),  # stomach (255,239,255)
+    "aorta": (KEEP, (255, 0), (255, 0)),  # aorta (0,255,255)
+    "postcava": ((205, 0), (133, 0), (63, 0)),  # postcava (205,133,63)
+    "pancreas": ((102, 0), (205, 0), (170, 0)),  # pancreas (102,205,170)
+    "pancreatic tumor": ((102, 0), (205, 0), (170, 0)),  # (102,205,170)
+}
 
 
 def event(folder, args):
     if folder == ".ipynb_checkpoints":
-        return
-    full_make_png(folder, args)
-    for plane in ["axial", "coronal", "sagittal"]:
-        make_avi(folder, plane, args)
+        return None
+    lut = build_color_lut(CLASS_COLOR, CLASS_IND)
+    return render_case(
+        folder, args, class_of_interest, CLASS_IND, lut, low_range, high_range
+    )
 
 
 def main(args):
@@ -272,9 +112,12 @@ def main(args):
         for future in tqdm(as_completed(futures), total=len(futures)):
             folder = futures[future]
             try:
-                future.result()
+                result = future.result()
             except Exception as e:
                 print(f"Error processing {folder}: {e}")
+                continue
+            if result is not None:
+                report_case(folder, *result)
 
 
 if __name__ == "__main__":
@@ -314,9 +157,10 @@ if __name__ == "__main__":
         default=20,
         help="the FPS value for videos",
     )
+    add_render_arguments(parser)
     args = parser.parse_args()
 
-    if not os.path.exists(args.png_save_path):
+    if args.save_png and not os.path.exists(args.png_save_path):
         os.makedirs(args.png_save_path)
 
     if not os.path.exists(args.video_save_path):
@@ -5,17 +5,19 @@ python -W ignore plot_website_video_standard_color_multiprocessing.py --abdomen_
 """
 
 import argparse
-import copy
 import os
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from multiprocessing import cpu_count
 
-import cv2
-import imageio
 import nibabel as nib
-import numpy as np
-from PIL import Image
 from tqdm import tqdm
+from video_renderer import (
+    add_render_arguments,
+    blend,
+    build_color_lut,
+    render_case,
+    report_case,
+)
 
 low_range = -150
 high_range = 250
@@ -149,148 +151,27 @@ CLASS_RGB_OPACITY = {
 }
 
 
-def add_colorful_mask(image, mask, class_index):
-    for class_name in class_of_interest:
-        indices = mask == class_index[class_name]
-        color, opacity = (
-            CLASS_RGB_OPACITY[class_name][0],
-            CLASS_RGB_OPACITY[class_name][1],
-        )
-        image[indices, 0] = np.clip(
-            image[indices, 0] * (1 - opacity) + color[0] * opacity, 0, 255
-        )
-        image[indices, 1] = np.clip(
-            image[indices, 0] * (1 - opacity) + color[1] * opacity, 0, 255
-        )
-        image[indices, 2] = np.clip(
-            image[indices, 0] * (1 - opacity) + color[2] * opacity, 0, 255
-        )
-
-    return image
-
-
-def load_individual_maps(segmentation_dir):
-    # Initializes an empty mask array to hold the combined masks.
-    combined_mask = None
-
-    for c in class_of_interest:
-        mask_path = os.path.join(segmentation_dir, c + ".nii.gz")
-        c_mask = nib.load(mask_path).get_fdata().astype(np.uint8)
-
-        if combined_mask is None:
-            combined_mask = np.zeros_like(c_mask)
-
-        combined_mask[c_mask == 1] = CLASS_IND[c]
-
-    return combined_mask
-
-
-def find_roi_bounds(mask):
-    # Identifies the top and bottom z-values with masks for the ROI.
-    present_slices = np.any(mask, axis=(0, 1))
-    z_min, z_max = np.where(present_slices)[0][[0, -1]]
-    return z_min + 5, z_max - 5
-
-
-def full_make_png(case_name, args):
-    for plane in ["axial", "coronal", "sagittal"]:
-        if not os.path.exists(os.path.join(args.png_save_path, plane, case_name)):
-            os.makedirs(os.path.join(args.png_save_path, plane, case_name))
-
-    image_name = f"ct.nii.gz"
-
-    image_path = os.path.join(args.abdomen_atlas, case_name, image_name)
-
-    # single case
-    image = nib.load(image_path).get_fdata().astype(np.int16)
-    # Load mask and find ROI bounds.
-    mask = load_individual_maps(
-        os.path.join(args.abdomen_atlas, case_name, "segmentations")
-    )
-    z_min, z_max = find_roi_bounds(mask)
-
-    # Modifications to handle the selected ROI instead of the whole volume.
-    for z in range(z_min, z_max + 1):
-        # Generate and save images for the ROI only.
-        pass  # Image generation and saving code here, adjusted for ROI.
-
-    # change orientation
-    ornt = nib.orientations.axcodes2ornt(
-        ("F", "L", "U"), (("L", "R"), ("B", "F"), ("D", "U"))
-    )
-    image = nib.orientations.apply_orientation(image, ornt)
-    mask = nib.orientations.apply_orientation(mask, ornt)
-
-    image[image > high_range] = high_range
-    image[image < low_range] = low_range
-    image = np.round((image - low_range) / (high_range - low_range) * 255.0).astype(
-        np.uint8
-    )
-    image = np.repeat(
-        image.reshape(image.shape[0], image.shape[1], image.shape[2], 1), 3, axis=3
-    )
-    original_image = copy.deepcopy(image)
-
-    image_mask = add_colorful_mask(image, mask, CLASS_IND)
-
-    concat_frame = np.concatenate((original_image, image_mask), axis=1)
-
-    for z in range(mask.shape[2]):
-        Image.fromarray(concat_frame[:, :, z, :]).save(
-            os.path.join(args.png_save_path, "axial", case_name, str(z) + ".png")
-        )
-
-    for z in range(mask.shape[1]):
-        Image.fromarray(concat_frame[:, z, :, :]).save(
-            os.path.join(args.png_save_path, "sagittal", case_name, str(z) + ".png")
-        )
-
-    for z in range(mask.shape[0]):
-        Image.fromarray(concat_frame[z, :, :, :]).save(
-            os.path.join(args.png_save_path, "coronal", case_name, str(z) + ".png")
-        )
-
-
-def make_avi(case_name, plane, args):
-    if not os.path.exists(os.path.join(args.video_save_path, plane)):
-        os.makedirs(os.path.join(args.video_save_path, plane))
-    if not os.path.exists(os.path.join(args.gif_save_path, plane)):
-        os.makedirs(os.path.join(args.gif_save_path, plane))
-
-    image_folder = os.path.join(args.png_save_path, plane, case_name)
-    video_name = os.path.join(args.video_save_path, plane, case_name + ".avi")
-    gif_name = os.path.join(args.gif_save_path, plane, case_name + ".gif")
-
-    images = [img for img in os.listdir(image_folder) if img.endswith(".png")]
-
-    for i in range(len(images)):
-        images[i] = images[i].replace(".png", "")
-        images[i] = int(images[i])
-    images.sort()
-
-    frame = cv2.imread(os.path.join(image_folder, str(images[0]) + ".png"))
-    height, width, layers = frame.shape
-
-    video = cv2.VideoWriter(video_name, 0, args.FPS, (width, height))
-
-    imgs = []
-    for image in images:
-        img = cv2.imread(os.path.join(image_folder, str(image) + ".png"))
-        video.write(img)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        imgs.append(img)
-
-    cv2.destroyAllWindows()
-    video.release()
-    imageio.mimsave(gif_name, imgs, duration=args.FPS * 0.4)
+# alpha blending of the class colours, only the classes of interest have one
+CLASS_COLOR = dict(
+    (class_name, blend(*CLASS_RGB_OPACITY[class_name]))
+    for class_name in class_of_interest
+)
 
 
 def event(folder, args):
     if folder == ".ipynb_checkpoints":
-        return
-    full_make_png(folder, args)
-    for plane in ["axial", "coronal", "sagittal"]:
-        make_avi(folder, plane, args)
+        return None
+    lut = build_color_lut(CLASS_COLOR, CLASS_IND)
+    return render_case(
+        folder,
+        args,
+        class_of_interest,
+        CLASS_IND,
+        lut,
+        low_range,
+        high_range,
+        side_by_side=True,
+    )
 
 
 def main(args):
@@ -310,9 +191,9 @@ def main(args):
         if mask_shape[3] > args.minimal_slices:
             folder_names.append(pid)
 
-    print(">> {} CPU cores are secured.".format(int(cpu_count() * 0.8)))
+    print(">> {} CPU cores are secured.".format(max(int(cpu_count() * 0.8), 1)))
 
-    with ProcessPoolExecutor(max_workers=int(cpu_count() * 0.8)) as executor:
+    with ProcessPoolExecutor(max_workers=max(int(cpu_count() * 0.8), 1)) as executor:
         futures = {
             executor.submit(event, folder, args): folder for folder in folder_names
         }
@@ -320,9 +201,12 @@ def main(args):
         for future in tqdm(as_completed(futures), total=len(futures)):
             folder = futures[future]
             try:
-                future.result()
+                result = future.result()
             except Exception as e:
                 print(f"Error processing {folder}: {e}")
+                continue
+            if result is not None:
+                report_case(folder, *result)
 
 
 if __name__ == "__main__":
@@ -369,9 +253,10 @@ if __name__ == "__main__":
         default=20,
         help="the FPS value for videos; larger the value, faster the video",
     )
+    add_render_arguments(parser)
     args = parser.parse_args()
 
-    if not os.path.exists(args.png_save_path):
+    if args.save_png and not os.path.exists(args.png_save_path):
         os.makedirs(args.png_save_path)
 
     if not os.path.exists(args.video_save_path):
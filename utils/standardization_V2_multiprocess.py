@@ -1,18 +1,32 @@
 """
 python standardization_V2_multiprocess.py --ORIGINAL_ROOT_DIR /Users/zongwei.zhou/Desktop/BodyMapsSmall --REVISED_ROOT_DIR /Users/zongwei.zhou/Desktop/BodyMapsSmallCore
+python standardization_V2_multiprocess.py --ORIGINAL_ROOT_DIR /Users/zongwei.zhou/Desktop/BodyMapsSmall --REVISED_ROOT_DIR /Users/zongwei.zhou/Desktop/BodyMapsSmallCore --memory_limit 128 --num_workers 64
+
+python standardization_V2_multiprocess.py --check_bounds --downsample 8
+
+Rerunning the command resumes: cases marked done in REVISED_ROOT_DIR/standardization_manifest.jsonl are skipped.
+--check_bounds compares the crop bounds of --downsample with the exact ones (--downsample 1) on synthetic cts.
 """
 
 import argparse
 import copy
 import glob
+import json
 import os
 import shutil
+import time
 import warnings
-from concurrent.futures import ProcessPoolExecutor, as_completed
 from multiprocessing import cpu_count
 
 import nibabel as nib
 import numpy as np
+from memory_scheduler import (
+    is_scaled,
+    peak_rss_mb,
+    physical_memory,
+    reset_peak_rss,
+    run_scheduled,
+)
 from skimage.measure import label
 from tqdm import tqdm
 
@@ -26,26 +40,95 @@ def getLargestCC(segmentation):
     return largestCC
 
 
-def find_largest_subarray_bounds(arr, low_threshold, high_threshold):
-    # Find the indices where the condition is True
-    condition = (arr > low_threshold) & (arr < high_threshold)
-    condition = getLargestCC(condition)
-    x, y, z = np.where(condition)
+def iter_slabs(dataobj, z_start, z_end, depth):
+    # reads [z_start, z_end) of the last axis in slabs of depth slices, in file order
+    for z in range(z_start, z_end, depth):
+        yield z, np.asarray(dataobj[:, :, z : min(z + depth, z_end)])
 
-    if not len(x):
-        return (0, 0, 0), (0, 0, 0)  # No values above threshold
 
-    # Find min and max indices along each dimension
-    min_x, max_x = np.min(x), np.max(x)
-    min_y, max_y = np.min(y), np.max(y)
-    min_z, max_z = np.min(z), np.max(z)
+def threshold_mask(arr, low_threshold, high_threshold):
+    return (arr > low_threshold) & (arr < high_threshold)
 
-    return (min_x, min_y, min_z), (max_x, max_y, max_z)
 
+def block_count(mask, factor):
+    # (X, Y, D) bool -> (ceil(X / factor), ceil(Y / factor)): number of set voxels in factor x factor x D blocks
+    X, Y, _ = mask.shape
+    pad = [(0, -X % factor), (0, -Y % factor), (0, 0)]
+    counts = np.pad(mask, pad).sum(axis=2, dtype=np.int32)
+    return counts.reshape(
+        counts.shape[0] // factor, factor, counts.shape[1] // factor, factor
+    ).sum(axis=(1, 3))
+
+
+def largest_counted_component(counts):
+    # connected component of the nonzero blocks holding the most voxels (not the most blocks)
+    labels = label(counts > 0)
+    return (
+        labels == np.argmax(np.bincount(labels.ravel(), weights=counts.ravel())[1:]) + 1
+    )
 
-def crop_largest_subarray(arr, low_threshold, high_threshold, case_name=None):
+
+def find_largest_subarray_bounds(
+    dataobj, low_threshold, high_threshold, factor=4, slab_depth=None
+):
+    """
+    bounds of the largest connected component of low_threshold < ct < high_threshold, without loading the volume
+    1. coarse: the ct is streamed in slabs of factor slices and the voxels in the threshold range are counted per
+    block of factor^3 voxels. Of the connected components of the nonzero blocks, the one holding the most voxels is
+    kept (counting blocks would let scattered voxels, one per block, outweigh a compact body)
+    2. refinement: the slices covered by that component are streamed again, the bounds are those of the voxels in
+    the threshold range that fall into the component
+    The full resolution component maps into a single coarse component holding at least its voxels, so the crop
+    contains it unless another coarse component holds more voxels in total, i.e. voxels only connected through
+    shared blocks. The crop can be larger by thresholded voxels that are not connected to the component but lie
+    within a block of it. factor 1 is the exact computation on the whole volume
+    """
+    X, Y, Z = dataobj.shape
+    if factor == 1:
+        condition = getLargestCC(
+            threshold_mask(np.asarray(dataobj), low_threshold, high_threshold)
+        )
+        x, y, z = np.where(condition)
+        return (np.min(x), np.min(y), np.min(z)), (np.max(x), np.max(y), np.max(z))
+
+    coarse = np.zeros((-(-X // factor), -(-Y // factor), -(-Z // factor)), np.int32)
+    for z, slab in iter_slabs(dataobj, 0, Z, factor):
+        coarse[:, :, z // factor] = block_count(
+            threshold_mask(slab, low_threshold, high_threshold), factor
+        )
+    if not coarse.any():
+        return (0, 0, 0), (0, 0, 0)  # No values above threshold
+    coarse = largest_counted_component(coarse)
+
+    cz = np.where(coarse.any(axis=(0, 1)))[0]
+    lower, upper = [X, Y, Z], [-1, -1, -1]
+    for z, slab in iter_slabs(
+        dataobj, cz[0] * factor, min((cz[-1] + 1) * factor, Z), factor
+    ):
+        # nearest neighbour upsampling of the component, cropped to the slab
+        component = coarse[:, :, z // factor]
+        component = np.repeat(np.repeat(component, factor, 0), factor, 1)[:X, :Y]
+        condition = threshold_mask(slab, low_threshold, high_threshold)
+        condition &= component[:, :, None]
+        x, y, dz = np.where(condition)
+        if len(x) == 0:
+            continue
+        lower = [
+            min(lower[0], x.min()),
+            min(lower[1], y.min()),
+            min(lower[2], z + dz.min()),
+        ]
+        upper = [
+            max(upper[0], x.max()),
+            max(upper[1], y.max()),
+            max(upper[2], z + dz.max()),
+        ]
+    return tuple(lower), tuple(upper)
+
+
+def crop_largest_subarray(arr, low_threshold, high_threshold, case_name=None, factor=4):
     (min_x, min_y, min_z), (max_x, max_y, max_z) = find_largest_subarray_bounds(
-        arr, low_threshold, high_threshold
+        arr, low_threshold, high_threshold, factor
     )
     if max_x - min_x < 50 or max_y - min_y < 50 or max_z - min_z < 5:
         print("ERROR in {}".format(case_name))
@@ -53,6 +136,25 @@ def crop_largest_subarray(arr, low_threshold, high_threshold, case_name=None):
     return (min_x, min_y, min_z), (max_x, max_y, max_z)
 
 
+def estimate_memory(original_ct_file, original_mask_file=(), factor=4):
+    """
+    peak memory (bytes) of standardization from the nifti headers: the cropped ct as read and as int16 (at most the
+    whole volume), the largest cropped mask as read and as int8, and the coarse block counts, mask and labels
+    """
+    img = nib.load(original_ct_file)
+    num_voxels = int(np.prod(img.shape[:3]))
+    ct_bytes = np.dtype(
+        img.dataobj.dtype if not is_scaled(img) else np.float64
+    ).itemsize
+    mask_bytes = 1
+    for mask_file in original_mask_file:
+        mask_img = nib.load(mask_file)
+        itemsize = 8 if is_scaled(mask_img) else mask_img.get_data_dtype().itemsize
+        mask_bytes = max(mask_bytes, itemsize)
+    coarse_bytes = 9 if factor == 1 else 13 / factor**3
+    return int(num_voxels * (ct_bytes + 2 + mask_bytes + 1 + coarse_bytes))
+
+
 def standardization(
     original_ct_file,
     revised_ct_file,
@@ -60,37 +162,54 @@ def standardization(
     revised_mask_file=None,
     image_type=np.int16,
     mask_type=np.int8,
+    factor=4,
 ):
-    img = nib.load(original_ct_file)
-    data = np.array(img.dataobj)
-
-    data[data > 1000] = 1000
-    data[data < -1000] = -1000
+    """
+    crops the ct and its masks to the body (largest connected component of -100 < HU < 100). The volumes are
+    never fully loaded: the bounds are computed by streaming the ct (see find_largest_subarray_bounds) and the ct and
+    masks are read through crops of their array proxies, one file at a time.
+    :return: crop bounds, shape of the original ct
+    """
+    img = nib.load(original_ct_file, keep_file_open=True)
 
     (min_x, min_y, min_z), (max_x, max_y, max_z) = crop_largest_subarray(
-        arr=data,
+        arr=img.dataobj,
         low_threshold=-100,
         high_threshold=100,
         case_name=original_ct_file.split("/")[-2],
+        factor=factor,
     )
-    data = data[min_x : max_x + 1, min_y : max_y + 1, min_z : max_z + 1]
+    crop = (
+        slice(min_x, max_x + 1),
+        slice(min_y, max_y + 1),
+        slice(min_z, max_z + 1),
+    )
+    data = np.asarray(img.dataobj[crop])
+
+    data[data > 1000] = 1000
+    data[data < -1000] = -1000
 
     data = nib.Nifti1Image(data, img.affine, img.header)
     data.set_data_dtype(image_type)
     data.get_data_dtype(finalize=True)
 
     nib.save(data, revised_ct_file)
+    del data
     if original_mask_file is not None and revised_mask_file is not None:
         for original, revised in zip(original_mask_file, revised_mask_file):
-            img = nib.load(original)
-            data = np.array(img.dataobj)
-            mask = data[min_x : max_x + 1, min_y : max_y + 1, min_z : max_z + 1]
+            img = nib.load(original, keep_file_open=True)
+            mask = np.asarray(img.dataobj[crop])
 
             mask = nib.Nifti1Image(mask, img.affine, img.header)
             mask.set_data_dtype(mask_type)
             mask.get_data_dtype(finalize=True)
 
             nib.save(mask, revised)
+    return [
+        [int(min_x), int(max_x)],
+        [int(min_y), int(max_y)],
+        [int(min_z), int(max_z)],
+    ]
 
 
 def rename_id(name):
@@ -100,7 +219,7 @@ def rename_id(name):
     return name
 
 
-def standardize_and_save(CT_ID, original_root_dir, revised_root_dir):
+def get_case_files(CT_ID, original_root_dir, revised_root_dir):
     original_ct_file = os.path.join(original_root_dir, CT_ID, "ct.nii.gz")
     revised_ct_file = os.path.join(revised_root_dir, CT_ID, "ct.nii.gz")
     revised_ct_file = rename_id(revised_ct_file)
@@ -112,23 +231,129 @@ def standardize_and_save(CT_ID, original_root_dir, revised_root_dir):
         s.replace(original_root_dir, revised_root_dir) for s in original_mask_files
     ]
     revised_mask_files = [rename_id(s) for s in revised_mask_files]
+    return original_ct_file, revised_ct_file, original_mask_files, revised_mask_files
+
+
+def standardize_and_save(CT_ID, original_root_dir, revised_root_dir, factor=4):
+    """
+    :return: manifest record of the case (status, crop bounds, seconds, peak memory of the worker)
+    """
+    start = time.time()
+    reset_peak_rss()
+    (
+        original_ct_file,
+        revised_ct_file,
+        original_mask_files,
+        revised_mask_files,
+    ) = get_case_files(CT_ID, original_root_dir, revised_root_dir)
 
     # Ensure the revised directories exist
     os.makedirs(os.path.dirname(revised_ct_file), exist_ok=True)
     for mask_file in revised_mask_files:
         os.makedirs(os.path.dirname(mask_file), exist_ok=True)
 
+    record = {"case": CT_ID}
     # Perform standardization and saving
     try:
-        standardization(
+        record["bounds"] = standardization(
             original_ct_file=original_ct_file,
             revised_ct_file=revised_ct_file,
             original_mask_file=original_mask_files,
             revised_mask_file=revised_mask_files,
             mask_type=np.int8,
+            factor=factor,
         )
+        record["status"] = "done"
     except Exception as e:
         print(f"Error processing {CT_ID}: {e}")
+        record["status"] = "error"
+        record["error"] = str(e)
+    record["seconds"] = round(time.time() - start, 2)
+    record["worker_peak_mb"] = round(peak_rss_mb(), 1)
+    return record
+
+
+def load_manifest(manifest_file):
+    """
+    cases completed by earlier runs
+    """
+    done = set()
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # line cut by an interrupted run
+                if record.get("status") == "done":
+                    done.add(record["case"])
+    return done
+
+
+def write_record(manifest, CT_ID, estimate, record, error):
+    if error is not None:
+        # the worker died (e.g. killed when out of memory)
+        record = {"case": CT_ID, "status": "error", "error": str(error)}
+        print(f"Error processing {CT_ID}: {error}")
+    record["estimated_mb"] = round(estimate / 1024**2, 1)
+    manifest.write(json.dumps(record) + "\n")
+    manifest.flush()
+    if record["status"] == "done":
+        tqdm.write(
+            "{}: {:.1f} s, estimated {:.0f} MB, worker peak {:.0f} MB".format(
+                CT_ID,
+                record["seconds"],
+                record["estimated_mb"],
+                record["worker_peak_mb"],
+            )
+        )
+
+
+def synthetic_cts(shape=(96, 96, 64)):
+    """
+    :return: name -> ct (HU) of air with a body at 0 HU and distractors in the -100..100 range
+    """
+    cts = {}
+    ct = np.full(shape, -1000, np.int16)
+    ct[10:30, 10:30, 10:30] = 0
+    cts["body"] = ct
+
+    ct = cts["body"].copy()
+    ct[50:94:4, 50:94:4, 20:62:4] = 0
+    cts["body and scattered voxels"] = ct
+
+    ct = cts["body"].copy()
+    ct[:, 90, :] = 50
+    cts["body and table"] = ct
+
+    ct = cts["body"].copy()
+    ct[60:70, 60:70, 40:50] = 0
+    cts["body and smaller body"] = ct
+
+    ct = cts["body"].copy()
+    ct[12:28, 12:28, 12:28] = 500
+    cts["hollow body"] = ct
+    return cts
+
+
+def check_bounds(factor):
+    mismatches = 0
+    for name, ct in synthetic_cts().items():
+        exact, bounds = [
+            [
+                tuple(int(i) for i in b)
+                for b in find_largest_subarray_bounds(ct, -100, 100, f)
+            ]
+            for f in (1, factor)
+        ]
+        same = bounds == exact
+        mismatches += not same
+        print(
+            "{}: downsample {} {}, exact {} ({})".format(
+                name, factor, bounds, exact, "same" if same else "MISMATCH"
+            )
+        )
+    print(">> {} mismatches".format(mismatches))
 
 
 def main():
@@ -140,34 +365,91 @@ def main():
     parser.add_argument(
         "--REVISED_ROOT_DIR", default=None, type=str, help="revised root directory"
     )
+    parser.add_argument(
+        "--downsample",
+        default=4,
+        type=int,
+        help="factor of the coarse volume the crop bounds are computed on, 1 is exact",
+    )
+    parser.add_argument(
+        "--num_workers", default=cpu_count(), type=int, help="maximum processes"
+    )
+    parser.add_argument(
+        "--memory_limit",
+        default=0.7 * physical_memory() / 1024**3,
+        type=float,
+        help="GB the running cases may use together (estimated from the headers)",
+    )
+    parser.add_argument(
+        "--manifest",
+        default=None,
+        type=str,
+        help=(
+            "jsonl log of the processed cases, cases done in it are skipped"
+            " (default: REVISED_ROOT_DIR/standardization_manifest.jsonl)"
+        ),
+    )
+
+    parser.add_argument(
+        "--check_bounds",
+        action="store_true",
+        default=False,
+        help=(
+            "compare the crop bounds of --downsample with the exact ones on synthetic"
+            " cts and exit"
+        ),
+    )
 
     args = parser.parse_args()
 
+    if args.check_bounds:
+        check_bounds(args.downsample)
+        return
+
     assert args.ORIGINAL_ROOT_DIR is not None
     assert args.REVISED_ROOT_DIR is not None
 
-    CT_ID_LIST = glob.glob(os.path.join(args.ORIGINAL_ROOT_DIR, "*"))
-    CT_ID_LIST = [os.path.basename(s) for s in CT_ID_LIST]
-
-    print(">> {} CPU cores are secured.".format(cpu_count()))
+    os.makedirs(args.REVISED_ROOT_DIR, exist_ok=True)
+    manifest_file = args.manifest or os.path.join(
+        args.REVISED_ROOT_DIR, "standardization_manifest.jsonl"
+    )
+    done = load_manifest(manifest_file)
 
-    with ProcessPoolExecutor(max_workers=cpu_count()) as executor:
-        futures = {
-            executor.submit(
-                standardize_and_save,
-                CT_ID,
-                args.ORIGINAL_ROOT_DIR,
-                args.REVISED_ROOT_DIR,
-            ): CT_ID
-            for CT_ID in CT_ID_LIST
-        }
-
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            CT_ID = futures[future]
-            try:
-                future.result()
-            except Exception as e:
-                print(f"Error processing {CT_ID}: {e}")
+    CT_ID_LIST = glob.glob(os.path.join(args.ORIGINAL_ROOT_DIR, "*"))
+    CT_ID_LIST = [os.path.basename(s) for s in CT_ID_LIST if os.path.isdir(s)]
+    cases = {}
+    for CT_ID in CT_ID_LIST:
+        if CT_ID in done:
+            continue
+        original_ct_file, _, original_mask_files, _ = get_case_files(
+            CT_ID, args.ORIGINAL_ROOT_DIR, args.REVISED_ROOT_DIR
+        )
+        try:
+            cases[CT_ID] = estimate_memory(
+                original_ct_file, original_mask_files, args.downsample
+            )
+        except Exception as e:
+            print(f"Error processing {CT_ID}: {e}")
+
+    print(
+        ">> {} of {} cases to process ({} done), {} workers, {:.1f} GB memory limit"
+        .format(
+            len(cases),
+            len(CT_ID_LIST),
+            len(done),
+            args.num_workers,
+            args.memory_limit,
+        )
+    )
+    with open(manifest_file, "a") as manifest:
+        run_scheduled(
+            cases,
+            standardize_and_save,
+            (args.ORIGINAL_ROOT_DIR, args.REVISED_ROOT_DIR, args.downsample),
+            args.num_workers,
+            args.memory_limit * 1024**3,
+            lambda *result: write_record(manifest, *result),
+        )
 
 
 if __name__ == "__main__":
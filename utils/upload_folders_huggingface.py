@@ -1,71 +1,106 @@
 """
 python upload_folders_huggingface.py
-"""
-
-from huggingface_hub import notebook_login
-
-notebook_login()
-
-from pathlib import Path
-
-import huggingface_hub
-import torch
-from huggingface_hub import CommitOperationAdd, HfApi
-
-# Base folder path on your computer
-base_folder = Path(
-    "/data2/wenxuan/Project/BagofTricks/SuPreM/direct_inference/AbdomenAtlasDemo"
-)  # /path/to/the/folder
-repository = "wenxuanchelsea/testAbdomenAtlas"  # Hugging face repository
-repository_type = "dataset"  # can be dataset, model, or space
-n = 1000  # number of files per commit
+python upload_folders_huggingface.py --base_folder /path/to/the/folder --repo_id wenxuanchelsea/testAbdomenAtlas --login
+python upload_folders_huggingface.py --base_folder /path/to/the/folder --backend local --repo_id /tmp/stand_in_repo
 
+Commits the files of base_folder in parts of at most --files_per_commit files and --commit_size_gb. The manifest
+records every committed file (size and mtime), a rerun only uploads the new or changed files.
+"""
 
-def get_all_files(root: Path):
-    dirs = [root]
-    while dirs:
-        current_dir = dirs.pop()
-        for candidate in current_dir.iterdir():
-            if candidate.is_file():
-                yield candidate
-            elif candidate.is_dir():
-                dirs.append(candidate)
-
+import argparse
+import os
 
-def get_groups_of_n(n: int, iterator):
-    assert n > 1
-    buffer = []
-    for elt in iterator:
-        if len(buffer) == n:
-            yield buffer
-            buffer = []
-        buffer.append(elt)
-    if buffer:
-        yield buffer
+from hf_transfer import HuggingFaceBackend, LocalBackend, upload_folder
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Upload a folder to a Hugging Face repo."
+    )
+    parser.add_argument(
+        "--base_folder",
+        type=str,
+        default="/data2/wenxuan/Project/BagofTricks/SuPreM/direct_inference/AbdomenAtlasDemo",
+        help="Base folder path on your computer",
+    )
+    parser.add_argument(
+        "--repo_id",
+        type=str,
+        default="wenxuanchelsea/testAbdomenAtlas",
+        help="Hugging face repository (a directory with --backend local)",
+    )
+    parser.add_argument(
+        "--repo_type",
+        type=str,
+        default="dataset",
+        help="can be dataset, model, or space",
+    )
+    parser.add_argument(
+        "--revision", type=str, default=None, help="branch to commit to"
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="hf",
+        choices=["hf", "local"],
+        help=(
+            "hf: the Hugging Face Hub, local: a directory standing in for the"
+            " repository"
+        ),
+    )
+    parser.add_argument(
+        "--login",
+        action="store_true",
+        help="log in to the Hugging Face Hub first (notebook_login)",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default="upload_manifest.jsonl",
+        help="jsonl of the committed files, replaces counter.pt",
+    )
+    parser.add_argument(
+        "--files_per_commit", type=int, default=1000, help="number of files per commit"
+    )
+    parser.add_argument(
+        "--commit_size_gb", type=float, default=50, help="bytes per commit, in GB"
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=5, help="parallel uploads of a commit"
+    )
+    parser.add_argument(
+        "--retries", type=int, default=3, help="retries of a failed commit"
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=10.0,
+        help="seconds before the first retry, doubled at every retry",
+    )
 
-api = HfApi()
+    args = parser.parse_args()
 
-try:
-    counter = torch.load("counter.pt")
-except FileNotFoundError:
-    counter = 0
+    if args.backend == "local":
+        os.makedirs(args.repo_id, exist_ok=True)
+        backend = LocalBackend(args.repo_id)
+    else:
+        if args.login:
+            from huggingface_hub import notebook_login
 
-for i, file_paths in enumerate(get_groups_of_n(n, get_all_files(base_folder))):
-    if i < counter:
-        continue
-    print(f"Committing {i}")
-    operations = [
-        CommitOperationAdd(
-            path_in_repo=str(file_path.relative_to(base_folder)),
-            path_or_fileobj=str(file_path),
+            notebook_login()
+        backend = HuggingFaceBackend(
+            args.repo_id,
+            repo_type=args.repo_type,
+            revision=args.revision,
+            num_threads=args.num_workers,
         )
-        for file_path in file_paths
-    ]
-    api.create_commit(
-        repo_id=repository,
-        operations=operations,
-        commit_message=f"Upload part {i}",
-        repo_type=repository_type,
+
+    uploaded, skipped, failed = upload_folder(
+        backend,
+        args.base_folder,
+        manifest_file=args.manifest,
+        files_per_commit=args.files_per_commit,
+        bytes_per_commit=int(args.commit_size_gb * 1024**3),
+        retries=args.retries,
+        backoff=args.backoff,
     )
-    torch.save(i, "counter.pt")
+    print(">> {} uploaded, {} skipped, {} failed".format(uploaded, skipped, failed))
@@ -0,0 +1,214 @@
+"""
+Renderer shared by plot_video_multiprocessing.py, plot_website_video_multiprocessing.py and
+plot_website_video_standard_color_multiprocessing.py.
+
+The colour of every class is a per channel function of the gray value, out = offset + scale * gray, so the overlay of
+a whole slice is a single gather lut[label, gray] in a (labels, 256, 3) table. Frames are rendered slice by slice and
+written straight to the avi and gif encoders; the png of every slice is only written with --save_png.
+"""
+
+import os
+import time
+
+import cv2
+import imageio
+import nibabel as nib
+import numpy as np
+from PIL import Image
+
+PLANES = ["axial", "coronal", "sagittal"]
+
+# (offset, scale) of a channel that keeps the gray value
+KEEP = (0, 1.0)
+
+# frame axis along which side_by_side puts the ct next to the overlay, as np.concatenate((ct, overlay), axis=1) of
+# the reoriented volume
+SIDE_BY_SIDE_AXIS = {"axial": 1, "coronal": 0, "sagittal": 1}
+
+
+def blend(color, opacity):
+    # alpha blending gray * (1 - opacity) + color * opacity, per channel
+    return tuple((c * opacity, 1.0 - opacity) for c in color)
+
+
+def build_color_lut(colors, class_index):
+    """
+    :param colors: class name -> ((offset, scale) of the red, green and blue channels)
+    :param class_index: class name -> label value
+    :return: (max label + 1, 256, 3) uint8, lut[label, gray] is the rgb of a voxel
+    """
+    gray = np.arange(256, dtype=np.float64)
+    lut = np.repeat(gray[None, :, None], max(class_index.values()) + 1, axis=0)
+    lut = np.repeat(lut, 3, axis=2)
+    for class_name, channels in colors.items():
+        for c, (offset, scale) in enumerate(channels):
+            lut[class_index[class_name], :, c] = offset + scale * gray
+    # the float to uint8 assignment of the former per class masking truncates
+    return np.floor(np.clip(lut, 0, 255)).astype(np.uint8)
+
+
+def build_window_lut(low_range, high_range):
+    # int16 hu in [low_range, high_range] -> uint8 gray, as round((hu - low) / (high - low) * 255)
+    hu = np.arange(low_range, high_range + 1, dtype=np.float64)
+    return np.round((hu - low_range) / (high_range - low_range) * 255.0).astype(
+        np.uint8
+    )
+
+
+def load_label_map(segmentation_dir, class_names, class_index):
+    label_map = None
+    for c in class_names:
+        mask_path = os.path.join(segmentation_dir, c + ".nii.gz")
+        c_mask = np.asanyarray(nib.load(mask_path).dataobj)
+        if label_map is None:
+            label_map = np.zeros(c_mask.shape, dtype=np.uint8)
+        label_map[c_mask == 1] = class_index[c]
+    return label_map
+
+
+def roi_bounds(mask, margin):
+    # slices of the last axis with a mask, extended by margin
+    present_slices = np.where(np.any(mask, axis=(0, 1)))[0]
+    if len(present_slices) == 0:
+        return slice(None)
+    z_min = max(present_slices[0] - margin, 0)
+    z_max = min(present_slices[-1] + margin + 1, mask.shape[2])
+    return slice(z_min, z_max)
+
+
+def load_case(case_dir, class_names, class_index, low_range, high_range, roi_margin):
+    """
+    :param roi_margin: None for the whole volume, otherwise the volume is cropped once to the slices with a mask
+    :return: gray (uint8) and label map of the case, in the orientation of the videos
+    """
+    image = np.asanyarray(nib.load(os.path.join(case_dir, "ct.nii.gz")).dataobj)
+    image = image.astype(np.int16)
+    mask = load_label_map(
+        os.path.join(case_dir, "segmentations"), class_names, class_index
+    )
+    if roi_margin is not None:
+        roi = roi_bounds(mask, roi_margin)
+        image, mask = image[:, :, roi], mask[:, :, roi]
+
+    window_lut = build_window_lut(low_range, high_range)
+    gray = window_lut[np.clip(image, low_range, high_range) - low_range]
+
+    # change orientation
+    ornt = nib.orientations.axcodes2ornt(
+        ("F", "L", "U"), (("L", "R"), ("B", "F"), ("D", "U"))
+    )
+    gray = nib.orientations.apply_orientation(gray, ornt)
+    mask = nib.orientations.apply_orientation(mask, ornt)
+    return gray, mask
+
+
+def plane_slices(volume, plane):
+    if plane == "axial":
+        return [volume[:, :, z] for z in range(volume.shape[2])]
+    if plane == "sagittal":
+        return [volume[:, z] for z in range(volume.shape[1])]
+    return [volume[z] for z in range(volume.shape[0])]
+
+
+def iter_frames(gray, mask, lut, plane, side_by_side=False):
+    for gray_slice, mask_slice in zip(
+        plane_slices(gray, plane), plane_slices(mask, plane)
+    ):
+        frame = lut[mask_slice, gray_slice]
+        if side_by_side:
+            frame = np.concatenate(
+                (np.repeat(gray_slice[..., None], 3, axis=2), frame),
+                axis=SIDE_BY_SIDE_AXIS[plane],
+            )
+        yield frame
+
+
+def write_plane(case_name, plane, frames, args):
+    """
+    streams the frames of a plane into the avi and the gif (and the pngs with --save_png)
+    :return: number of frames
+    """
+    for save_path in (args.video_save_path, args.gif_save_path):
+        if not os.path.exists(os.path.join(save_path, plane)):
+            os.makedirs(os.path.join(save_path, plane), exist_ok=True)
+    png_folder = os.path.join(args.png_save_path, plane, case_name)
+    if args.save_png and not os.path.exists(png_folder):
+        os.makedirs(png_folder, exist_ok=True)
+
+    video_name = os.path.join(args.video_save_path, plane, case_name + ".avi")
+    gif_name = os.path.join(args.gif_save_path, plane, case_name + ".gif")
+
+    video = None
+    num_frames = 0
+    with imageio.get_writer(gif_name, mode="I", duration=args.FPS * 0.4) as gif:
+        for z, frame in enumerate(frames):
+            if video is None:
+                height, width = frame.shape[:2]
+                video = cv2.VideoWriter(video_name, 0, args.FPS, (width, height))
+            video.write(np.ascontiguousarray(frame[..., ::-1]))
+            gif.append_data(frame)
+            if args.save_png:
+                Image.fromarray(frame).save(os.path.join(png_folder, str(z) + ".png"))
+            num_frames += 1
+    if video is not None:
+        video.release()
+    return num_frames
+
+
+def render_case(
+    case_name,
+    args,
+    class_names,
+    class_index,
+    lut,
+    low_range,
+    high_range,
+    side_by_side=False,
+):
+    """
+    :return: number of frames of the three planes and seconds, loading included
+    """
+    start = time.time()
+    gray, mask = load_case(
+        os.path.join(args.abdomen_atlas, case_name),
+        class_names,
+        class_index,
+        low_range,
+        high_range,
+        args.roi_margin if args.crop_roi else None,
+    )
+    num_frames = 0
+    for plane in PLANES:
+        num_frames += write_plane(
+            case_name, plane, iter_frames(gray, mask, lut, plane, side_by_side), args
+        )
+    return num_frames, time.time() - start
+
+
+def add_render_arguments(parser):
+    parser.add_argument(
+        "--save_png",
+        action="store_true",
+        default=False,
+        help="also save the png of every slice to --png_save_path",
+    )
+    parser.add_argument(
+        "--crop_roi",
+        action="store_true",
+        default=False,
+        help="only render the slices with a mask (plus --roi_margin)",
+    )
+    parser.add_argument(
+        "--roi_margin",
+        type=int,
+        default=5,
+        help="slices kept on both sides of the masks with --crop_roi",
+    )
+
+
+def report_case(case_name, num_frames, seconds):
+    print(
+        "{}: {} frames in {:.1f} s, {:.1f} frames/s".format(
+            case_name, num_frames, seconds, num_frames / max(seconds, 1e-9)
+        )
+    )